@@ -0,0 +1,42 @@
+"""Encode/decode time and bytes on the wire for each codec, over typical command payloads
+
+    python -m benchmarks.codec_bench [iterations]
+"""
+import sys
+
+from time import perf_counter
+
+from modules.utils import codec
+
+PAYLOADS = {
+    'command': codec.request(1234, 'my_ctx', ['some', 'user', 'args'], {
+        'server.id': '293847561928374651',
+        'message.id': '918273645019283746',
+        'channel.id': '192837465019283746',
+        'server.name': 'A fairly ordinary server',
+        'author.name': 'somebody'
+    }),
+    'response': codec.reply(1234, ['send_message', '192837465019283746', 'All the parameters given: some, user, args']),
+    'wake': codec.reply(7, [True] * 20),
+    'long text': codec.reply(99, ['send_message', '192837465019283746', 'lorem ipsum dolor sit amet ' * 70])
+}
+
+def main(n=100000):
+    for name, payload in PAYLOADS.items():
+        print(name)
+        for wire in codec.CODECS.values():
+            data = wire.encode(payload)
+            start = perf_counter()
+            for i in range(n):
+                wire.encode(payload)
+            encode = (perf_counter() - start) / n
+            start = perf_counter()
+            for i in range(n):
+                wire.decode(data)
+            decode = (perf_counter() - start) / n
+            size = len(data.encode() if isinstance(data, str) else data)
+            print('  {:<8} {:6d} bytes   encode {:6.2f}us   decode {:6.2f}us'.format(
+                wire.name, size, encode * 1e6, decode * 1e6))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""Cost of building a command's context kwargs and resolving its response: splitting and walking each
+@requires path per message with a value-equality lookup on the way back, against a compiled extractor
+and typed handles
+
+    python -m benchmarks.context_bench [iterations]
+"""
+import sys
+
+from time import perf_counter
+
+from modules.utils.moduletools import HANDLES, ref
+from modules.utils.router import make_route
+
+class Obj:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+def iter_getattr(obj, attr):
+    attrs = attr.split('.')
+    while len(attrs) > 0:
+        obj = getattr(obj, attrs.pop(0))
+    return obj
+
+def old_context(required, message):
+    kwargs = {}
+    kwargs.update({
+        'server.id': message.server.id,
+        'message.id': message.id,
+        'channel.id': message.channel.id
+    })
+    for k in required:
+        kwargs.update({k: iter_getattr(message, k)})
+    return kwargs
+
+def old_resolve(message, kwargs, response):
+    rattr,*rargs = response
+    for i in range(len(rargs)):
+        for k,v in kwargs.items():
+            if v == rargs[i]:
+                rargs[i] = message if k == 'message.id' else getattr(message, k.split('.')[0])
+    return rargs
+
+def new_resolve(message, response):
+    rattr,*rargs = response
+    for i, arg in enumerate(rargs):
+        if type(arg) is dict and 'ref' in arg:
+            rargs[i] = HANDLES[arg['ref']](message)
+    return rargs
+
+def main(iterations=200000):
+    server = Obj(id='1', name='a server', owner=Obj(id='2', name='owner'))
+    message = Obj(id='3', content='!cmd', server=server, channel=Obj(id='4', name='general', server=server),
+                  author=Obj(id='5', name='someone', display_name='someone'))
+    required = ('server.name', 'author.name', 'server.owner.name', 'channel.name')
+    route = make_route('Example', 'localhost:9000', required)
+
+    start = perf_counter()
+    for i in range(iterations):
+        kwargs = old_context(required, message)
+        old_resolve(message, kwargs, ['send_message', '4', 'some text'])
+    old = (perf_counter() - start) / iterations
+    print('{:>10}: {:.2f}us per command'.format('getattr', old * 1e6))
+
+    start = perf_counter()
+    for i in range(iterations):
+        kwargs = route.extract(message)
+        new_resolve(message, ['send_message', ref('channel'), 'some text'])
+    new = (perf_counter() - start) / iterations
+    print('{:>10}: {:.2f}us per command ({:.1f}x)'.format('compiled', new * 1e6, old / new))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
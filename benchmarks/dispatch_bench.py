@@ -0,0 +1,57 @@
+"""Cost of finding the pool for a request with many modules running: the old regex scan over every
+pool against the route table
+
+    python -m benchmarks.dispatch_bench [modules] [lookups]
+"""
+import random
+import re
+import sys
+
+from time import perf_counter
+
+from module_manager import Manager
+
+class FakePool:
+    def __init__(self, i):
+        self.name = 'Synthetic{}'.format(i)
+        self.route = '/synthetic{}'.format(i)
+        self.commands = frozenset('cmd_{}_{}'.format(i, c) for c in range(10))
+        self.pattern = re.compile(r'^{}$'.format(self.route))
+
+def regex_scan(processes, route, act):
+    # what Manager.dispatch used to do, minus forwarding to every match
+    for pool in processes.values():
+        if pool.pattern.match(route):
+            return pool
+
+def main(n=500, lookups=200000):
+    manager = Manager.__new__(Manager)
+    manager.processes = dict(('synthetic_{}'.format(i), FakePool(i)) for i in range(n))
+    start = perf_counter()
+    manager._rebuild_routes()
+    print('rebuilt routes for {} modules in {:.2f}ms'.format(n, (perf_counter() - start) * 1e3))
+
+    requests = []
+    for i in range(1000):
+        m = random.randrange(n)
+        requests.append(('/synthetic{}'.format(m), 'cmd_{}_{}'.format(m, random.randrange(10))))
+
+    for label, lookup in [('regex scan', lambda r, a: regex_scan(manager.processes, r, a)),
+                          ('route table', manager.resolve)]:
+        count = lookups if label == 'route table' else lookups // 100
+        start = perf_counter()
+        for i in range(count):
+            lookup(*requests[i % 1000])
+        elapsed = perf_counter() - start
+        print('{:>12}: {:.2f}us per request'.format(label, elapsed / count * 1e6))
+
+    start = perf_counter()
+    for i in range(lookups):
+        try:
+            manager.resolve('/nothing_here', 'cmd')
+        except LookupError:
+            pass
+    print('{:>12}: {:.2f}us per request'.format('unknown', (perf_counter() - start) / lookups * 1e6))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+"""Cost per sample of the metrics hot path, against an empty loop doing the same timing calls
+
+    python -m benchmarks.metrics_bench [samples]
+"""
+import random
+import sys
+
+from time import perf_counter
+
+from modules.utils.metrics import Metrics
+
+def per_sample(fn, n):
+    start = perf_counter()
+    fn(n)
+    return (perf_counter() - start) / n * 1e9
+
+def main(n=1000000):
+    metrics = Metrics()
+    # a spread of latencies from a few microseconds to a few seconds
+    samples = [random.lognormvariate(-7, 2) for i in range(10000)]
+
+    def baseline(n):
+        for i in range(n):
+            samples[i % 10000]
+
+    def observe(n):
+        observe = metrics.observe
+        for i in range(n):
+            observe('bench', samples[i % 10000])
+
+    def record(n):
+        record = metrics.histograms['bench'].record
+        for i in range(n):
+            record(samples[i % 10000])
+
+    def incr(n):
+        incr = metrics.incr
+        for i in range(n):
+            samples[i % 10000]
+            incr('bench')
+
+    base = per_sample(baseline, n)
+    for name, fn in [('observe', observe), ('Histogram.record', record), ('incr', incr)]:
+        print('{:>17}: {:.0f}ns per sample'.format(name, per_sample(fn, n) - base))
+
+    start = perf_counter()
+    summary = metrics.histograms['bench'].summary()
+    print('summary of {} samples in {:.2f}ms: {}'.format(summary['count'], (perf_counter() - start) * 1e3, summary))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,46 @@
+"""Routes synthetic messages through the prefix trie and command table
+
+    python -m benchmarks.route_bench [messages] [servers] [commands]
+"""
+import random
+import sys
+
+from time import perf_counter
+
+from modules.utils.router import Router
+
+def main(n=1000000, servers=1000, commands=500):
+    router = Router('!')
+    prefixes = {}
+    for s in range(servers):
+        prefixes[str(s)] = random.choice(['?', '$', '>>', 'pj ', '.'])
+        router.set_prefix(str(s), prefixes[str(s)])
+    router.register('Synthetic', 'localhost:1337/synthetic', dict(
+        ('cmd{}'.format(c), {'requires': [], 'permissions': []}) for c in range(commands)))
+
+    server_ids = [str(s) for s in range(servers)]
+    messages = []
+    for i in range(10000):
+        server = random.choice(server_ids)
+        if i % 4 == 0:
+            content = 'just chatting about nothing in particular'
+        else:
+            prefix = random.choice([router.global_prefix, prefixes[server]])
+            content = '{}cmd{} some args here'.format(prefix, random.randrange(commands))
+        messages.append((server, content))
+
+    routed = 0
+    parse = router.parse
+    table = router.commands
+    start = perf_counter()
+    for i in range(n):
+        server, content = messages[i % 10000]
+        parsed = parse(server, content)
+        if parsed is not None and parsed[1] in table:
+            routed += 1
+    elapsed = perf_counter() - start
+    print('{} messages ({} commands) in {:.3f}s: {:.0f} msg/s, {:.2f}us each'.format(
+        n, routed, elapsed, n / elapsed, elapsed / n * 1e6))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+"""Throughput of worker -> manager responses through the queue alone vs the shared-memory ring
+
+    python -m benchmarks.shm_bench [seconds per case]
+"""
+import multiprocessing
+import pickle
+import sys
+
+from time import perf_counter
+
+from modules.utils.shm import SharedRing, ShmRef
+
+SIZES = [('1 KB', 1024), ('100 KB', 100 * 1024), ('5 MB', 5 * 1024 * 1024)]
+
+def worker(queue, ring, size, seconds):
+    response = ['send_message', '192837465019283746', 'x' * size]
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        if ring is None:
+            queue.put(response)
+        else:
+            ref = ring.write(pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL))
+            queue.put(response if ref is None else ref)
+    queue.put(None)
+
+def run(size, seconds, use_ring):
+    queue = multiprocessing.Queue(maxsize=64)
+    ring = SharedRing(64 * 1024 * 1024) if use_ring else None
+    proc = multiprocessing.Process(target=worker, args=(queue, ring, size, seconds))
+    start = perf_counter()
+    proc.start()
+    count = 0
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        if isinstance(item, ShmRef):
+            item = ring.load(item)
+        count += 1
+    elapsed = perf_counter() - start
+    proc.join()
+    if ring is not None:
+        ring.close()
+    return count / elapsed
+
+def main(seconds=2.0):
+    seconds = float(seconds)
+    for name, size in SIZES:
+        queue = run(size, seconds, False)
+        ring = run(size, seconds, True)
+        print('{:>7}: queue {:9.0f} msg/s ({:8.1f} MB/s)   ring {:9.0f} msg/s ({:8.1f} MB/s)'.format(
+            name, queue, queue * size / 1e6, ring, ring * size / 1e6))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
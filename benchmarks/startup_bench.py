@@ -0,0 +1,80 @@
+"""Module discovery time with synthetic modules: importing and constructing every module (the old
+get_modules) against reading them from source, with and without the discovery cache
+
+    python -m benchmarks.startup_bench [modules] [commands per module]
+"""
+import importlib
+import os
+import sys
+import tempfile
+
+from time import perf_counter
+
+from modules.utils import sql
+from modules.utils.discovery import Discovery
+from modules.utils.moduletools import BaseModule
+
+TEMPLATE = '''from modules.utils.moduletools import BaseModule, command, requires, checks
+
+class Synthetic{i}(BaseModule):
+    options = {{'option_{i}': 'default'}}
+{commands}
+'''
+
+COMMAND = '''
+    @command
+    @requires('server.name')
+    @checks('manage_messages')
+    async def cmd_{i}_{c}(self, *args, **ctx):
+        """Synthetic command {c} of module {i}."""
+        return ['send_message', ctx['channel.id'], 'hi']
+'''
+
+def write_package(root, package, n, commands):
+    path = os.path.join(root, package)
+    os.mkdir(path)
+    open(os.path.join(path, '__init__.py'), 'w').close()
+    for i in range(n):
+        with open(os.path.join(path, 'synthetic_{}.py'.format(i)), 'w') as f:
+            f.write(TEMPLATE.format(i=i, commands=''.join(COMMAND.format(i=i, c=c) for c in range(commands))))
+    return path
+
+def eager(package, n, config):
+    """What Manager.get_modules used to do"""
+    modules = {}
+    for i in range(n):
+        module = importlib.import_module('{}.synthetic_{}'.format(package, i))
+        for attr in module.__dict__.values():
+            if isinstance(attr, type) and issubclass(attr, BaseModule) and attr != BaseModule:
+                attr(config=config)
+                modules[module.__name__] = [attr, sql.Module.get(sql.Module.name == attr.__name__)]
+    return modules
+
+def lazy(path, package, cache_path, db):
+    discovery = Discovery(path, package, cache_path)
+    modules = {}
+    with db.connection_context():
+        for name, info in discovery.discover().items():
+            row, _ = sql.Module.get_or_create(name=info.name, defaults={'url': 'localhost:1337/' + info.name.lower()})
+            modules[name] = [info, row]
+    return modules
+
+def timed(label, fn, *args):
+    start = perf_counter()
+    result = fn(*args)
+    print('{:>24}: {:.3f}s for {} modules'.format(label, perf_counter() - start, len(result)))
+
+def main(n=100, commands=10):
+    with tempfile.TemporaryDirectory() as root:
+        config = {'database_url': 'sqlite:///' + os.path.join(root, 'bench.db'), 'uri': ['localhost', '1337']}
+        db = sql.db_init(config['database_url'])
+        path = write_package(root, 'synthetic_modules', n, commands)
+        sys.path.insert(0, root)
+        cache_path = os.path.join(root, 'discovery_cache.json')
+
+        timed('discovery, cold cache', lazy, path, 'synthetic_modules', cache_path, db)
+        timed('discovery, warm cache', lazy, path, 'synthetic_modules', cache_path, db)
+        timed('import and construct', eager, 'synthetic_modules', n, config)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,24 +1,426 @@
 from aioprocessing import AioProcess, AioQueue, AioJoinableQueue
-from types import ModuleType
 import sys
+import os
 import websockets
 import json
 import asyncio
-import re
+import itertools
+import pickle
+import queue
 
-from modules import *
-from modules.utils import sql
-from modules.utils.moduletools import BaseModule
+from functools import partial
+from multiprocessing import Value
+from time import monotonic
 
-MANAGER_ACTIONS = ['wake', 'enable', 'disable', 'start', 'stop', 'stop_all', 'refresh', 'refresh_all', 'sleep']
+from modules.utils import sql, codec, metrics
+from modules.utils.discovery import Discovery
+from modules.utils.balancer import NotRunning
+from modules.utils.cache import LRUCache, MISSING
+from modules.utils.moduletools import module_settings, result_key
+from modules.utils.shm import SharedRing, ShmRef
+
+POOL_SETTINGS = [
+    'min_workers', 'max_workers', 'scale_up_depth', 'scale_interval', 'shm_size', 'shm_threshold',
+    'heartbeat_timeout', 'restart_backoff', 'max_restart_backoff', 'result_cache_size'
+]
+MANAGER_ACTIONS = [
+    'wake', 'enable', 'disable', 'start', 'stop', 'stop_all', 'refresh', 'refresh_all', 'sleep',
+    'manifest', 'invalidate_options', 'health', 'metrics_snapshot'
+]
+
+class Worker:
+    """A module process and the handles the pool keeps on it"""
+
+    def __init__(self, wid, module):
+        self.wid = wid
+        # queues of its own, so killing a worker mid-get can't leave a lock held on one the others share
+        self.in_queue = AioJoinableQueue()
+        self.out_queue = AioQueue()
+        # for notifications every worker must see
+        self.control = AioQueue()
+        # bumped by the worker's event loop, so a wedged loop shows up as a stale value
+        self.heartbeat = Value('d', 0.0, lock=False)
+        self.spawned = monotonic()
+        # requests handed to it and not yet answered, rid -> when
+        self.assigned = {}
+        self.retiring = False
+        self.dispatcher = None
+        self.proc = AioProcess(target=module.run, args=(self.in_queue, self.out_queue, self.control, self.heartbeat))
+        self.proc.start()
+
+    @property
+    def ready(self):
+        """Whether its event loop has started"""
+        return self.heartbeat.value > 0
+
+    @property
+    def heartbeat_age(self):
+        return monotonic() - (self.heartbeat.value or self.spawned)
+
+
+class Stream:
+    """Chunks of one streaming request on their way from a worker to whoever asked for them"""
 
-class Manager:
     def __init__(self):
-        self.config = self._load_config('module_server_config.json')
+        self.chunks = asyncio.Queue()
+        self.rid = None
+        self.worker = None
+        self.request = None
+
+
+class ModulePool:
+    """Worker processes serving one module, fed from a backlog, scaled with its depth and restarted when they die"""
+
+    def __init__(self, module_instance, min_workers=1, max_workers=1, scale_up_depth=4, scale_interval=1.0,
+                 shm_size=0, shm_threshold=65536, heartbeat_timeout=10.0, restart_backoff=0.5, max_restart_backoff=30.0,
+                 result_cache_size=1024, metrics=None, generation=0):
+        self.module = module_instance
+        self.name = module_instance.__class__.__name__
+        # bumped on every hot reload
+        self.generation = generation
+        self.metrics = metrics
+        # queue wait per priority, so the levels can be tuned
+        self._wait_metrics = tuple('manager.{}.wait.{}'.format(self.name, p) for p in codec.PRIORITY_NAMES)
+        self._expired_metric = 'manager.{}.expired'.format(self.name)
+        self._service_metric = 'manager.{}.service'.format(self.name)
+        self._execute_metric = 'module.{}.execute'.format(self.name)
+        self._error_metric = 'module.{}.errors'.format(self.name)
+        # made before any worker forks, so they all share the segment
+        self.ring = None
+        if shm_size:
+            self.ring = SharedRing(shm_size)
+            module_instance.ring = self.ring
+            module_instance.shm_threshold = shm_threshold
+        self.route = module_instance.route
+        manifest = module_instance.manifest()
+        self.commands = frozenset(manifest)
+        # command -> its @cacheable spec, and (chunks, response) for results that may be reused
+        self.cacheable = dict((name, spec['cache']) for name, spec in manifest.items() if spec['cache'])
+        self.results = LRUCache(maxsize=result_cache_size)
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.scale_up_depth = scale_up_depth
+        self.scale_interval = scale_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        # (priority, rid, deadline, request) for requests no worker has had room for yet, most urgent
+        # and then oldest first
+        self.backlog = asyncio.PriorityQueue()
+        self.workers = {}
+        self.restarts = 0
+        self.expired = 0
+        self.last_latency = None
+        self._crashes = 0
+        self._next_restart = 0.0
+        # rid -> (future, time sent)
+        self.pending = {}
+        # rid -> Stream for requests whose chunks are forwarded as they come, and rid -> chunks so far
+        # for those that want them all at the end or whose result gets cached
+        self.streams = {}
+        self.collected = {}
+        self._ids = itertools.count()
+        self._wids = itertools.count()
+        self._room = asyncio.Event()
+        self._feeder = None
+        self._supervisor = None
+
+    @property
+    def active(self):
+        # dead ones are left to _reap, and new work waits in the backlog for their restart meanwhile
+        return [w for w in self.workers.values() if not w.retiring and w.proc.is_alive()]
+
+    def _spawn(self):
+        worker = Worker(next(self._wids), self.module)
+        worker.dispatcher = asyncio.ensure_future(self._dispatch(worker))
+        self.workers[worker.wid] = worker
+        self._room.set()
+
+    async def _retire(self):
+        worker = min(self.active, key=lambda w: len(w.assigned))
+        worker.retiring = True
+        await worker.in_queue.coro_put(None)
+
+    def _fail_assigned(self, worker, reason):
+        for rid in worker.assigned:
+            fut, sent = self.pending.pop(rid, (None, None))
+            if fut is not None and not fut.done():
+                fut.set_exception(RuntimeError(reason))
+        worker.assigned.clear()
+
+    def _reap(self):
+        """Drops exited workers, failing whatever a crashed one was running"""
+        for wid, worker in list(self.workers.items()):
+            if worker.proc.is_alive():
+                continue
+            self.workers.pop(wid)
+            if self.ring is not None:
+                # once its dispatcher has loaded everything it queued, anything it still holds is orphaned
+                worker.dispatcher.add_done_callback(partial(self._free_blocks, worker))
+            if worker.proc.exitcode != 0:
+                self._fail_assigned(worker, 'Worker {} died with exit code {}'.format(wid, worker.proc.exitcode))
+                self._crashed()
+
+    def _free_blocks(self, worker, dispatcher):
+        freed = self.ring.release_owner(worker.proc.pid)
+        if freed is None:
+            print('Could not free shared memory left by worker {} of {}, the ring lock is stuck'.format(worker.wid, self.name))
+        elif freed:
+            print('Freed {} shared memory blocks left by worker {} of {}'.format(freed, worker.wid, self.name))
+
+    def _crashed(self):
+        self.restarts += 1
+        self._crashes += 1
+        delay = min(self.restart_backoff * 2 ** (self._crashes - 1), self.max_restart_backoff)
+        self._next_restart = monotonic() + delay
+
+    def broadcast(self, msg):
+        for worker in self.workers.values():
+            worker.control.put(msg)
+
+    def start(self):
+        for i in range(self.min_workers):
+            self._spawn()
+        self._feeder = asyncio.ensure_future(self._feed())
+        self._supervisor = asyncio.ensure_future(self._supervise())
+
+    def _least_loaded(self):
+        workers = [w for w in self.active if len(w.assigned) < self.module.max_concurrency]
+        return min(workers, key=lambda w: len(w.assigned)) if workers else None
+
+    def _expire(self, rid):
+        fut, sent = self.pending.pop(rid)
+        self.expired += 1
+        if self.metrics is not None:
+            self.metrics.incr(self._expired_metric)
+        if not fut.done():
+            fut.set_exception(TimeoutError('Request to {} expired after {:.2f}s in the queue'.format(
+                self.name, monotonic() - sent)))
+
+    async def _feed(self):
+        """Moves requests from the backlog to the least loaded worker with a free slot, most urgent first"""
+        while True:
+            priority, rid, deadline, item = await self.backlog.get()
+            if item is None:
+                for worker in self.active:
+                    await worker.in_queue.coro_put(None)
+                break
+            if rid not in self.pending:
+                # the caller gave up while it was queued
+                continue
+            worker = self._least_loaded()
+            while worker is None:
+                self._room.clear()
+                await self._room.wait()
+                worker = self._least_loaded()
+            now = monotonic()
+            if rid not in self.pending:
+                continue
+            if deadline is not None and now > deadline:
+                # nobody is waiting on this any more, so don't spend a worker on it
+                self._expire(rid)
+                continue
+            worker.assigned[rid] = now
+            if rid in self.streams:
+                self.streams[rid].worker = worker
+            if self.metrics is not None:
+                self.metrics.observe(self._wait_metrics[priority], now - self.pending[rid][1])
+            await worker.in_queue.coro_put(item)
+
+    async def _dispatch(self, worker):
+        """Hands each of a worker's responses to whoever is waiting on its request id"""
+        while True:
+            try:
+                # polled rather than woken with a sentinel, since a worker that died mid-send can leave
+                # the queue's write lock held for good
+                item = await worker.out_queue.coro_get(timeout=self.scale_interval)
+            except queue.Empty:
+                if worker.proc.is_alive():
+                    continue
+                break
+            kind, rid, response, error, elapsed = item
+            if self.ring is not None and error is None:
+                # with a ring, workers send every response as a ShmRef or as its pickled bytes
+                response = self.ring.load(response) if isinstance(response, ShmRef) else pickle.loads(response)
+            if kind == 'chunk':
+                self._chunk(worker, rid, response)
+                continue
+            handed = worker.assigned.pop(rid, None)
+            if self.metrics is not None and handed is not None:
+                self.metrics.observe(self._service_metric, monotonic() - handed)
+                self.metrics.observe(self._execute_metric, elapsed)
+                if error is not None:
+                    self.metrics.incr(self._error_metric)
+            self._room.set()
+            fut, sent = self.pending.pop(rid, (None, None))
+            if fut is None or fut.done():
+                continue
+            self.last_latency = monotonic() - sent
+            if error is not None:
+                fut.set_exception(RuntimeError(error))
+            else:
+                fut.set_result(response)
+
+    def _chunk(self, worker, rid, chunk):
+        if rid in self.collected:
+            self.collected[rid].append(chunk)
+        stream = self.streams.get(rid)
+        if stream is not None:
+            stream.chunks.put_nowait(chunk)
+            return
+        # nobody is pacing this one, so let the worker carry straight on
+        worker.control.put(['credit', rid, 1])
+
+    def credit(self, stream, n=1):
+        """Lets the worker running a stream send n more chunks"""
+        if stream.worker is not None:
+            stream.worker.control.put(['credit', stream.rid, n])
+
+    async def _supervise(self):
+        """Restarts dead or wedged workers with backoff, and scales between min and max workers"""
+        while True:
+            await asyncio.sleep(self.scale_interval)
+            for worker in list(self.workers.values()):
+                if worker.proc.is_alive() and worker.heartbeat_age > self.heartbeat_timeout:
+                    print('Worker {} of {} stopped responding, killing it'.format(worker.wid, self.module.__class__.__name__))
+                    worker.proc.kill()
+            self._reap()
+            if self._feeder.done():
+                # stopping, and every worker has its sentinel, so there's nothing left to restart or scale for
+                continue
+
+            active = len(self.active)
+            if active < self.min_workers:
+                if monotonic() >= self._next_restart:
+                    self._spawn()
+                continue
+            if not self.pending and self._crashes and monotonic() > self._next_restart + self.max_restart_backoff:
+                # been stable for a while, so the next crash starts the backoff over
+                self._crashes = 0
+
+            depth = self.backlog.qsize()
+            if depth > self.scale_up_depth and active < self.max_workers:
+                self._spawn()
+            elif depth == 0 and not self.pending and active > self.min_workers:
+                await self._retire()
+
+    async def ready(self, timeout=30):
+        """Waits until every worker has its event loop running"""
+        deadline = monotonic() + timeout
+        while not all(w.ready for w in self.active):
+            if monotonic() > deadline:
+                raise TimeoutError('Workers of {} did not start within {}s'.format(self.name, timeout))
+            await asyncio.sleep(0.05)
+
+    async def request(self, act, args, kwargs, stream=None, priority=codec.NORMAL, deadline=None):
+        """Runs a command, returning its response
+
+        Chunks from async generator commands go to stream.chunks as they arrive if a Stream is given,
+        with the caller granting more through credit(); otherwise they are returned together as a list.
+        Requests still queued at deadline (a monotonic() time) fail with TimeoutError instead of running.
+        """
+        cache = self.cacheable.get(act)
+        key = None
+        if cache is not None:
+            key = result_key(act, args, kwargs, cache)
+            hit = self.results.get(key)
+            if hit is not MISSING:
+                return self._replay(hit, stream)
+        rid = next(self._ids)
+        fut = asyncio.get_event_loop().create_future()
+        self.pending[rid] = (fut, monotonic())
+        if stream is None or key is not None:
+            self.collected[rid] = []
+        if stream is not None:
+            stream.rid = rid
+            self.streams[rid] = stream
+        try:
+            await self.backlog.put((priority, rid, deadline, [rid, act, args, kwargs]))
+            response = await fut
+            chunks = self.collected.pop(rid, [])
+            if key is not None:
+                self.results.set(key, (chunks, response), cache['ttl'])
+            if stream is None and chunks:
+                return list(chunks)
+            return response
+        finally:
+            self.pending.pop(rid, None)
+            self.collected.pop(rid, None)
+            # cancelling us cancels fut too, so only a result actually set means the stream ended
+            ended = fut.done() and not fut.cancelled()
+            if self.streams.pop(rid, None) is not None and not ended and stream.worker is not None:
+                # given up on, so stop the generator rather than leave it waiting for credit
+                stream.worker.control.put(['cancel', rid])
+
+    def _replay(self, hit, stream):
+        """Answers a request from a cached result just as the worker would have"""
+        chunks, response = hit
+        if stream is None:
+            return list(chunks) if chunks else response
+        for chunk in chunks:
+            stream.chunks.put_nowait(chunk)
+        return response
+
+    def invalidate_results(self, server_id=None):
+        """Forgets cached results for a server, or all of them"""
+        if server_id is None:
+            self.results.invalidate()
+        else:
+            self.results.invalidate_if(lambda key: key[0] == server_id)
+
+    def health(self):
+        return {
+            'generation': self.generation,
+            'workers': len(self.workers),
+            'alive': sum(w.proc.is_alive() for w in self.workers.values()),
+            'heartbeat_age': max([w.heartbeat_age for w in self.workers.values()] or [None]),
+            'restarts': self.restarts,
+            'in_flight': len(self.pending),
+            'queued': self.backlog.qsize(),
+            'expired': self.expired,
+            'last_latency': self.last_latency,
+            'cached_results': len(self.results),
+            'cache_hits': self.results.hits,
+            'cache_misses': self.results.misses,
+            # blocks recovered from dead workers, and releases that gave up waiting on the ring's lock
+            'shm_reclaimed': self.ring.reclaimed if self.ring is not None else None,
+            'shm_lock_timeouts': self.ring.lock_timeouts if self.ring is not None else None
+        }
+
+    async def stop(self):
+        # everything already queued still gets run before the workers see their sentinels, so the
+        # supervisor has to keep restarting workers that die until then, and killing wedged ones after
+        await self.backlog.put((len(codec.PRIORITY_NAMES), next(self._ids), None, None))
+        await self._feeder
+        workers = list(self.workers.values())
+        for worker in workers:
+            await worker.proc.coro_join()
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        self._reap()
+        for worker in workers:
+            await worker.dispatcher
+        if self.ring is not None:
+            self.ring.close()
+
+
+class Manager:
+    def __init__(self, config='module_server_config.json'):
+        self.config = self._load_config(config)
         self.db = sql.db_init(self.config['database_url'])
+        self.dbx = sql.DBExecutor(self.db, self.config.get('db_workers', 4))
         self._init_module_server()
-        self.modules = self.get_modules() 
+        modules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules')
+        self.discovery = Discovery(modules_dir, 'modules',
+                                   self.config.get('discovery_cache', os.path.join(modules_dir, '.discovery_cache.json')))
+        self.modules = self.get_modules()
         self.processes = {}
+        # websocket path -> pool and command -> pool, rebuilt whenever self.processes changes
+        self.routes = {}
+        self.commands = {}
+        # old generations still finishing their requests after a reload
+        self.draining = set()
+        self.metrics = metrics.Metrics()
 
     def _load_config(self, cfg):
         with open(cfg, 'r') as f:
@@ -26,44 +428,117 @@ class Manager:
 
     def _init_module_server(self):
         addr,port = self.config['uri']
-        sql.ModuleServer.get_or_create(
-                url=':'.join(self.config['uri'])+'/main'
-        )
+        # closed again, so worker processes forked later don't inherit an open connection
+        with self.db.connection_context():
+            sql.ModuleServer.get_or_create(
+                    url=':'.join(self.config['uri'])+'/main'
+            )
+
+    def _module_row(self, info):
+        # ensure a row exists, the module's own constructor fills in its commands when started. Its
+        # options are declared now, so servers can set them before it ever runs
+        uri = ':'.join(self.config['uri'])
+        with self.db.connection_context():
+            with self.db.atomic():
+                module = sql.Module.get_or_create(name=info.name, defaults={'url': uri + '/' + info.name.lower()})[0]
+                sql.declare_options(module, info.options)
+        return module
 
     def get_modules(self):
-        _modules = dict([(k,v) for k,v in globals().items() if isinstance(v, ModuleType)])
-        modules = {}
-        for name, module in _modules.items():
-            for attr in module.__dict__.values():
-                try:
-                    if issubclass(attr, BaseModule) and attr != BaseModule:
-                        # ensure initialised in case db entry does not exist
-                        m = attr()
-                        modules.update({name: [attr, sql.Module.get(sql.Module.name == attr.__name__)]})
-                except TypeError:
-                    continue
-        return modules
+        """Finds modules from their source alone, only importing them once they are started"""
+        return dict((name, [info, self._module_row(info)]) for name, info in self.discovery.discover().items())
+
+    async def _start_pool(self, module_name, reload=False, generation=0):
+        info = self.modules[module_name][0]
+        module_class = self.discovery.load(info, reload)
+        # the class has the final say, e.g. on commands made dynamically
+        self.modules[module_name][0] = info._replace(commands=module_class.manifest())
+        # each worker gets its own queues from the pool
+        module_instance = await self.dbx.run(module_class, None, None, self.config)
+        # the constructor registers the module, so its row is the freshest
+        self.modules[module_name][1] = module_instance.module
+        pool = ModulePool(module_instance, metrics=self.metrics, generation=generation, **self._pool_config(info.name))
+        pool.start()
+        return pool
 
     async def start(self, module_name):
         if not self.modules[module_name][1].enabled:
             return False
         elif module_name in self.processes.keys():
             return True
-        module_class = self.modules[module_name][0]
-        input_queue = AioJoinableQueue()
-        output_queue = AioQueue()
-        module_instance = module_class(input_queue, output_queue)
-        proc = AioProcess(target=module_instance.run)
-        proc.start()
-        self.processes.update({module_name: [
-            proc,
-            input_queue,
-            output_queue,
-            re.compile(r'^{}$'.format(module_instance.route))
-            ]
-        })
+        self.processes.update({module_name: await self._start_pool(module_name)})
+        self._rebuild_routes()
+        return True
+
+    def _rebuild_routes(self):
+        # built aside and swapped in whole, so a lookup never sees them half done
+        self.routes = dict((pool.route, pool) for pool in self.processes.values())
+        self.commands = dict((cmd, pool) for pool in self.processes.values() for cmd in pool.commands)
+
+    def resolve(self, route, act):
+        """The pool serving route if it has the command act, or whichever has it for requests to /main"""
+        pool = self.routes.get(route)
+        if pool is None and route == '/main':
+            pool = self.commands.get(act)
+        if pool is None:
+            # the client's balancer moves on to another replica when it gets this
+            raise NotRunning('No module is running at {}'.format(route))
+        if act not in pool.commands:
+            raise LookupError('{} has no command {}'.format(pool.name, act))
+        return pool
+
+    async def reload(self, module_name):
+        """Swaps in a new generation of a module's workers running its current source, without downtime
+
+        The old generation keeps serving until the new one is up, then drains what it already has in the
+        background while new requests go to the new one.
+        """
+        found = self.discovery.discover()
+        if module_name not in found:
+            raise KeyError('{} no longer defines a module'.format(module_name))
+        self.modules[module_name][0] = found[module_name]
+        old = self.processes.get(module_name)
+        pool = await self._start_pool(module_name, reload=True, generation=old.generation + 1 if old else 0)
+        try:
+            await pool.ready(self.config.get('reload_timeout', 30))
+        except Exception:
+            await pool.stop()
+            raise
+        self.processes[module_name] = pool
+        self._rebuild_routes()
+        if old is not None:
+            task = asyncio.ensure_future(old.stop())
+            self.draining.add(task)
+            task.add_done_callback(self.draining.discard)
         return True
 
+    async def _watch(self, interval):
+        """Hot reloads running modules when their source changes, and picks up new ones"""
+        hashes = self.discovery.hashes()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for name, info in self.discovery.discover().items():
+                    if name not in self.modules:
+                        self.modules[name] = [info, await self.dbx.run(self._module_row, info)]
+                current = self.discovery.hashes()
+            except Exception as e:
+                # nothing awaits this task, so anything let out would quietly end hot reloading
+                print('Could not scan modules: {}: {}'.format(type(e).__name__, e))
+                continue
+            changed = [name for name, h in current.items() if h != hashes.get(name) and name in self.processes]
+            hashes = current
+            for name in changed:
+                try:
+                    await self.reload(name)
+                    print('Reloaded {}'.format(name))
+                except Exception as e:
+                    print('Could not reload {}: {}: {}'.format(name, type(e).__name__, e))
+
+    def _pool_config(self, class_name):
+        settings = module_settings(self.config, class_name)
+        return dict((k, v) for k, v in settings.items() if k in POOL_SETTINGS)
+
     async def wake(self):
         mod_res = []
         for k in self.modules.keys():
@@ -74,29 +549,35 @@ class Manager:
         return mod_res
     
     async def stop(self, module_name):
-        p = self.processes[module_name][0]
-        inp = self.processes[module_name][1]
-        await inp.coro_put(None)
-        await inp.coro_join()
-        await p.coro_join()
-        self.processes.pop(module_name)
+        pool = self.processes.pop(module_name)
+        # nothing new gets routed to it while it drains, and clients stop looking for it here
+        self._rebuild_routes()
+        await self.dbx.run(self._drop_replica, self.modules[module_name][0])
+        await pool.stop()
         return True
+
+    def _drop_replica(self, info):
+        uri = ':'.join(self.config['uri'])
+        with self.db.connection_context():
+            (sql.ModuleReplica.delete()
+                .where((sql.ModuleReplica.name == info.name) & (sql.ModuleReplica.url == uri + '/' + info.name.lower()))
+                .execute())
     
     async def stop_all(self):
         mod_res = []
         ps = list(self.processes.keys())
         for k in ps:
             mod_res.append(await self.stop(k))
+        if self.draining:
+            await asyncio.wait(self.draining)
         return mod_res
 
     async def refresh(self, module_name):
-        if module_name in self.processes.keys():
-            await self.stop(module_name)
-        if self.modules[module_name][1].enabled:
-            await self.start(module_name)
-            return True
-        else:
+        if not self.modules[module_name][1].enabled:
+            if module_name in self.processes.keys():
+                await self.stop(module_name)
             return False
+        return await self.reload(module_name)
     
     async def refresh_all(self):
         mod_res = []
@@ -107,45 +588,136 @@ class Manager:
     async def enable(self, module_name):
         m = self.modules[module_name][1]
         m.enabled = True
-        m.save()
+        await self.dbx.run(m.save)
         return True
 
     async def disable(self, module_name):
         m = self.modules[module_name][1]
         m.enabled = False
-        m.save()
+        await self.dbx.run(m.save)
         return True
 
+    async def manifest(self):
+        """Commands each module serves, so clients can route without the database"""
+        uri = ':'.join(self.config['uri'])
+        return dict((info.name, {
+            # our own replica, the Module row holds whichever host registered last
+            'url': uri + '/' + info.name.lower(),
+            'running': name in self.processes,
+            'commands': info.commands
+        }) for name, (info, row) in self.modules.items())
+
+    async def invalidate_options(self, class_name, server_id=None):
+        """Tells every worker of a module that a server's options changed"""
+        for name, (info, row) in self.modules.items():
+            if info.name == class_name and name in self.processes:
+                # results may depend on the options too
+                self.processes[name].invalidate_results(server_id)
+                self.processes[name].broadcast(['invalidate_options', server_id])
+                return True
+        return False
+
+    async def health(self):
+        """Liveness, restarts and latency of every running module"""
+        return dict((self.modules[name][0].name, pool.health()) for name, pool in self.processes.items())
+
+    async def metrics_snapshot(self):
+        """Request counters and wait, service and execution time histograms, in microseconds"""
+        return self.metrics.snapshot()
+
     async def sleep(self):
         await self.stop_all()
+        self.dbx.shutdown()
         sys.exit()
 
     async def handler(self, websocket, route):
-        payload = await websocket.recv()
-        j = json.loads(payload)
-        act = j['action']
-        args = j.get('args', [])
-        kwargs = j.get('kwargs', {})
-        if act in MANAGER_ACTIONS:
-            action = getattr(self, act)
-            try:
-                r = await action()
-            except TypeError:
+        """Serves requests from one connection until it closes, answering each as it completes"""
+        wire = codec.negotiated(websocket.subprotocol)
+        in_flight = set()
+        # client request id -> (pool, Stream) for this connection's streaming requests
+        streams = {}
+        try:
+            async for payload in websocket:
+                task = asyncio.ensure_future(self.dispatch(websocket, wire, route, payload, streams))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except websockets.ConnectionClosed:
+            pass
+        for task in in_flight:
+            task.cancel()
+
+    async def dispatch(self, websocket, wire, route, payload, streams=None):
+        j = wire.decode(payload)
+        rid = j.get('id')
+        if 'credit' in j or 'cancel' in j:
+            pool, stream = (streams or {}).get(rid, (None, None))
+            if pool is None:
+                return
+            if 'cancel' in j:
+                stream.request.cancel()
+            else:
+                pool.credit(stream, j['credit'])
+            return
+        self.metrics.incr('manager.requests')
+        try:
+            if j.get('v', 1) > codec.VERSION:
+                raise ValueError('Unsupported envelope version {}'.format(j['v']))
+            act = j['action']
+            args = j.get('args', [])
+            kwargs = j.get('kwargs', {})
+            if act in MANAGER_ACTIONS:
+                action = getattr(self, act)
                 r = await action(*args)
-            await websocket.send(json.dumps(r))
-        for proc, inq, outq, regex_pattern in self.processes.values():
-            if regex_pattern.match(route):
-                await inq.coro_put([act, args, kwargs])
-                response = await outq.coro_get()
-                await websocket.send(json.dumps(response))
+                await websocket.send(wire.encode(codec.reply(rid, r)))
+                return
+            pool = self.resolve(route, act)
+            schedule = {
+                'priority': min(max(int(j.get('priority', codec.NORMAL)), codec.HIGH), codec.LOW),
+                'deadline': monotonic() + j['deadline'] if j.get('deadline') is not None else None
+            }
+            if j.get('stream') and streams is not None:
+                response = await self._stream(websocket, wire, rid, pool, act, args, kwargs, streams, **schedule)
+            else:
+                response = await pool.request(act, args, kwargs, **schedule)
+            await websocket.send(wire.encode(codec.reply(rid, response)))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            self.metrics.incr('manager.errors')
+            await websocket.send(wire.encode(codec.reply(rid, error='{}: {}'.format(type(e).__name__, e))))
     
+    async def _stream(self, websocket, wire, rid, pool, act, args, kwargs, streams, **schedule):
+        """Runs a command, forwarding each chunk it yields to the client as soon as it arrives"""
+        stream = Stream()
+        streams[rid] = (pool, stream)
+        request = stream.request = asyncio.ensure_future(pool.request(act, args, kwargs, stream, **schedule))
+        try:
+            while True:
+                get = asyncio.ensure_future(stream.chunks.get())
+                await asyncio.wait([get, request], return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                await websocket.send(wire.encode(codec.chunk(rid, get.result())))
+            # chunks always arrive before the result, but may still be waiting here
+            while not stream.chunks.empty():
+                await websocket.send(wire.encode(codec.chunk(rid, stream.chunks.get_nowait())))
+            return request.result()
+        finally:
+            request.cancel()
+            streams.pop(rid, None)
+
     def run(self):
         loop = asyncio.get_event_loop()
         addr,port = self.config['uri']
-        loop.run_until_complete(websockets.serve(self.handler, addr, port))
+        protocols = codec.subprotocols(self.config.get('codecs', ['msgpack', 'json']))
+        loop.run_until_complete(websockets.serve(self.handler, addr, port, subprotocols=protocols))
+        if self.config.get('watch_interval'):
+            loop.create_task(self._watch(self.config['watch_interval']))
         loop.run_forever()
         loop.close()
 
 if __name__ == '__main__':
-    main = Manager()
+    # e.g. python module_manager.py other_node.json, to run several managers side by side
+    main = Manager(*sys.argv[1:2])
     main.run()
@@ -0,0 +1,112 @@
+from time import monotonic
+
+class RequestLost(ConnectionError):
+    """The connection to a replica dropped after the request went out, so it may have run and mustn't be retried"""
+
+class NotRunning(LookupError, ConnectionError):
+    """The module server is up but no longer runs the module, so the request never ran and may go to another replica"""
+
+def remote_error(error):
+    """The exception for an error reply, NotRunning for the manager's own or a RuntimeError for anything else"""
+    if error.startswith(NotRunning.__name__ + ':'):
+        return NotRunning(error)
+    return RuntimeError(error)
+
+class Replica:
+    """One module server running a given module, and how it has been behaving"""
+    __slots__ = ['url', 'in_flight', 'failures', 'down_until', 'last_latency']
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_latency = 0.0
+
+    @property
+    def healthy(self):
+        return self.down_until <= monotonic()
+
+
+class Balancer:
+    """Spreads requests for a module over its replicas by least outstanding requests, failing over on connection errors"""
+
+    def __init__(self, max_failures=3, cooldown=5.0):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.replicas = {}
+
+    def add(self, module, url):
+        replicas = self.replicas.setdefault(module, {})
+        if url not in replicas:
+            replicas[url] = Replica(url)
+
+    def remove(self, module, url):
+        """Forgets a replica, returning how many the module has left"""
+        replicas = self.replicas.get(module, {})
+        replicas.pop(url, None)
+        if not replicas:
+            self.replicas.pop(module, None)
+        return len(replicas)
+
+    def pick(self, module, exclude=()):
+        candidates = [r for r in self.replicas.get(module, {}).values() if r.url not in exclude]
+        if not candidates:
+            return None
+        # if everything is marked down, trying one beats failing outright
+        healthy = [r for r in candidates if r.healthy] or candidates
+        return min(healthy, key=lambda r: r.in_flight)
+
+    def _failed(self, replica):
+        replica.failures += 1
+        if replica.failures >= self.max_failures:
+            replica.down_until = monotonic() + self.cooldown
+
+    async def call(self, module, request):
+        """Awaits request(url) against the best replica, moving on to the next if it can't be reached
+
+        Only a ConnectionError before the request was sent (or a NotRunning from a replica that stopped the
+        module) moves on; a RequestLost is raised to the caller.
+        """
+        tried = set()
+        error = ConnectionError('No replicas of {} are known'.format(module))
+        while True:
+            replica = self.pick(module, tried)
+            if replica is None:
+                raise error
+            tried.add(replica.url)
+            replica.in_flight += 1
+            start = monotonic()
+            try:
+                result = await request(replica.url)
+            except RequestLost:
+                self._failed(replica)
+                raise
+            except ConnectionError as e:
+                self._failed(replica)
+                error = e
+                continue
+            finally:
+                replica.in_flight -= 1
+            replica.failures = 0
+            replica.down_until = 0.0
+            replica.last_latency = monotonic() - start
+            return result
+
+    def gauges(self):
+        """status() flattened into module.url.field -> number, for Metrics.gauge"""
+        gauges = {}
+        for module, replicas in self.status().items():
+            for r in replicas:
+                for field in ('in_flight', 'healthy', 'failures', 'last_latency'):
+                    gauges['{}.{}.{}'.format(module, r['url'], field)] = int(r[field]) if field == 'healthy' else r[field]
+        return gauges
+
+    def status(self):
+        return dict((module, [{
+            'url': r.url,
+            'in_flight': r.in_flight,
+            'healthy': r.healthy,
+            'failures': r.failures,
+            'last_latency': r.last_latency
+        } for r in replicas.values()]) for module, replicas in self.replicas.items())
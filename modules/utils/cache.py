@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from time import monotonic
+
+# returned by LRUCache.get on a miss, since None is a perfectly cacheable value
+MISSING = object()
+
+class LRUCache:
+    """Bounded least-recently-used cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (value, monotonic() + (self.ttl if ttl is None else ttl))
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key=MISSING):
+        """Drops a single key, or everything if no key is given"""
+        if key is MISSING:
+            self.data.clear()
+        else:
+            self.data.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """Drops every key predicate(key) is true for"""
+        for key in [k for k in self.data if predicate(k)]:
+            del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,80 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# bumped whenever the envelope gains or changes fields
+VERSION = 1
+
+# request priorities, most urgent first, and what their stats are reported as
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = ('high', 'normal', 'low')
+
+class JSONCodec:
+    """The original text wire format, always available"""
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    """Compact binary wire format, used when both ends have msgpack installed"""
+    name = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {'json': JSONCodec()}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+DEFAULT = CODECS['json']
+
+def subprotocols(preferred=('msgpack', 'json')):
+    """Websocket subprotocols to offer, most preferred first, skipping codecs we can't use"""
+    return ['pajama.{}'.format(name) for name in preferred if name in CODECS]
+
+def negotiated(subprotocol):
+    """The codec agreed on during the handshake, JSON for peers that didn't negotiate"""
+    if subprotocol and subprotocol.startswith('pajama.'):
+        return CODECS.get(subprotocol[len('pajama.'):], DEFAULT)
+    return DEFAULT
+
+def request(rid, action, args=(), kwargs={}, stream=False, priority=None, deadline=None):
+    r = {'v': VERSION, 'id': rid, 'action': action, 'args': list(args), 'kwargs': kwargs}
+    if stream:
+        # chunks are sent as they come rather than gathered into the reply
+        r['stream'] = True
+    if priority is not None:
+        r['priority'] = priority
+    if deadline is not None:
+        # seconds from now rather than a time, since the two ends' clocks needn't agree
+        r['deadline'] = deadline
+    return r
+
+def chunk(rid, data):
+    """One part of a streamed response, ahead of the reply that ends it"""
+    return {'v': VERSION, 'id': rid, 'chunk': data}
+
+def credit(rid, n=1):
+    """Sent back for a streamed request once n chunks have been dealt with, so more may follow"""
+    return {'v': VERSION, 'id': rid, 'credit': n}
+
+def cancel(rid):
+    """Sent for a streamed request the client has stopped reading"""
+    return {'v': VERSION, 'id': rid, 'cancel': True}
+
+def reply(rid, response=None, error=None):
+    if error is not None:
+        return {'v': VERSION, 'id': rid, 'error': error}
+    return {'v': VERSION, 'id': rid, 'response': response}
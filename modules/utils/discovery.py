@@ -0,0 +1,177 @@
+import ast
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+from collections import namedtuple
+
+from .moduletools import cacheable
+
+# what the manager needs to know about a module before (or without) importing it
+ModuleInfo = namedtuple('ModuleInfo', ['module', 'name', 'commands', 'options'])
+
+# bumped whenever what gets cached changes shape
+CACHE_VERSION = 2
+
+def _call_name(node):
+    """'requires' for both @requires(...) and @moduletools.requires(...)"""
+    if isinstance(node, ast.Call):
+        node = node.func
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+def _literal_args(call):
+    try:
+        return [ast.literal_eval(arg) for arg in call.args]
+    except ValueError:
+        return []
+
+def _cache_spec(call):
+    """What @cacheable(...) would set, or None if its arguments aren't literals"""
+    try:
+        args = [ast.literal_eval(arg) for arg in call.args]
+        kwargs = dict((k.arg, ast.literal_eval(k.value)) for k in call.keywords)
+    except ValueError:
+        return None
+    return cacheable(*args, **kwargs)(lambda: None).cache
+
+def _command(func):
+    names = [_call_name(d) for d in func.decorator_list]
+    if 'command' not in names:
+        return None
+    spec = {'help': ast.get_docstring(func, clean=False), 'requires': [], 'permissions': [], 'cache': None}
+    for d in func.decorator_list:
+        if isinstance(d, ast.Call) and _call_name(d) == 'requires':
+            spec['requires'] = _literal_args(d)
+        elif isinstance(d, ast.Call) and _call_name(d) == 'checks':
+            spec['permissions'] = _literal_args(d)
+        elif isinstance(d, ast.Call) and _call_name(d) == 'cacheable':
+            spec['cache'] = _cache_spec(d)
+    return spec
+
+def _options(cls):
+    for stmt in cls.body:
+        if isinstance(stmt, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'options' for t in stmt.targets):
+            try:
+                return ast.literal_eval(stmt.value)
+            except ValueError:
+                return {}
+    return {}
+
+def parse(source, module):
+    """Every BaseModule subclass defined in source, read from its syntax tree without running anything"""
+    found = []
+    bases = {'BaseModule'}
+    for node in ast.parse(source).body:
+        if not isinstance(node, ast.ClassDef) or not any(_call_name(b) in bases for b in node.bases):
+            continue
+        # a subclass of a module defined above it in the same file is a module too
+        bases.add(node.name)
+        commands = {}
+        for stmt in node.body:
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                spec = _command(stmt)
+                if spec is not None:
+                    commands[stmt.name] = spec
+        found.append(ModuleInfo(module, node.name, commands, _options(node)))
+    return found
+
+class Discovery:
+    """Finds the modules in a package from their source, caching what it found per file on disk
+
+    Entries are reused while a file's mtime and size are unchanged, or when they changed but its
+    contents hash the same. Nothing is imported until load() is called for a module being started.
+    """
+
+    def __init__(self, path, package, cache_path=None):
+        self.path = path
+        self.package = package
+        self.cache_path = cache_path
+        self.cache = self._read_cache()
+        # python module name -> hash of the source it was last imported from
+        self.loaded = {}
+
+    def _read_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            return {}
+        return cache.get('files', {}) if cache.get('version') == CACHE_VERSION else {}
+
+    def _write_cache(self):
+        if self.cache_path is None:
+            return
+        tmp = self.cache_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'files': self.cache}, f)
+        os.replace(tmp, self.cache_path)
+
+    def _scan_file(self, filename):
+        """Returns (infos, whether the cache entry had to change)"""
+        path = os.path.join(self.path, filename)
+        st = os.stat(path)
+        entry = self.cache.get(filename)
+        if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            return [ModuleInfo(*i) for i in entry['modules']], False
+        with open(path, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if entry is not None and entry['hash'] == digest:
+            infos = [ModuleInfo(*i) for i in entry['modules']]
+        else:
+            try:
+                infos = parse(source, filename[:-3])
+            except SyntaxError as e:
+                # most likely saved mid-edit, so keep what it was until it parses again
+                print('Could not parse {}: {}'.format(filename, e))
+                return [ModuleInfo(*i) for i in entry['modules']] if entry is not None else [], False
+        self.cache[filename] = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'hash': digest, 'modules': infos}
+        return infos, True
+
+    def discover(self):
+        """python module name -> ModuleInfo for every module in the package"""
+        modules = {}
+        dirty = False
+        files = sorted(f for f in os.listdir(self.path) if f.endswith('.py') and f != '__init__.py')
+        for filename in files:
+            infos, changed = self._scan_file(filename)
+            dirty = dirty or changed
+            for info in infos:
+                modules[info.module] = info
+        for filename in set(self.cache) - set(files):
+            del self.cache[filename]
+            dirty = True
+        if dirty:
+            self._write_cache()
+        return modules
+
+    def hashes(self):
+        """python module name -> hash of its source, as of the last discover()"""
+        return dict((filename[:-3], entry['hash']) for filename, entry in self.cache.items())
+
+    def load(self, info, reload=False):
+        """Imports the module's file and returns its class
+
+        The file is re-executed if reload is set, or if it changed since it was last imported here, e.g.
+        while the module was stopped.
+        """
+        name = '{}.{}'.format(self.package, info.module)
+        filename = info.module + '.py'
+        if self._scan_file(filename)[1]:
+            self._write_cache()
+        digest = self.cache[filename]['hash'] if filename in self.cache else None
+        module = sys.modules.get(name)
+        if module is None:
+            module = importlib.import_module(name)
+        elif reload or self.loaded.get(name) != digest:
+            module = importlib.reload(module)
+        self.loaded[name] = digest
+        return getattr(module, info.name)
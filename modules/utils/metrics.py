@@ -0,0 +1,135 @@
+import asyncio
+
+# log-linear buckets, HDR-style: 2**SUB_BITS per power of two, so ~6% precision at any magnitude
+SUB_BITS = 4
+SUB = 1 << SUB_BITS
+# values are recorded in microseconds, anything past ~19 hours lands in the last bucket
+MAX_VALUE = (1 << 36) - 1
+_MAX_SHIFT = MAX_VALUE.bit_length() - (SUB_BITS + 1)
+BUCKETS = (_MAX_SHIFT + 2) * SUB
+
+def _lower(idx):
+    """Smallest value that falls in bucket idx"""
+    if idx < 2 * SUB:
+        return idx
+    shift = idx // SUB - 1
+    return (idx - shift * SUB) << shift
+
+class Histogram:
+    """Latency histogram with fixed log-linear buckets, cheap enough to record on every message
+
+    Recording only bumps a bucket and a running total; counts, extremes and percentiles are worked out
+    from the buckets when a summary is asked for.
+    """
+    __slots__ = ['counts', 'total']
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0
+
+    def record(self, seconds):
+        v = int(seconds * 1000000)
+        self.total += v
+        if v < 2 * SUB:
+            self.counts[v] += 1
+        elif v <= MAX_VALUE:
+            shift = v.bit_length() - SUB_BITS - 1
+            self.counts[shift * SUB + (v >> shift)] += 1
+        else:
+            self.counts[-1] += 1
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p, count=None):
+        """Lower bound of the bucket holding the p-th percentile, in microseconds"""
+        count = self.count if count is None else count
+        rank = p / 100 * count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return _lower(idx)
+        return 0
+
+    def summary(self):
+        """Microsecond figures for reporting"""
+        count = self.count
+        if not count:
+            return {'count': 0}
+        used = [idx for idx, n in enumerate(self.counts) if n]
+        return {
+            'count': count,
+            'mean': self.total / count,
+            'min': _lower(used[0]),
+            'max': _lower(used[-1] + 1) - 1,
+            'p50': self.percentile(50, count),
+            'p90': self.percentile(90, count),
+            'p99': self.percentile(99, count),
+            'p999': self.percentile(99.9, count)
+        }
+
+
+class Metrics:
+    """Named counters and histograms, created on first use, plus gauges read from their owners on demand"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # prefix -> function returning {name: value}, called whenever a snapshot is taken
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        try:
+            self.counters[name] += n
+        except KeyError:
+            self.counters[name] = n
+
+    def observe(self, name, seconds):
+        try:
+            self.histograms[name].record(seconds)
+        except KeyError:
+            h = self.histograms[name] = Histogram()
+            h.record(seconds)
+
+    def gauge(self, prefix, collect):
+        """Reports each name -> value collect() returns as prefix.name, costing nothing between snapshots"""
+        self.gauges[prefix] = collect
+
+    def snapshot(self):
+        gauges = {}
+        for prefix, collect in self.gauges.items():
+            for name, value in collect().items():
+                gauges['{}.{}'.format(prefix, name)] = value
+        return {
+            'counters': dict(self.counters),
+            'gauges': gauges,
+            'histograms': dict((name, h.summary()) for name, h in self.histograms.items())
+        }
+
+    def render(self, snapshot=None):
+        """Plain text, one metric per line"""
+        snapshot = snapshot or self.snapshot()
+        lines = ['{} {}'.format(name, value) for name, value in sorted(snapshot['counters'].items())]
+        lines.extend('{} {}'.format(name, value) for name, value in sorted(snapshot.get('gauges', {}).items()))
+        for name, summary in sorted(snapshot['histograms'].items()):
+            for stat, value in summary.items():
+                lines.append('{}_{}{} {:g}'.format(name, stat, '' if stat == 'count' else '_us', value))
+        return '\n'.join(lines) + '\n'
+
+
+async def serve(metrics, host='127.0.0.1', port=9100):
+    """Answers every HTTP request on host:port with metrics.render()"""
+    async def handle(reader, writer):
+        try:
+            # only the request line matters, whatever the path
+            while (await reader.readline()).strip():
+                pass
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n')
+            writer.write('Content-Length: {}\r\n\r\n'.format(len(body)).encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
@@ -1,12 +1,19 @@
 import asyncio
 import re
 import json
+import pickle
+import traceback
 import websockets
 
-from inspect import iscoroutinefunction
+from inspect import iscoroutinefunction, isasyncgenfunction
 from collections import UserDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import attrgetter
+from time import monotonic
 
 from . import sql
+from .cache import LRUCache, MISSING
 
 from os.path import dirname
 
@@ -17,12 +24,13 @@ class AttrDict(UserDict):
 
 class Command:
     """Represents a user command"""
-    def __init__(self, name, func, help, requires, permissions):
+    def __init__(self, name, func, help, requires, permissions, cache=None):
         self.name = name
         self.func = func
         self.help = help
         self.requires = requires
         self.permissions = permissions
+        self.cache = cache
 
 def command(cmd):
     """User command decorator"""
@@ -30,7 +38,9 @@ def command(cmd):
         cmd.requires = []
     if not hasattr(cmd, 'permissions'):
         cmd.permissions = []
-    return Command(cmd.__name__, cmd, cmd.__doc__, cmd.requires, cmd.permissions)
+    if not hasattr(cmd, 'cache'):
+        cmd.cache = None
+    return Command(cmd.__name__, cmd, cmd.__doc__, cmd.requires, cmd.permissions, cmd.cache)
     
 def requires(*args):
     """Decorator that signifies a Command needs context from the API"""
@@ -46,116 +56,260 @@ def checks(*args):
         return cmd
     return wrapper
 
+# what a response can point back at, and how the client gets it from the message that triggered the command
+HANDLES = {
+    'message': lambda message: message,
+    'author': attrgetter('author'),
+    'channel': attrgetter('channel'),
+    'server': attrgetter('server')
+}
+
+def ref(handle):
+    """Stands in for the triggering message (or its author, channel or server) in a response"""
+    if handle not in HANDLES:
+        raise ValueError('No such handle: {}'.format(handle))
+    return {'ref': handle}
+
+def cacheable(ttl=60, key=()):
+    """Decorator that lets a Command's result be reused for ttl seconds by clients and the manager
+
+    Results are kept per server and arguments, plus whatever context is named in key, so the command
+    should depend on nothing else and name its channel etc. with ref().
+    """
+    def wrapper(cmd):
+        cmd.cache = {'ttl': ttl, 'key': list(key)}
+        return cmd
+    return wrapper
+
+def result_key(name, args, ctx, cache):
+    """What a cacheable command's result is stored under, given its cache spec"""
+    return (ctx.get('server.id'), name, tuple(args)) + tuple(ctx.get(k) for k in cache['key'])
+
+def module_settings(config, name):
+    """Merges module_defaults with the module's own entry in the server config"""
+    settings = dict(config.get('module_defaults', {}))
+    settings.update(config.get('modules', {}).get(name, {}))
+    return settings
+
 class BaseModule:
     """Base class for new modules to inherit"""
+    # coroutine commands run at once per process, and threads for plain function commands
+    max_concurrency = 16
+    max_threads = 4
+    heartbeat_interval = 1.0
+    # chunks an async generator command may have sent that the client hasn't carried out yet
+    stream_window = 4
+    options = {}
+    # set by the manager's ModulePool when large responses should go through shared memory
+    ring = None
+    shm_threshold = 65536
 
-    def __init__(self, inq=None, outq=None):
+    def __init__(self, inq=None, outq=None, config=None):
         """Initialise database connection, classify data, create and access tables, create worker queues"""
         # kind of ugly here
-        self.config = self._load_config(dirname(dirname(dirname(__file__))) + '/module_server_config.json')
-        self.db = sql.db_init(self.config['database_url'])
+        if config is None:
+            config = self._load_config(dirname(dirname(dirname(__file__))) + '/module_server_config.json')
+        self.config = config
+        self.db = sql.database(self.config['database_url'])
         self.uri = ':'.join(self.config['uri'])
         self.route = '/' + self.__class__.__name__.lower()
+        settings = module_settings(self.config, self.__class__.__name__)
+        self.max_concurrency = settings.get('max_concurrency', self.max_concurrency)
+        self.max_threads = settings.get('max_threads', self.max_threads)
+        self.heartbeat_interval = settings.get('heartbeat_interval', self.heartbeat_interval)
+        self.stream_window = settings.get('stream_window', self.stream_window)
+        # rid -> semaphore of credits for each streaming command, while flow control is on
+        self._credits = None
+        self._cancelled = set()
         self.module = self._init_module()
-        self.commands = self._init_commands()
+        self.commands = self.manifest()
         self.options = AttrDict(self.__class__.options)
-        self._init_options()
         self.in_queue = inq
         self.out_queue = outq
+        # resolved options per server, dropped when the manager tells us they changed
+        self._server_options = LRUCache(**self.config.get('options_cache', {}))
 
     def _load_config(self, cfg):
         with open(cfg, 'r') as f:
             return json.load(f)
 
+    @classmethod
+    def manifest(cls):
+        """Describes the module's commands without touching the database"""
+        return dict((v.name, {'help': v.help, 'requires': list(v.requires), 'permissions': list(v.permissions),
+                              'cache': v.cache})
+                    for v in cls.__dict__.values() if isinstance(v, Command))
+
     def _init_module(self):
+        """Registers the module's commands and options, writing only what changed since last time"""
         name = self.__class__.__name__
-        # refresh tables on startup
         with self.db.connection_context():
-            sql.Module.delete().where(sql.Module.name == name).execute()
-
-            module = sql.Module.create(
-                    name=name,
-                    url=self.uri+self.route
-            )
+            with self.db.atomic():
+                module = sql.register_module(name, self.uri+self.route, self.manifest(), dict(self.__class__.options))
+                sql.ModuleReplica.get_or_create(name=name, url=self.uri+self.route)
         return module
 
-    def _init_commands(self):
-        """Load Commands into tables"""
-        command_fields = [sql.Command.name, sql.Command.help, sql.Command.module]
-        context_fields = [sql.RequiredContext.attr, sql.RequiredContext.command]
-        perms_fields = [sql.RequiredPermission.perm, sql.RequiredPermission.command]
-        
-        commands = []
-        _required_contexts = []
-        _required_perms = []
-        for k,v in self.__class__.__dict__.items():
-            if isinstance(v, Command):
-                commands.append((v.name, v.help, self.module))
-                _required_contexts.append((v.requires, v.name))
-                _required_perms.append((v.permissions, v.name))
-        
-        self.db.connect()
+    def _load_server_options(self, server_id):
+        """Our OptionLookup defaults, overridden by whatever the server has set"""
+        rows = (sql.OptionLookup
+                .select(sql.OptionLookup.option, sql.OptionLookup.default, sql.ServerOption.value)
+                .join(sql.ServerOption, sql.JOIN.LEFT_OUTER, on=(
+                    (sql.ServerOption.option == sql.OptionLookup.id) & (sql.ServerOption.server == server_id)))
+                .where(sql.OptionLookup.module == self.module.id)
+                .tuples())
+        opts = dict(self.options)
+        for option, default, value in rows:
+            opts[option] = default if value is None else value
+        return AttrDict(opts)
 
-        sql.Command.insert_many(commands, fields=command_fields).execute()
-        
-        required_context = []
-        for t in _required_contexts:
-            attrs = t[0]
-            cmd = t[1]
-            for attr in attrs:
-                required_context.append((attr, sql.Command.get(sql.Command.name == cmd)))
-        sql.RequiredContext.insert_many(required_context, fields=context_fields).execute()
-
-        required_perms = []
-        for p in _required_perms:
-            perms = p[0]
-            cmd = p[1]
-            for perm in perms:
-                required_perms.append((perm, sql.Command.get(sql.Command.name == cmd)))
-        sql.RequiredPermission.insert_many(required_perms, fields=perms_fields).execute()
-        
-        self.db.close()
-        return commands
-
-    def _init_options(self):
-        """Load options into table"""
-        fields = [sql.OptionLookup.option, sql.OptionLookup.default, sql.OptionLookup.module]
-        ks = list(self.options.keys())
-        vs = list(self.options.values())
-        r = [self.module for i in self.options]
-        opts = list(zip(ks, vs, r))
-        with self.db.connection_context():
-            sql.OptionLookup.insert_many(opts, fields=fields).execute()
+    async def server_options(self, server_id):
+        if server_id is None:
+            return self.options
+        opts = self._server_options.get(server_id)
+        if opts is MISSING:
+            opts = await self.dbx.run(self._load_server_options, server_id)
+            self._server_options.set(server_id, opts)
+        return opts
+
+    async def _listen(self, control):
+        """Handles notifications the manager pushes to this worker"""
+        while True:
+            msg = await control.coro_get()
+            if msg is None:
+                break
+            act,*args = msg
+            if act == 'invalidate_options':
+                server_id, = args
+                if server_id is None:
+                    self._server_options.invalidate()
+                else:
+                    self._server_options.invalidate(server_id)
+            elif act == 'credit':
+                rid, n = args
+                credits = self._credits.get(rid)
+                for i in range(n if credits is not None else 0):
+                    credits.release()
+            elif act == 'cancel':
+                rid, = args
+                credits = self._credits.get(rid)
+                if credits is not None:
+                    self._cancelled.add(rid)
+                    # wake it so it notices
+                    credits.release()
+
+    def _stash(self, response):
+        """Moves a large response into the shared ring, returning its ShmRef
+
+        Small ones (or any the full ring has no room for) go through the queue as the bytes already
+        pickled to size them up, rather than being pickled a second time by the queue.
+        """
+        data = pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.shm_threshold:
+            return data
+        ref = self.ring.write(data)
+        return data if ref is None else ref
+
+    async def _beat(self, heartbeat):
+        while True:
+            heartbeat.value = monotonic()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _stream(self, rid, chunks):
+        """Sends each chunk an async generator command yields as soon as the client has room for it"""
+        credits = None
+        if self._credits is not None:
+            credits = self._credits[rid] = asyncio.Semaphore(self.stream_window)
+        try:
+            async for chunk in chunks:
+                if credits is not None:
+                    await credits.acquire()
+                    if rid in self._cancelled:
+                        break
+                if self.ring is not None:
+                    chunk = self._stash(chunk)
+                await self.out_queue.coro_put(['chunk', rid, chunk, None, 0])
+        finally:
+            await chunks.aclose()
+            if credits is not None:
+                self._credits.pop(rid, None)
+                self._cancelled.discard(rid)
+
+    async def _execute(self, rid, act, args, kwargs):
+        """Runs a single command and sends back its response, or what went wrong"""
+        response = None
+        error = None
+        start = monotonic()
+        try:
+            action = getattr(self, act).func
+            if self.options:
+                kwargs.update({'server_options': await self.server_options(kwargs.get('server.id'))})
+
+            if isasyncgenfunction(action):
+                await self._stream(rid, action(self, *args, **kwargs))
+            elif iscoroutinefunction(action):
+                response = await action(self, *args, **kwargs)
+            else:
+                loop = asyncio.get_event_loop()
+                response = await loop.run_in_executor(self._threads, partial(action, self, *args, **kwargs))
+            if self.ring is not None:
+                response = self._stash(response)
+        except Exception as e:
+            traceback.print_exc()
+            response = None
+            error = '{}: {}'.format(type(e).__name__, e)
+        await self.out_queue.coro_put(['result', rid, response, error, monotonic() - start])
+        self.in_queue.task_done()
 
     async def main(self):
-        """Worker function, processes incoming commands and returns to sender"""
-        next_task = await self.in_queue.coro_get()
-        if next_task is None:
-            self.in_queue.task_done()
-            raise Exception
-        act,args,kwargs = next_task
-        action = getattr(self, act).func
-        if self.options:
-            try:
-                with self.db.connection_context():
-                    server_options = sql.ServerOption.select().where(sql.ServerOption.server == context['server.id'])
-            except:
-                server_options = self.options
-            kwargs.update({'server_options': server_options})
-
-        response = {}
-        if iscoroutinefunction(action):
-            response = await action(self, *args, **kwargs)
-        else:
-            response = action(self, *args, **kwargs)
-        await self.out_queue.coro_put(response)
+        """Worker function, pulls commands continuously and runs up to max_concurrency at once"""
+        slots = asyncio.Semaphore(self.max_concurrency)
+        in_flight = set()
+
+        def finished(task):
+            in_flight.discard(task)
+            slots.release()
+
+        while True:
+            await slots.acquire()
+            next_task = await self.in_queue.coro_get()
+            if next_task is None:
+                break
+            task = asyncio.ensure_future(self._execute(*next_task))
+            in_flight.add(task)
+            task.add_done_callback(finished)
+
+        # drain whatever is still running before acknowledging the sentinel
+        if in_flight:
+            await asyncio.wait(in_flight)
         self.in_queue.task_done()
         
-    def run(self):
+    def run(self, in_queue=None, out_queue=None, control=None, heartbeat=None):
+        if in_queue is not None:
+            # the pool hands every worker queues of its own
+            self.in_queue = in_queue
+            self.out_queue = out_queue
         loop = asyncio.new_event_loop()
-        while True:
-            try:
-                loop.run_until_complete(self.main())
-            except:
-                break
-        loop.close()
+        asyncio.set_event_loop(loop)
+        # threads don't survive the fork into this process, so the pools are made here
+        self.dbx = sql.DBExecutor(self.db, self.config.get('db_workers', 4))
+        self._threads = ThreadPoolExecutor(max_workers=self.max_threads)
+        listener = None
+        beat = None
+        if control is not None:
+            # credits for streaming commands come in over control, so flow control needs it
+            self._credits = {}
+            listener = loop.create_task(self._listen(control))
+        if heartbeat is not None:
+            beat = loop.create_task(self._beat(heartbeat))
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            if beat is not None:
+                beat.cancel()
+            if listener is not None:
+                # wake our own listener so its blocked get doesn't keep us alive
+                control.put(None)
+                loop.run_until_complete(listener)
+            self._threads.shutdown(wait=True)
+            self.dbx.shutdown()
+            loop.close()
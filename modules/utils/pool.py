@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+
+import websockets
+
+from . import codec
+from .balancer import RequestLost, remote_error
+
+class ModuleConnection:
+    """A single long-lived websocket to a module server, shared by many in-flight requests"""
+
+    def __init__(self, url, max_concurrency=64, timeout=30, retries=5, max_backoff=10, codecs=('msgpack', 'json')):
+        self.url = url
+        self.codecs = codecs
+        self.wire = codec.DEFAULT
+        self.timeout = timeout
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.websocket = None
+        # request id -> (websocket it was sent on, future)
+        self.pending = {}
+        # request id -> (websocket it was sent on, queue of ('chunk' | 'end' | 'error', value)) for streaming requests
+        self.streams = {}
+        self._ids = itertools.count()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._connect_lock = asyncio.Lock()
+        self._reader = None
+
+    async def _connect(self):
+        """Returns the open websocket, reconnecting with exponential backoff if needed"""
+        async with self._connect_lock:
+            if self.websocket is not None and self.websocket.open:
+                return self.websocket
+            attempt = 0
+            while True:
+                try:
+                    self.websocket = await websockets.connect(
+                            'ws://{}'.format(self.url), subprotocols=codec.subprotocols(self.codecs))
+                    break
+                except (OSError, websockets.InvalidHandshake):
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise ConnectionError('Could not connect to {}'.format(self.url))
+                    await asyncio.sleep(min(0.1 * 2 ** attempt, self.max_backoff))
+            self.wire = codec.negotiated(self.websocket.subprotocol)
+            self._reader = asyncio.ensure_future(self._read(self.websocket, self.wire))
+            return self.websocket
+
+    async def _read(self, websocket, wire):
+        """Matches responses back to their waiters by request id, in whatever order they arrive"""
+        try:
+            while True:
+                j = wire.decode(await websocket.recv())
+                sent_on, stream = self.streams.get(j.get('id'), (None, None))
+                if stream is not None:
+                    if 'chunk' in j:
+                        stream.put_nowait(('chunk', j['chunk']))
+                    elif 'error' in j:
+                        stream.put_nowait(('error', remote_error(j['error'])))
+                    else:
+                        stream.put_nowait(('end', j.get('response')))
+                    continue
+                sent_on, fut = self.pending.get(j.get('id'), (None, None))
+                if fut is None or fut.done():
+                    continue
+                if 'error' in j:
+                    fut.set_exception(remote_error(j['error']))
+                else:
+                    fut.set_result(j.get('response'))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+            # anything still waiting on this socket will never be answered, unlike what has been sent
+            # since on a new one. It was sent, so it may have run and mustn't be retried elsewhere
+            for sent_on, fut in self.pending.values():
+                if sent_on is websocket and not fut.done():
+                    fut.set_exception(RequestLost('Lost connection to {}'.format(self.url)))
+            for sent_on, stream in self.streams.values():
+                if sent_on is websocket:
+                    stream.put_nowait(('error', RequestLost('Lost connection to {}'.format(self.url))))
+
+    async def request(self, action, args=(), kwargs={}):
+        async with self._semaphore:
+            websocket = await self._connect()
+            rid = next(self._ids)
+            fut = asyncio.get_event_loop().create_future()
+            self.pending[rid] = (websocket, fut)
+            try:
+                try:
+                    await websocket.send(self.wire.encode(codec.request(rid, action, args, kwargs)))
+                except websockets.ConnectionClosed:
+                    # never went out, so another replica may have it
+                    raise ConnectionError('Lost connection to {}'.format(self.url))
+                return await asyncio.wait_for(fut, self.timeout)
+            finally:
+                self.pending.pop(rid, None)
+
+    async def stream(self, action, args=(), kwargs={}, priority=None, deadline=None):
+        """Yields each chunk of a command's response as it arrives, then its final response if it has one
+
+        The module only gets to send another chunk once the caller has finished with the last one and
+        asked for the next, so a slow consumer holds the module back rather than piling chunks up here.
+        The manager runs higher priority requests first, and drops any not started within deadline seconds.
+        """
+        async with self._semaphore:
+            websocket = await self._connect()
+            rid = next(self._ids)
+            chunks = asyncio.Queue()
+            self.streams[rid] = (websocket, chunks)
+            finished = False
+            try:
+                try:
+                    await websocket.send(self.wire.encode(codec.request(rid, action, args, kwargs, stream=True,
+                                                                       priority=priority, deadline=deadline)))
+                except websockets.ConnectionClosed:
+                    raise ConnectionError('Lost connection to {}'.format(self.url))
+                while True:
+                    kind, value = await asyncio.wait_for(chunks.get(), self.timeout)
+                    if kind != 'chunk':
+                        finished = True
+                    if kind == 'error':
+                        raise value
+                    if kind == 'end':
+                        if value is not None:
+                            yield value
+                        return
+                    yield value
+                    try:
+                        await websocket.send(self.wire.encode(codec.credit(rid)))
+                    except websockets.ConnectionClosed:
+                        raise RequestLost('Lost connection to {}'.format(self.url))
+            finally:
+                self.streams.pop(rid, None)
+                if not finished and websocket.open:
+                    # stopped reading early, so the module can stop producing
+                    try:
+                        await websocket.send(self.wire.encode(codec.cancel(rid)))
+                    except websockets.ConnectionClosed:
+                        pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self._reader is not None:
+            await self._reader
+
+
+class ConnectionPool:
+    """Keeps one multiplexed ModuleConnection per module server URL"""
+
+    def __init__(self, **options):
+        self.options = options
+        self.connections = {}
+
+    def get(self, url):
+        conn = self.connections.get(url)
+        if conn is None:
+            conn = ModuleConnection(url, **self.options)
+            self.connections[url] = conn
+        return conn
+
+    async def request(self, url, action, args=(), kwargs={}):
+        return await self.get(url).request(action, args, kwargs)
+
+    def stream(self, url, action, args=(), kwargs={}, priority=None, deadline=None):
+        return self.get(url).stream(action, args, kwargs, priority, deadline)
+
+    async def close(self):
+        for conn in self.connections.values():
+            await conn.close()
+        self.connections = {}
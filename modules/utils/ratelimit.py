@@ -0,0 +1,142 @@
+import math
+
+from collections import OrderedDict
+from time import monotonic
+
+SCOPES = ('user', 'command', 'channel', 'server')
+
+class RateLimiter:
+    """Token buckets per key, refilled at rate tokens a second up to burst
+
+    Buckets are kept in least recently used order, so each check can drop the stalest ones once they have
+    sat idle long enough to have refilled, which forgets nothing and keeps memory bounded by recent traffic.
+    """
+
+    def __init__(self, rate=1.0, burst=5, idle=None):
+        self.rate = rate
+        self.burst = burst
+        self.idle = idle if idle is not None else burst / rate
+        # key -> [tokens, last checked]
+        self.buckets = OrderedDict()
+
+    def refill(self, key, rate=None, burst=None, now=None):
+        """key's [tokens, last checked] bucket, topped up for the time since it was last checked"""
+        rate = self.rate if rate is None else rate
+        burst = self.burst if burst is None else burst
+        now = monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        self.evict(now, limit=2)
+        return bucket
+
+    def allow(self, key, rate=None, burst=None, now=None):
+        """Takes a token for key, returning False if it has none left"""
+        bucket = self.refill(key, rate, burst, now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def evict(self, now=None, limit=None):
+        """Drops buckets idle for longer than self.idle, at most limit of them"""
+        now = monotonic() if now is None else now
+        buckets = self.buckets
+        dropped = 0
+        while buckets and (limit is None or dropped < limit):
+            key, (tokens, last) = next(iter(buckets.items()))
+            if now - last < self.idle:
+                break
+            del buckets[key]
+            dropped += 1
+        return dropped
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class RateLimits:
+    """One RateLimiter per scope, with per-server overrides of their rate and burst
+
+    Scopes are 'user', 'command' (a user's use of one command), 'channel' and 'server', configured as
+    {scope: {'rate': ..., 'burst': ...}, 'idle': ...}. Scopes left out of the config aren't limited.
+    """
+
+    def __init__(self, idle=600, **scopes):
+        self.limiters = dict((scope, RateLimiter(idle=idle, **scopes[scope])) for scope in SCOPES if scope in scopes)
+        # server_id -> {scope: (rate, burst)}
+        self.overrides = {}
+
+    def defaults(self):
+        """The options servers may override, as option name -> default value"""
+        opts = {}
+        for scope, limiter in self.limiters.items():
+            opts['rate_limit.{}.rate'.format(scope)] = limiter.rate
+            opts['rate_limit.{}.burst'.format(scope)] = limiter.burst
+        return opts
+
+    def parse_option(self, option, value):
+        """(scope, field, value) for one of the options from defaults(), or None for any other option
+
+        Raises ValueError for a value that isn't a finite number, at least 1 for a burst or above 0 for a rate.
+        """
+        parts = option.split('.')
+        if len(parts) != 3 or parts[0] != 'rate_limit' or parts[1] not in self.limiters or \
+                parts[2] not in ('rate', 'burst'):
+            return None
+        _, scope, field = parts
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('{} must be a number, not {!r}'.format(option, value))
+        if field == 'burst' and not (math.isfinite(value) and value >= 1):
+            raise ValueError('{} must be at least 1, not {}'.format(option, value))
+        if field == 'rate' and not (math.isfinite(value) and value > 0):
+            raise ValueError('{} must be above 0, not {}'.format(option, value))
+        return scope, field, value
+
+    def set_option(self, server_id, option, value):
+        """Applies one of the options from defaults() for a server, ignoring anything else
+
+        Raises ValueError, leaving the server's limits as they were, if the value is out of range.
+        """
+        parsed = self.parse_option(option, value)
+        if parsed is None:
+            return False
+        scope, field, value = parsed
+        limiter = self.limiters[scope]
+        server = self.overrides.setdefault(server_id, {})
+        rate, burst = server.get(scope, (limiter.rate, limiter.burst))
+        if field == 'rate':
+            rate = value
+        else:
+            burst = value
+        server[scope] = (rate, burst)
+        return True
+
+    def allow(self, user_id, command, channel_id, server_id=None):
+        """Whether a command may go ahead, checked from the narrowest scope out
+
+        A token is only taken from each scope once every scope has one, so a busy server or channel
+        doesn't also use up the allowance of everyone it turns away.
+        """
+        now = monotonic()
+        overrides = self.overrides.get(server_id, {})
+        buckets = []
+        for scope, key in (('user', user_id), ('command', (user_id, command)),
+                           ('channel', channel_id), ('server', server_id)):
+            limiter = self.limiters.get(scope)
+            if limiter is None or key is None:
+                continue
+            rate, burst = overrides.get(scope, (None, None))
+            bucket = limiter.refill(key, rate, burst, now)
+            if bucket[0] < 1:
+                return False
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket[0] -= 1
+        return True
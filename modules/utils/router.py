@@ -0,0 +1,98 @@
+from collections import namedtuple
+from operator import attrgetter
+
+# where a command lives and what it needs, as reported by the module that owns it, with extract
+# turning a message into the context kwargs the command is sent and cache its @cacheable spec, if any
+Route = namedtuple('Route', ['module', 'url', 'required_context', 'permissions', 'extract', 'cache'])
+
+# every command gets these, whatever it @requires
+BASE_CONTEXT = ('server.id', 'message.id', 'channel.id')
+
+_END = None
+
+# context keys -> extractor, shared by every command that needs the same context
+_extractors = {}
+
+def context_extractor(required=()):
+    """A message -> kwargs function for the given dotted paths, compiled once into a single attrgetter"""
+    keys = BASE_CONTEXT + tuple(k for k in required if k not in BASE_CONTEXT)
+    extract = _extractors.get(keys)
+    if extract is None:
+        # keys are paths from the message, except that the message itself goes by 'message'
+        getter = attrgetter(*(k[len('message.'):] if k.startswith('message.') else k for k in keys))
+        extract = _extractors[keys] = lambda message: dict(zip(keys, getter(message)))
+    return extract
+
+def make_route(module, url, required_context=(), permissions=(), cache=None):
+    required_context = tuple(required_context)
+    return Route(module, url, required_context, tuple(permissions), context_extractor(required_context), cache)
+
+class PrefixTrie:
+    """Finds the longest known prefix at the start of a string in O(len(prefix))"""
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for p in prefixes:
+            self.add(p)
+
+    def add(self, prefix):
+        if not prefix:
+            return
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[_END] = prefix
+
+    def match(self, text):
+        node = self.root
+        found = None
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            if _END in node:
+                found = node[_END]
+        return found
+
+
+class Router:
+    """Per-server prefix tries plus an in-memory command table, so routing never reads the database"""
+
+    def __init__(self, global_prefix, private_prefix=' '):
+        self.global_prefix = global_prefix
+        self.tries = {None: PrefixTrie((global_prefix, private_prefix))}
+        self.commands = {}
+        self.modules = {}
+
+    def has_server(self, server_id):
+        return server_id in self.tries
+
+    def set_prefix(self, server_id, prefix):
+        self.tries[server_id] = PrefixTrie((self.global_prefix, prefix))
+
+    def forget_server(self, server_id):
+        self.tries.pop(server_id, None)
+
+    def register(self, module, url, commands):
+        """Replaces everything known about a module with its latest manifest"""
+        for name in self.modules.pop(module, ()):
+            self.commands.pop(name, None)
+        for name, spec in commands.items():
+            self.commands[name] = make_route(module, url, spec['requires'], spec['permissions'], spec.get('cache'))
+        self.modules[module] = set(commands)
+
+    def unregister(self, module):
+        for name in self.modules.pop(module, ()):
+            self.commands.pop(name, None)
+
+    def add(self, name, route):
+        self.commands[name] = route
+        self.modules.setdefault(route.module, set()).add(name)
+
+    def parse(self, server_id, content):
+        """Returns (prefix, command, args) or None if the message isn't addressed to us"""
+        prefix = self.tries[server_id].match(content)
+        if prefix is None:
+            return None
+        cmd, _, rest = content[len(prefix):].partition(' ')
+        return prefix, cmd, rest.split(' ') if rest else []
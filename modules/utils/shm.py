@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import pickle
+import struct
+
+from collections import namedtuple
+from multiprocessing.shared_memory import SharedMemory
+
+# stands in for a response that was written to the ring instead of the queue
+ShmRef = namedtuple('ShmRef', ['offset', 'length'])
+
+_HEADER = struct.Struct('<QQQ')  # head, tail, pid holding the lock
+_HOLDER = struct.Struct('<Q')
+_HOLDER_OFFSET = 16
+_BLOCK = struct.Struct('<II')   # payload length, pid of the process that wrote it or _FREE once released
+_FREE = 0
+
+def _aligned(n):
+    return (n + 7) & ~7
+
+class SharedRing:
+    """Ring buffer in shared memory for handing large payloads from worker processes to the manager
+
+    Made before the workers fork so every process maps the same segment. Blocks may be released in any
+    order; the writer reclaims space from the oldest end once the blocks there have been released.
+    Each block and the lock record the pid holding them, so release_owner() can recover whatever a
+    process that died was holding. Nobody waits more than lock_timeout for the lock.
+    """
+
+    def __init__(self, size, lock_timeout=0.5):
+        self.capacity = _aligned(size)
+        self.shm = SharedMemory(create=True, size=_HEADER.size + self.capacity)
+        self.buf = self.shm.buf
+        self.lock = multiprocessing.Lock()
+        self.lock_timeout = lock_timeout
+        # in whichever process counts them: how often the lock couldn't be had, and blocks recovered
+        self.lock_timeouts = 0
+        self.reclaimed = 0
+        _HEADER.pack_into(self.buf, 0, 0, 0, 0)
+
+    def _acquire(self):
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            self.lock_timeouts += 1
+            return False
+        _HOLDER.pack_into(self.buf, _HOLDER_OFFSET, os.getpid())
+        return True
+
+    def _release_lock(self):
+        _HOLDER.pack_into(self.buf, _HOLDER_OFFSET, 0)
+        self.lock.release()
+
+    def _block(self, pos):
+        return _HEADER.size + pos
+
+    def _reclaim(self, head, tail):
+        while tail < head:
+            length, owner = _BLOCK.unpack_from(self.buf, self._block(tail % self.capacity))
+            if owner != _FREE:
+                break
+            tail += _aligned(_BLOCK.size + length)
+        return tail
+
+    def _alloc(self, length):
+        """Reserves a block for length bytes, returning the payload's offset or None if there's no room
+        (or the lock couldn't be had)"""
+        total = _aligned(_BLOCK.size + length)
+        if total > self.capacity:
+            return None
+        if not self._acquire():
+            return None
+        try:
+            head, tail, holder = _HEADER.unpack_from(self.buf, 0)
+            tail = self._reclaim(head, tail)
+            pos = head % self.capacity
+            padding = self.capacity - pos if pos + total > self.capacity else 0
+            if head + padding + total - tail > self.capacity:
+                _HEADER.pack_into(self.buf, 0, head, tail, holder)
+                return None
+            if padding:
+                # the rest of the segment is too short, so skip it with an already-free block
+                _BLOCK.pack_into(self.buf, self._block(pos), padding - _BLOCK.size, _FREE)
+                head += padding
+                pos = 0
+            _BLOCK.pack_into(self.buf, self._block(pos), length, os.getpid())
+            _HEADER.pack_into(self.buf, 0, head + total, tail, holder)
+        finally:
+            self._release_lock()
+        return pos + _BLOCK.size
+
+    def write(self, data):
+        """Copies data into the ring, returning a ShmRef for the reader or None if it doesn't fit"""
+        offset = self._alloc(len(data))
+        if offset is None:
+            return None
+        start = self._block(offset)
+        self.buf[start:start + len(data)] = data
+        return ShmRef(offset, len(data))
+
+    def read(self, ref):
+        """A zero-copy view of a payload, valid until it is released"""
+        start = self._block(ref.offset)
+        return self.buf[start:start + ref.length]
+
+    def release(self, ref):
+        """Frees a payload's block, returning False if the lock couldn't be had and it is still taken"""
+        if not self._acquire():
+            # left to release_owner once the process stuck holding the lock is reaped
+            return False
+        try:
+            _BLOCK.pack_into(self.buf, self._block(ref.offset - _BLOCK.size), ref.length, _FREE)
+        finally:
+            self._release_lock()
+        return True
+
+    def release_owner(self, pid):
+        """Frees every block a dead process wrote that was never released, and the lock if it died holding it
+
+        Only safe once nothing will load those blocks any more, i.e. after the process's queue has been
+        drained. Returns how many blocks were freed, or None if the lock couldn't be had.
+        """
+        if self.buf is None:
+            return 0
+        holder, = _HOLDER.unpack_from(self.buf, _HOLDER_OFFSET)
+        if holder == pid:
+            _HOLDER.pack_into(self.buf, _HOLDER_OFFSET, 0)
+            self.lock.release()
+        if not self._acquire():
+            return None
+        freed = 0
+        try:
+            head, tail, _ = _HEADER.unpack_from(self.buf, 0)
+            while tail < head:
+                pos = tail % self.capacity
+                length, owner = _BLOCK.unpack_from(self.buf, self._block(pos))
+                if owner == pid:
+                    _BLOCK.pack_into(self.buf, self._block(pos), length, _FREE)
+                    freed += 1
+                tail += _aligned(_BLOCK.size + length)
+        finally:
+            self._release_lock()
+        self.reclaimed += freed
+        return freed
+
+    def load(self, ref):
+        """Unpickles a payload straight out of shared memory and frees its block"""
+        view = self.read(ref)
+        try:
+            return pickle.loads(view)
+        finally:
+            view.release()
+            self.release(ref)
+
+    def close(self):
+        self.buf.release()
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
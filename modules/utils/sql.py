@@ -1,5 +1,17 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from peewee import *
 from playhouse.db_url import connect
+from playhouse.migrate import SchemaMigrator, migrate
 
 db_proxy = Proxy()
 
@@ -15,6 +27,16 @@ class Module(BaseModel):
     name = CharField(unique=True)
     enabled = BooleanField(default=True)
     url = CharField()
+    # of the commands and options last registered, so unchanged modules skip re-registering
+    manifest_hash = CharField(null=True)
+
+class ModuleReplica(BaseModel):
+    # keyed by name rather than a foreign key, so one host re-registering a module doesn't drop the others
+    name = CharField()
+    url = CharField()
+
+    class Meta:
+        indexes = ((('name', 'url'), True),)
 
 class Command(BaseModel):
     name = CharField(unique=True)
@@ -59,6 +81,14 @@ class Message(BaseModel):
     channel = ForeignKeyField(Channel, backref='messages', on_delete='CASCADE')
     author = ForeignKeyField(User, backref='messages', on_delete='CASCADE')
 
+    class Meta:
+        # new messages go to a message_YYYYMM table per month, see message_partition, so this one only
+        # holds what was logged before partitioning
+        indexes = (
+            (('channel', 'timestamp'), False),
+            (('author', 'timestamp'), False)
+        )
+
 class OptionLookup(BaseModel):
     option = CharField()
     default = CharField()
@@ -82,15 +112,336 @@ class Blacklist(BaseModel):
     server = ForeignKeyField(Server, backref='blacklist', on_delete='CASCADE')
     channel = ForeignKeyField(Channel, backref='blacklist', on_delete='CASCADE')
 
+def _existing(model, fields, ids, chunk_size):
+    """Maps id -> tuple(fields) for whichever of ids are already stored"""
+    found = {}
+    for chunk in chunked(ids, chunk_size):
+        query = model.select(model.id, *fields).where(model.id.in_(chunk)).tuples()
+        found.update((row[0], row[1:]) for row in query)
+    return found
+
+def _changed(model, rows, fields, chunk_size):
+    """Rows that are missing or differ from what's stored, judged by fields"""
+    names = [f.name for f in fields]
+    existing = _existing(model, fields, [r['id'] for r in rows], chunk_size)
+    return [r for r in rows if existing.get(r['id']) != tuple(r[n] for n in names)]
+
+def sync_servers(users, servers, channels, prune=False, chunk_size=100, keep=()):
+    """Reconciles stored users/servers/channels with what the gateway reports, meant to run in one transaction
+
+    Only missing or changed rows are upserted. With prune, servers we are no longer in and channels that
+    no longer exist in the given servers are deleted as well. Ids in keep are servers we are still in but
+    couldn't sync (e.g. unavailable), which are left as they are.
+    """
+    stats = {'users': 0, 'servers': 0, 'channels': 0, 'deleted_servers': [], 'deleted_channels': []}
+    upserts = [
+        (User, users, [User.name], 'users'),
+        (Server, servers, [Server.name, Server.owner], 'servers'),
+        (Channel, channels, [Channel.name, Channel.server], 'channels')
+    ]
+    for model, rows, fields, key in upserts:
+        changed = _changed(model, rows, fields, chunk_size)
+        for chunk in chunked(changed, chunk_size):
+            model.insert_many(chunk).on_conflict(conflict_target=[model.id], preserve=fields).execute()
+        stats[key] = len(changed)
+
+    if prune:
+        server_ids = set(r['id'] for r in servers)
+        channel_ids = set(r['id'] for r in channels)
+        stale_channels = [c for c, s in Channel.select(Channel.id, Channel.server).tuples()
+                          if s in server_ids and c not in channel_ids]
+        keep = set(int(s) for s in keep)
+        stale_servers = [s for s, in Server.select(Server.id).tuples() if s not in server_ids and s not in keep]
+        for chunk in chunked(stale_channels, chunk_size):
+            Channel.delete().where(Channel.id.in_(chunk)).execute()
+        for chunk in chunked(stale_servers, chunk_size):
+            Server.delete().where(Server.id.in_(chunk)).execute()
+        stats['deleted_servers'] = stale_servers
+        stats['deleted_channels'] = stale_channels
+    return stats
+
+def builtin_options(defaults):
+    """Registers options the client reads itself under a 'Builtin' module, returning what servers have set
+
+    Returns server_id -> {option: value} for every server that overrides one of them.
+    """
+    module, _ = Module.get_or_create(name='Builtin', defaults={'url': 'builtin'})
+    for option, default in defaults.items():
+        OptionLookup.get_or_create(option=option, module=module, defaults={'default': str(default)})
+    rows = (ServerOption
+            .select(ServerOption.server, OptionLookup.option, ServerOption.value)
+            .join(OptionLookup)
+            .where(OptionLookup.module == module)
+            .tuples())
+    overrides = {}
+    for server_id, option, value in rows:
+        overrides.setdefault(str(server_id), {})[option] = value
+    return overrides
+
+def declare_options(module, options):
+    """Adds OptionLookup rows for whichever of options the module doesn't have yet, leaving the rest to
+    register_module"""
+    known = set(o for o, in OptionLookup.select(OptionLookup.option).where(OptionLookup.module == module).tuples())
+    rows = [{'option': o, 'default': str(d), 'module': module} for o, d in options.items() if o not in known]
+    if rows:
+        OptionLookup.insert_many(rows).execute()
+
+def manifest_hash(commands, options):
+    return hashlib.sha1(json.dumps([commands, options], sort_keys=True, default=str).encode()).hexdigest()
+
+def _sync_links(model, field, command_ids, wanted):
+    """Makes model's (field, command) rows for command_ids match wanted, a set of (command id, value)"""
+    if not command_ids:
+        return
+    existing = set((c, v) for v, c in model.select(field, model.command).where(model.command.in_(command_ids)).tuples())
+    for c, v in existing - wanted:
+        model.delete().where((model.command == c) & (field == v)).execute()
+    rows = [{field.name: v, 'command': c} for c, v in wanted - existing]
+    if rows:
+        model.insert_many(rows).execute()
+
+def register_module(name, url, commands, options):
+    """Brings a module's Module, Command, RequiredContext, RequiredPermission and OptionLookup rows in line with
+    its manifest, meant to run in one transaction
+
+    Nothing is written if the manifest hashes the same as last time. Otherwise only what changed is
+    touched, so rows referring to commands and options that still exist (whitelists, server options) survive.
+    """
+    digest = manifest_hash(commands, options)
+    module, created = Module.get_or_create(name=name, defaults={'url': url})
+    if module.manifest_hash == digest and module.url == url:
+        return module
+
+    existing = dict((n, (i, h)) for i, n, h in
+                    Command.select(Command.id, Command.name, Command.help).where(Command.module == module).tuples())
+    stale = [i for n, (i, h) in existing.items() if n not in commands]
+    if stale:
+        Command.delete().where(Command.id.in_(stale)).execute()
+    new = [{'name': n, 'help': spec['help'], 'module': module} for n, spec in commands.items() if n not in existing]
+    if new:
+        Command.insert_many(new).execute()
+    for n, spec in commands.items():
+        if n in existing and existing[n][1] != spec['help']:
+            Command.update(help=spec['help']).where(Command.id == existing[n][0]).execute()
+
+    ids = dict((n, i) for i, n in Command.select(Command.id, Command.name).where(Command.module == module).tuples())
+    _sync_links(RequiredContext, RequiredContext.attr, list(ids.values()),
+                set((ids[n], attr) for n, spec in commands.items() for attr in spec['requires']))
+    _sync_links(RequiredPermission, RequiredPermission.perm, list(ids.values()),
+                set((ids[n], perm) for n, spec in commands.items() for perm in spec['permissions']))
+
+    known = dict((o, (i, d)) for i, o, d in
+                 OptionLookup.select(OptionLookup.id, OptionLookup.option, OptionLookup.default)
+                 .where(OptionLookup.module == module).tuples())
+    stale = [i for o, (i, d) in known.items() if o not in options]
+    if stale:
+        # server options don't cascade
+        ServerOption.delete().where(ServerOption.option.in_(stale)).execute()
+        OptionLookup.delete().where(OptionLookup.id.in_(stale)).execute()
+    new = [{'option': o, 'default': d, 'module': module} for o, d in options.items() if o not in known]
+    if new:
+        OptionLookup.insert_many(new).execute()
+    for o, d in options.items():
+        if o in known and known[o][1] != str(d):
+            OptionLookup.update(default=d).where(OptionLookup.id == known[o][0]).execute()
+
+    module.url = url
+    module.manifest_hash = digest
+    module.save()
+    return module
+
+def _migrate(db):
+    """Adds columns newer code expects to tables made before they existed"""
+    columns = [c.name for c in db.get_columns(Module._meta.table_name)]
+    if 'manifest_hash' not in columns:
+        migrate(SchemaMigrator.from_database(db).add_column(Module._meta.table_name, 'manifest_hash', Module.manifest_hash))
+
+_PARTITION_TABLE = re.compile(r'^message_(\d{4})(\d{2})$')
+# (year, month) -> model, for every partition that exists
+_partitions = {}
+_partitions_lock = threading.Lock()
+
+def _partition_model(year, month):
+    suffix = '{:04d}{:02d}'.format(year, month)
+    return type('Message' + suffix, (Message,), {
+        'Meta': type('Meta', (), {'table_name': 'message_' + suffix}),
+        # plain ids rather than foreign keys: a log shouldn't reject a message from a channel that
+        # hasn't been synced yet, and old partitions are dropped whole anyway. The composite indexes
+        # cover lookups by either
+        'channel': IntegerField(column_name='channel_id', index=False),
+        'author': IntegerField(column_name='author_id', index=False)
+    })
+
+def message_partition(when):
+    """The model for the month of the datetime when, making its table the first time it's needed"""
+    key = (when.year, when.month)
+    model = _partitions.get(key)
+    if model is None:
+        with _partitions_lock:
+            model = _partitions.get(key)
+            if model is None:
+                model = _partition_model(*key)
+                model.create_table(safe=True)
+                _partitions[key] = model
+    return model
+
+def _partition_snapshot():
+    """(year, month), model pairs for every partition, oldest first
+
+    Copied under the lock, since prune_messages may be dropping one on another DB thread meanwhile.
+    """
+    with _partitions_lock:
+        return sorted(_partitions.items(), key=lambda p: p[0])
+
+def message_partitions():
+    """Every partition's model, newest first"""
+    return [model for key, model in reversed(_partition_snapshot())]
+
+def partition_messages(rows):
+    """Groups message rows by the partition their timestamp puts them in, as (model, rows) pairs"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(message_partition(row['timestamp']), []).append(row)
+    return list(groups.items())
+
+def recent_messages(channel_id, limit=50, before=None):
+    """A channel's latest messages, newest first, optionally only those sent before a datetime
+
+    Each partition is one seek on its (channel, timestamp) index, and older partitions are only read
+    while we are still short of limit.
+    """
+    found = []
+    for model in message_partitions() + [Message]:
+        if before is not None and model is not Message and \
+                (model._meta.table_name > 'message_{:04d}{:02d}'.format(before.year, before.month)):
+            continue
+        query = model.select().where(model.channel == channel_id)
+        if before is not None:
+            query = query.where(model.timestamp < before)
+        found.extend(query.order_by(model.timestamp.desc()).limit(limit - len(found)).dicts())
+        if len(found) >= limit:
+            break
+    return found
+
+class ArchivedMessage(Model):
+    """A message in an archive file, bound to that file's database by _archive"""
+    id = IntegerField(primary_key=True)
+    content = TextField()
+    timestamp = DateTimeField()
+    channel = IntegerField(column_name='channel_id')
+    author = IntegerField(column_name='author_id')
+
+    class Meta:
+        table_name = 'message'
+
+def _archive(model, archive_dir, chunk_size):
+    """Copies a partition into its own SQLite file under archive_dir"""
+    os.makedirs(archive_dir, exist_ok=True)
+    archive = SqliteDatabase(os.path.join(archive_dir, model._meta.table_name + '.db'))
+    fields = [ArchivedMessage.id, ArchivedMessage.content, ArchivedMessage.timestamp,
+              ArchivedMessage.channel, ArchivedMessage.author]
+    rows = (model
+            .select(model.id, model.content, model.timestamp, model.channel, model.author)
+            .tuples()
+            .iterator())
+    with archive.bind_ctx([ArchivedMessage]):
+        with archive:
+            ArchivedMessage.create_table(safe=True)
+            for chunk in chunked(rows, chunk_size):
+                with archive.atomic():
+                    ArchivedMessage.insert_many(chunk, fields=fields).on_conflict_ignore().execute()
+
+def prune_messages(keep_months=12, archive_dir=None, now=None, chunk_size=1000):
+    """Drops (after archiving, if archive_dir is set) partitions older than keep_months, and trims the
+    unpartitioned table in small batches
+
+    Only ever touches old tables, so the partition taking writes is never locked. Returns the names of
+    the tables dropped and how many old unpartitioned rows were deleted.
+    """
+    now = now or datetime.datetime.utcnow()
+    months = now.year * 12 + now.month - 1 - keep_months
+    cutoff = datetime.datetime(months // 12, months % 12 + 1, 1)
+    dropped = []
+    for key, model in [p for p in _partition_snapshot() if p[0] < (cutoff.year, cutoff.month)]:
+        if archive_dir is not None:
+            _archive(model, archive_dir, chunk_size)
+        with _partitions_lock:
+            model.drop_table(safe=True)
+            _partitions.pop(key, None)
+        dropped.append(model._meta.table_name)
+
+    deleted = 0
+    while True:
+        batch = Message.select(Message.id).where(Message.timestamp < cutoff).limit(chunk_size)
+        n = Message.delete().where(Message.id.in_(batch)).execute()
+        deleted += n
+        if n < chunk_size:
+            break
+    return {'dropped': dropped, 'deleted': deleted}
+
+def _load_partitions(db):
+    for table in db.get_tables():
+        m = _PARTITION_TABLE.match(table)
+        if m is not None:
+            key = (int(m.group(1)), int(m.group(2)))
+            _partitions.setdefault(key, _partition_model(*key))
+
+# what db_proxy was last initialised with
+_db_url = None
+
 def db_init(db_url):
+    global _db_url
     db_proxy.initialize(connect(db_url, thread_safe=True))
+    _db_url = db_url
     if db_url.startswith('sqlite'):
         # since sqlite doesnt support fks by default
         db_proxy.pragma('foreign_keys', 1, permanent=True)
     db_proxy.create_tables([
-        ModuleServer, Module, Command, OptionLookup, RequiredContext, RequiredPermission,
+        ModuleServer, Module, ModuleReplica, Command, OptionLookup, RequiredContext, RequiredPermission,
         User, Server, Channel, Message, ServerOption,
         Whitelist, Blacklist
     ])
+    _migrate(db_proxy)
+    _load_partitions(db_proxy)
     db_proxy.close()
     return db_proxy
+
+def database(db_url):
+    """The database at db_url, only set up by db_init the first time
+
+    Modules are constructed while DB threads are using the database (on every hot reload, too), so
+    swapping a new one in under them each time isn't safe.
+    """
+    if db_proxy.obj is None or _db_url != db_url:
+        return db_init(db_url)
+    return db_proxy
+
+class DBExecutor:
+    """Runs peewee calls on a bounded pool of threads so they never block the event loop"""
+
+    def __init__(self, db, max_workers=4):
+        self.db = db
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+    def _call(self, func, args, kwargs):
+        # connection state is thread local, so each worker thread holds on to its own
+        self.db.connect(reuse_if_open=True)
+        return func(*args, **kwargs)
+
+    def _call_atomic(self, func, args, kwargs):
+        self.db.connect(reuse_if_open=True)
+        with self.db.atomic():
+            return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """Awaitable func(*args, **kwargs), run on a database thread"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.pool, partial(self._call, func, args, kwargs))
+
+    async def atomic(self, func, *args, **kwargs):
+        """Like run, but inside a single transaction"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.pool, partial(self._call_atomic, func, args, kwargs))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
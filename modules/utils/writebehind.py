@@ -0,0 +1,152 @@
+import asyncio
+
+from time import perf_counter
+
+from peewee import IntegrityError, chunked
+
+class WriteBehindQueue:
+    """Buffers rows in memory and writes them out in batched transactions off the event loop"""
+
+    def __init__(self, dbx, models, max_rows=500, interval=1.0, max_pending=10000, put_timeout=1.0, chunk_size=100,
+                 partitions=None):
+        """models maps each model to its on_conflict kwargs, in the order they must be flushed
+
+        partitions optionally maps a model to a function splitting its rows into (model, rows) pairs,
+        for models whose rows are spread over several tables.
+        """
+        self.dbx = dbx
+        self.models = models
+        self.partitions = partitions or {}
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.chunk_size = chunk_size
+        # keyed by primary key so repeated upserts of a row collapse into one
+        self.buffers = {m: {} for m in models}
+        self.depth = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._wake = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._task = loop.create_task(self._run())
+
+    async def put(self, model, row):
+        """Queues a row, waiting up to put_timeout for room before dropping it"""
+        key = row[model._meta.primary_key.name]
+        buf = self.buffers[model]
+        if key not in buf:
+            while self.depth >= self.max_pending:
+                self._not_full.clear()
+                self._wake.set()
+                try:
+                    await asyncio.wait_for(self._not_full.wait(), self.put_timeout)
+                except asyncio.TimeoutError:
+                    self.dropped += 1
+                    return False
+            # the buffers may have been swapped out while we waited
+            buf = self.buffers[model]
+            self.depth += 1
+        buf[key] = row
+        if self.depth >= self.max_rows:
+            self._wake.set()
+        return True
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.depth:
+                return
+            batches = [(m, list(self.buffers[m].values())) for m in self.models]
+            count = self.depth
+            self.buffers = {m: {} for m in self.models}
+            self.depth = 0
+            self._not_full.set()
+
+            start = perf_counter()
+            try:
+                await self.dbx.atomic(self._write, batches)
+                self.rows_written += count
+            except IntegrityError as e:
+                # a bad row (e.g. a dangling foreign key) shouldn't take the rest of the batch with it
+                print('Write-behind flush of {} rows failed, retrying in parts: {}'.format(count, e))
+                written = await self.dbx.run(self._write_isolated, batches)
+                self.rows_written += written
+                self.dropped += count - written
+            except Exception as e:
+                print('Write-behind flush of {} rows failed: {}'.format(count, e))
+                self.dropped += count
+            self.flushes += 1
+            self.last_flush_latency = perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+    def _chunks(self, batches):
+        """(table model, on_conflict kwargs, rows) for every insert a flush makes, in order"""
+        for model, rows in batches:
+            split = self.partitions.get(model)
+            for target, part in split(rows) if split else [(model, rows)]:
+                for chunk in chunked(part, self.chunk_size):
+                    yield target, self.models[model], chunk
+
+    def _write(self, batches):
+        for target, conflict, chunk in self._chunks(batches):
+            target.insert_many(chunk).on_conflict(**conflict).execute()
+
+    def _write_isolated(self, batches):
+        """Writes each chunk in its own transaction, and a failing chunk row by row, returning the rows written"""
+        db = self.dbx.db
+        written = 0
+        for target, conflict, chunk in self._chunks(batches):
+            try:
+                with db.atomic():
+                    target.insert_many(chunk).on_conflict(**conflict).execute()
+                written += len(chunk)
+                continue
+            except IntegrityError:
+                pass
+            for row in chunk:
+                try:
+                    with db.atomic():
+                        target.insert(row).on_conflict(**conflict).execute()
+                    written += 1
+                except IntegrityError as e:
+                    print('Write-behind dropped a {} row: {}'.format(target.__name__, e))
+        return written
+
+    async def close(self):
+        """Stops the background flusher and writes out whatever is left"""
+        if self._task is not None:
+            # let an in-progress flush finish rather than cancelling it mid-transaction
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency
+        }
@@ -2,24 +2,42 @@ import asyncio
 import json
 
 from functools import reduce
+from collections import namedtuple
+from time import perf_counter
 
-import websockets
 import discord
 
 from modules.utils import sql
-from modules.utils.moduletools import Command, command, checks
+from modules.utils.pool import ConnectionPool
+from modules.utils.cache import LRUCache, MISSING
+from modules.utils.writebehind import WriteBehindQueue
+from modules.utils.router import Router, make_route
+from modules.utils.balancer import Balancer
+from modules.utils.ratelimit import RateLimits
+from modules.utils import codec, metrics
+from modules.utils.moduletools import Command, command, checks, result_key, HANDLES
+
+# Read-only snapshots of the rows dispatch needs, so they can outlive their connection
+CommandInfo = namedtuple('CommandInfo', [
+    'name', 'enabled', 'module', 'module_enabled', 'url', 'replicas',
+    'required_context', 'permissions', 'whitelist', 'whitelist_servers', 'blacklist'
+])
+ChannelInfo = namedtuple('ChannelInfo', ['server', 'owner', 'can_post'])
+UserInfo = namedtuple('UserInfo', ['name', 'bot', 'banned'])
 
 class Builtin:
     """Outlines the Commands the bot should always have, without need to defer to a module"""
+    # these are handed the triggering message rather than just its arguments
+    takes_message = {'get_server_options', 'set_server_option', 'startup_report'}
+
     def __init__(self, client):
         # Load in bot commands
-        self.commands = [k for k,v in self.__class__.__dict__.items() if isinstance(v, Command)]
+        self.commands = {k for k,v in self.__class__.__dict__.items() if isinstance(v, Command)}
 
     @command
     @checks('administrator')
     async def get_server_options(self, message):
-        with self.db.connection_context():
-            all_opts = sql.OptionLookup.select()
+        def describe():
             opts = sql.ServerOption.select().where(sql.ServerOption.server == message.server.id)
             s = ''
             for o in opts:
@@ -27,57 +45,105 @@ class Builtin:
                 if not t:
                     t = '{}: {}\n'.format(o.option.option, o.option.default)
                 s += t
-            await self.send_message(message.channel, s)
+            return s
+        await self.send_message(message.channel, await self.dbx.run(describe))
 
     @command
     @checks('administrator')
     async def set_server_option(self, message, option, new_val):
-        with self.db.connection_context():
+        try:
+            # ours can be checked before anything is saved, so a bad value never reaches the database
+            self.limits.parse_option(option, new_val)
+        except ValueError as e:
+            await self.send_message(message.channel, str(e))
+            return
+        def store():
             opt = sql.OptionLookup.get(sql.OptionLookup.option == option)
             (sql.ServerOption
                 .insert({sql.ServerOption.option: opt, sql.ServerOption.value: new_val, sql.ServerOption.server: message.server.id})
                 .on_conflict('replace').execute())
+            module = opt.module
+            replicas = [r.url for r in sql.ModuleReplica.select().where(sql.ModuleReplica.name == module.name)]
+            return module.name, replicas or [module.url]
+        module_name, module_urls = await self.dbx.run(store)
+        if module_name == 'Builtin':
+            # one of ours, e.g. a rate limit
+            self.limits.set_option(message.server.id, option, new_val)
+            return
+        self.cache['result'].invalidate_if(lambda key: key[0] == module_name and key[1] == message.server.id)
+        # modules cache resolved options, so let every module server running it know
+        manager_urls = set(url.rsplit('/', 1)[0] + '/main' for url in module_urls)
+        results = await asyncio.gather(*(self.call_module(url, 'invalidate_options', module_name, message.server.id)
+                                         for url in manager_urls), return_exceptions=True)
+        for url, result in zip(manager_urls, results):
+            if isinstance(result, Exception):
+                print('Could not invalidate {} options on {}: {}'.format(module_name, url, result))
 
     @command
     @checks('bot_owner')
     async def module_enable(self, module_serv, module_name):
         await self.call_module(module_serv, 'enable', [module_name])
+        self.cache['command'].invalidate()
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_disable(self, module_serv, module_name):
         await self.call_module(module_serv, 'disable', [module_name])
+        self.cache['command'].invalidate()
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_start(self, module_serv, module_name):
         await self.call_module(module_serv, 'start', [module_name])
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_stop(self, module_serv, module_name):
         await self.call_module(module_serv, 'stop', [module_name])
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_stop_all(self, module_serv, module_name):
         await self.call_module(module_serv, 'stop_all')
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_refresh(self, module_serv, module_name):
         await self.call_module(module_serv, 'refresh', [module_name])
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_refresh_all(self, module_serv, module_name):
         await self.call_module(module_serv, 'refresh_all')
+        await self.refresh_routes(module_serv)
 
     @command
     @checks('bot_owner')
     async def module_sleep(self, module_serv):
         await self.call_module(module_serv, 'sleep')
 
+    @command
+    @checks('bot_owner')
+    async def startup_report(self, message):
+        report = self.startup_report
+        if report is None:
+            await self.send_message(message.channel, 'Still starting up.')
+            return
+        lines = ['Woke {} module servers in {:.2f}s'.format(len(report['servers']), report['elapsed'])]
+        for r in report['servers']:
+            if r['error']:
+                lines.append('{}: failed after {:.2f}s ({})'.format(r['url'], r['latency'], r['error']))
+            else:
+                lines.append('{}: {:.2f}s, {} enabled, {} disabled, {} missing'.format(
+                    r['url'], r['latency'], r['enabled'], r['disabled'], r['missing']))
+        await self.send_message(message.channel, '\n'.join(lines))
+
 
 class PajamaClient(discord.Client):
 
@@ -85,22 +151,116 @@ class PajamaClient(discord.Client):
         self.config = self._load_config('data/config.json')
         self.modules = {}
         self.db = sql.db_init(self.config['database_url'])
+        self.dbx = sql.DBExecutor(self.db, self.config.get('db_workers', 4))
         self.token = self.config['bot_token']
         self.builtins = Builtin(self)
+        self.router = Router(self.config['global_prefix'])
+        self.balancer = Balancer(**self.config.get('balancer', {}))
+        self.startup_report = None
+        self.metrics = metrics.Metrics()
+        self.limits = RateLimits(**self.config.get('rate_limits', {}))
+        self.metrics_server = None
+        self.pool = ConnectionPool(**self.config.get('module_connection', {}))
+        cache_cfg = self.config.get('cache', {})
+        self.cache = {
+            'command': LRUCache(**cache_cfg),
+            'prefix': LRUCache(**cache_cfg),
+            'channel': LRUCache(**cache_cfg),
+            'user': LRUCache(**cache_cfg),
+            # results of @cacheable module commands, each kept for its own ttl
+            'result': LRUCache(**self.config.get('result_cache', {}))
+        }
+        # users go first so the messages referencing them never dangle
+        self.writer = WriteBehindQueue(self.dbx, {
+            sql.User: {'conflict_target': [sql.User.id], 'preserve': [sql.User.name, sql.User.bot]},
+            sql.Message: {'action': 'IGNORE'}
+        }, partitions={sql.Message: sql.partition_messages}, **self.config.get('write_behind', {}))
+        self.metrics.gauge('client.writebehind', self.writer.stats)
+        self.metrics.gauge('client.balancer', self.balancer.gauges)
+        self.retention = None
 
         super().__init__(*args, **kwargs)
+        self.writer.start(self.loop)
 
     def _load_config(self, cfg):
         with open(cfg, 'r') as f:
             return json.load(f)
     
-    async def get_prefixes(self, channel):
-        if channel.is_private:
-            server_prefix = ' '
-        else:
-            with self.db.connection_context():
-                server_prefix = sql.Server[channel.server.id].prefix
-        return (self.config['global_prefix'], server_prefix)
+    async def _cached(self, table, key, loader):
+        """Reads through self.cache[table], only touching the database on a miss"""
+        value = self.cache[table].get(key)
+        if value is MISSING:
+            value = await self.dbx.run(loader, key)
+            self.cache[table].set(key, value)
+        return value
+
+    def _load_command(self, name):
+        command = sql.Command.get_or_none(sql.Command.name == name)
+        if command is None:
+            return None
+        module = command.module
+        return CommandInfo(
+                name=command.name,
+                enabled=command.enabled,
+                module=module.name,
+                module_enabled=module.enabled,
+                url=module.url,
+                replicas=tuple(r.url for r in sql.ModuleReplica.select().where(sql.ModuleReplica.name == module.name)),
+                required_context=tuple(r.attr for r in command.required_context),
+                permissions=tuple(r.perm for r in command.required_permissions),
+                whitelist=frozenset(str(w.channel_id) for w in command.whitelist),
+                whitelist_servers=frozenset(str(w.server_id) for w in command.whitelist),
+                blacklist=frozenset(str(b.channel_id) for b in command.blacklist)
+        )
+
+    def _load_prefix(self, server_id):
+        return sql.Server[server_id].prefix
+
+    def _load_channel(self, channel_id):
+        channel = sql.Channel[channel_id]
+        return ChannelInfo(str(channel.server_id), str(channel.server.owner_id), channel.can_post)
+
+    def _load_user(self, user_id):
+        user = sql.User.get_or_none(sql.User.id == user_id)
+        if user is None:
+            return None
+        return UserInfo(user.name, user.bot, user.banned)
+
+    async def get_route(self, cmd):
+        route = self.router.commands.get(cmd)
+        if route is None:
+            # not announced by any module server we know of, so ask the database
+            command = await self._cached('command', cmd, self._load_command)
+            if command is None:
+                return None
+            route = make_route(command.module, command.url, command.required_context, command.permissions)
+            self.router.add(cmd, route)
+            for url in command.replicas or (command.url,):
+                self.balancer.add(command.module, url)
+        return route
+
+    async def refresh_routes(self, url):
+        """Syncs the router with the modules a module server is currently running"""
+        manifest = await self.call_module(url, 'manifest')
+        # started, stopped or reloaded, so what they returned before may no longer hold
+        self.cache['result'].invalidate_if(lambda key: key[0] in manifest)
+        for module, m in manifest.items():
+            if m['running']:
+                self.router.register(module, m['url'], m['commands'])
+                self.balancer.add(module, m['url'])
+            elif not self.balancer.remove(module, m['url']):
+                # that was the last replica
+                self.router.unregister(module)
+
+    def _builtin_allowed(self, message, act):
+        if message.author.id in self.config['bot_owner_ids']:
+            return True
+        if 'bot_owner' in act.permissions:
+            return False
+        if message.channel.is_private:
+            return not act.permissions
+        sess_perms = message.author.permissions_in(message.channel)
+        return all(getattr(sess_perms, perm) for perm in act.permissions)
 
     async def _checks(self, message, cmd):
         # True -> allowed action
@@ -110,246 +270,303 @@ class PajamaClient(discord.Client):
         if message.author.id in self.config.get('bot_owner_ids'):
             return True
 
-        with self.db.connection_context():
-            author = sql.User[message.author.id]
-            channel = sql.Channel[message.channel.id]
-            command = sql.Command.get_or_none(sql.Command.name == cmd)
-        module = command.module
-        permissions = command.required_permissions
+        author = await self._cached('user', message.author.id, self._load_user)
+        command = await self._cached('command', cmd, self._load_command)
+        if command is None:
+            return False
+        permissions = command.permissions
 
         # owner check
         if 'bot_owner' in permissions:
             return False
 
         # general user checks
-        if author.banned:
+        if author is not None and author.banned:
             return False
 
         # enabled check
-        if not module.enabled or not command.enabled:
+        if not command.module_enabled or not command.enabled:
             return False
         
         sess_perms = message.author.permissions_in(message.channel)
-        for row in permissions:
-            if not getattr(sess_perms, row.perm):
+        for perm in permissions:
+            if not getattr(sess_perms, perm):
                 return False
         
         # channel/server checks
         if not message.channel.is_private:
-            server = channel.server
-            if author == server.owner:
+            channel = await self._cached('channel', message.channel.id, self._load_channel)
+            if message.author.id == channel.owner:
                 return True
             # blacklist/whitelist
             # whitelist > blacklist but discord hierarchy remains
-            if hasattr(command, 'whitelist'):
-                if command.whitelist.get(sql.Whitelist.channel == channel):
-                    return True
-                else:
-                    return False
-
-            if hasattr(command, 'blacklist'):
-                if command.blacklist.get(sql.Blacklist.channel == channel):
-                    return False
-                else:
-                    return True
-
-            if hasattr(command, 'whitelist'):
-                if command.whitelist.get(sql.Whitelist.server == server):
-                    return True
-                else:
-                    return False
-
-            if hasattr(command, 'blacklist'):
-                if command.blacklist.get(sql.Blacklist.server == server):
-                    return False
-                else:
-                    return True
-
-            # finally 
-            if channel.can_post:
+            if message.channel.id in command.whitelist:
                 return True
-            else:
+            if channel.server in command.whitelist_servers:
+                return False
+            if message.channel.id in command.blacklist:
                 return False
 
+            # finally 
+            return channel.can_post
+
     async def call_module(self, url, action, *args, **kwargs):
-        async with websockets.connect('ws://{}'.format(url)) as websocket:
-            payload = json.dumps({"action":action, "args":args, "kwargs":kwargs})
-            await websocket.send(payload)
-            response = json.loads(await websocket.recv())
-            return response
+        return await self.pool.request(url, action, args, kwargs)
 
     async def on_ready(self):
-        module_responses = []
-        with self.db.connection_context():
-            for m in sql.ModuleServer.select():
+        metrics_cfg = self.config.get('metrics')
+        if metrics_cfg and self.metrics_server is None:
+            self.metrics_server = await metrics.serve(self.metrics, **metrics_cfg)
+        retention_cfg = self.config.get('message_retention')
+        if retention_cfg and self.retention is None:
+            self.retention = asyncio.ensure_future(self._retention(**retention_cfg))
+        await self.sync_servers(self.servers, prune=True)
+        overrides = await self.dbx.run(sql.builtin_options, self.limits.defaults())
+        for server_id, opts in overrides.items():
+            for option, value in opts.items():
                 try:
-                    res = await self.call_module(url=m.url, action='wake')
-                    module_responses += res
-                except:
-                    print('Error connecting to {}'.format(m.url)) 
+                    self.limits.set_option(server_id, option, value)
+                except ValueError as e:
+                    # saved before values were checked, so fall back to the default rather than fail to start
+                    print('Ignoring server {}\'s {}: {}'.format(server_id, option, e))
 
-        total_modules = len(module_responses)
-        enabled_modules = module_responses.count(True)
-        disabled_modules = module_responses.count(False)
-        missing_modules = total_modules - (enabled_modules + disabled_modules)
+        start = perf_counter()
+        urls = await self.dbx.run(lambda: [m.url for m in sql.ModuleServer.select()])
+        servers = await asyncio.gather(*(self._wake_server(url) for url in urls))
+        self.startup_report = {'elapsed': perf_counter() - start, 'servers': servers}
 
         print('Logged in as {}'.format(self.user.name))
         print('ID: {}'.format(self.user.id))
 
         print('\nModules:')
-        print('{} Total'.format(total_modules))
-        print('{} Enabled'.format(enabled_modules))
-        print('{} Disabled'.format(disabled_modules))
-        print('{} Missing'.format(missing_modules))
-    
-    def iter_getattr(self, obj, attr):
-        attrs = attr.split('.')
-        while len(attrs) > 0:
-            obj = getattr(obj, attrs.pop(0))
-        return obj
+        for key in ['total', 'enabled', 'disabled', 'missing']:
+            print('{} {}'.format(sum(r[key] for r in servers), key.capitalize()))
+        for r in servers:
+            if r['error']:
+                print('Error connecting to {}: {}'.format(r['url'], r['error']))
+
+    async def _wake_server(self, url):
+        """Wakes one module server, reporting how it went rather than raising"""
+        report = {'url': url, 'latency': 0.0, 'total': 0, 'enabled': 0, 'disabled': 0, 'missing': 0, 'error': None}
+        start = perf_counter()
+        async def wake():
+            res = await self.call_module(url, 'wake')
+            await self.refresh_routes(url)
+            return res
+        try:
+            # the route refresh shares the wake's timeout, so one slow server can't hold up on_ready
+            res = await asyncio.wait_for(wake(), self.config.get('wake_timeout', 30))
+        except Exception as e:
+            report['error'] = '{}: {}'.format(type(e).__name__, e)
+        else:
+            report['total'] = len(res)
+            report['enabled'] = res.count(True)
+            report['disabled'] = res.count(False)
+            report['missing'] = report['total'] - (report['enabled'] + report['disabled'])
+        report['latency'] = perf_counter() - start
+        return report
     
-    async def preprocess_command(self, cmd, message):
-        kwargs = {}
-        with self.db.connection_context():
-            try:
-                command = sql.Command.get(sql.Command.name == cmd)
-            except:
-                if message.author.id in self.config['bot_owner_ids']:
-                    return {}
-                else:
-                    return None
-        kwargs.update({
-            'server.id': message.server.id,
-            'message.id': message.id,
-            'channel.id': message.channel.id
-        })
-        for field in command.required_context:
-            k = field.attr
-            v = self.iter_getattr(message, k)
-            kwargs.update({k: v})
-        return kwargs
+    async def preprocess_command(self, route, message):
+        if route is None:
+            if message.author.id in self.config['bot_owner_ids']:
+                return {}
+            else:
+                return None
+        return route.extract(message)
 
     async def log_message(self, message):
-        with self.db.connection_context():
-            sql.Message.create(
-                    id = message.id,
-                    content = message.content,
-                    timestamp = message.timestamp,
-                    channel = message.channel.id,
-                    author = message.author.id
-            )
+        if message.channel.is_private:
+            # DMs have no Channel row to belong to
+            return
+        await self.writer.put(sql.Message, {
+                'id': message.id,
+                'content': message.content,
+                'timestamp': message.timestamp,
+                'channel': message.channel.id,
+                'author': message.author.id
+        })
+
+    async def recent_messages(self, channel_id, limit=50, before=None):
+        """A channel's latest logged messages as dicts, newest first"""
+        return await self.dbx.run(sql.recent_messages, int(channel_id), limit, before)
+
+    async def _retention(self, keep_months=12, archive_dir=None, interval=3600):
+        """Prunes (and optionally archives) old message partitions every interval seconds"""
+        while True:
+            try:
+                res = await self.dbx.run(sql.prune_messages, keep_months, archive_dir)
+                if res['dropped'] or res['deleted']:
+                    print('Pruned message partitions {} and {} older messages'.format(', '.join(res['dropped']) or 'none', res['deleted']))
+            except Exception as e:
+                print('Message retention failed: {}: {}'.format(type(e).__name__, e))
+            await asyncio.sleep(interval)
+
+    async def _perform(self, message, response):
+        """Carries out one [action, *args] a module sent back, swapping handles for the objects they name"""
+        rattr,*rargs = response
+        for i, arg in enumerate(rargs):
+            if type(arg) is dict and 'ref' in arg:
+                rargs[i] = HANDLES[arg['ref']](message)
+        action = getattr(self, rattr)
+        await action(*rargs)
+
+    async def _run_command(self, url, cmd, args, kwargs, message):
+        """Performs each action a module command streams back as it arrives, returning them all"""
+        # the owner's commands jump the queue, and nobody's are worth running once they've been forgotten
+        priority = codec.HIGH if message.author.id in self.config['bot_owner_ids'] else codec.NORMAL
+        performed = []
+        # losing the connection once this is sent raises RequestLost, which the balancer won't retry elsewhere
+        async for response in self.pool.stream(url, cmd, args, kwargs, priority, self.config.get('command_deadline')):
+            await self._perform(message, response)
+            performed.append(response)
+        return performed
 
     async def on_message(self, message):
-        self.db.connect(reuse_if_open=True)
         author = message.author
         if author.bot:
             return
-        sql_author,created = sql.User.get_or_create(id=author.id)
-        sql_author.name = author.name
-        sql_author.bot = author.bot
-        if created:
-            sql_author.save(force_insert=True)
-        else:
-            sql_author.save()
-
-        content = message.content
-        prefixes = await self.get_prefixes(message.channel)
-        prefix = ''
-        for p in prefixes:
-            if content.startswith(p):
-                prefix = p
-        if not p:
+        start = perf_counter()
+        self.metrics.incr('client.messages')
+        known = await self._cached('user', author.id, self._load_user)
+        if known is None or known.name != author.name:
+            await self.writer.put(sql.User, {'id': author.id, 'name': author.name, 'bot': author.bot})
+            banned = known.banned if known is not None else False
+            self.cache['user'].set(author.id, UserInfo(author.name, author.bot, banned))
+
+        server_id = None if message.channel.is_private else message.server.id
+        if not self.router.has_server(server_id):
+            self.router.set_prefix(server_id, await self._cached('prefix', server_id, self._load_prefix))
+        parsed = self.router.parse(server_id, message.content)
+        if parsed is None:
             await self.log_message(message)
         else:
-            cmd,*args = content[len(prefix):].split(' ')
+            prefix,cmd,args = parsed
+            self.metrics.incr('client.commands')
+            # before anything that could reach the database or a module server
+            if author.id not in self.config['bot_owner_ids'] and \
+                    not self.limits.allow(author.id, cmd, message.channel.id, server_id):
+                self.metrics.incr('client.rate_limited')
+                return
             if cmd in self.builtins.commands:
-                self.db.close()
                 act = getattr(self.builtins, cmd)
-                if cmd == 'set_server_option' or 'get_server_options':
+                if not self._builtin_allowed(message, act):
+                    return
+                if cmd in self.builtins.takes_message:
                     await act.func(self, message, *args)
                 else:
                     await act.func(self, *args)
                 return
-            kwargs = await self.preprocess_command(cmd, message)
-            if kwargs is None:
+            route = await self.get_route(cmd)
+            t = perf_counter()
+            kwargs = await self.preprocess_command(route, message)
+            self.metrics.observe('client.preprocess', perf_counter() - t)
+            if kwargs is None or route is None:
                 return
-            if await self._checks(message, cmd):
-                module = sql.Command.get(sql.Command.name == cmd).module
-                rattr,*rargs = await self.call_module(module.url, cmd, *args, **kwargs)
-                for i in range(len(rargs)):
-                    obj = ''
-                    for k,v in kwargs.items():
-                        if v == rargs[i]:
-                            if k == 'message.id':
-                                obj = message
-                            else:
-                                var = k.split('.')[0]
-                                obj = getattr(message, var)
-                            rargs[i] = obj
-                action = getattr(self, rattr)
-                await action(*rargs)
-        self.db.close()
+            t = perf_counter()
+            allowed = await self._checks(message, cmd)
+            self.metrics.observe('client.checks', perf_counter() - t)
+            if not allowed:
+                self.metrics.incr('client.denied')
+            else:
+                key = None
+                if route.cache is not None:
+                    key = (route.module,) + result_key(cmd, args, kwargs, route.cache)
+                    cached = self.cache['result'].get(key)
+                    if cached is not MISSING:
+                        self.metrics.incr('client.cache_hits')
+                        for response in cached:
+                            await self._perform(message, response)
+                        self.metrics.observe('client.command', perf_counter() - start)
+                        return
+                    self.metrics.incr('client.cache_misses')
+                t = perf_counter()
+                performed = await self.balancer.call(
+                        route.module, lambda url: self._run_command(url, cmd, args, kwargs, message))
+                self.metrics.observe('client.call_module', perf_counter() - t)
+                if key is not None:
+                    self.cache['result'].set(key, performed, route.cache['ttl'])
+                self.metrics.observe('client.command', perf_counter() - start)
+
+    async def sync_servers(self, servers, prune=False):
+        """Bulk-reconciles the database with the given servers, their owners and channels"""
+        users = {}
+        rows = []
+        channels = []
+        # still joined, just not something we can read right now, so pruning mustn't take them for gone
+        skipped = []
+        for server in servers:
+            owner = server.owner
+            if server.unavailable or owner is None:
+                skipped.append(int(server.id))
+                continue
+            users[owner.id] = {'id': int(owner.id), 'name': owner.name, 'bot': owner.bot}
+            rows.append({'id': int(server.id), 'name': server.name, 'owner': int(owner.id)})
+            for ch in server.channels:
+                channels.append({'id': int(ch.id), 'name': ch.name, 'server': int(server.id)})
+
+        start = perf_counter()
+        stats = await self.dbx.atomic(sql.sync_servers, list(users.values()), rows, channels,
+                                      prune=prune, chunk_size=self.config.get('sync_chunk_size', 100), keep=skipped)
+        elapsed = perf_counter() - start
+
+        for server_id in stats['deleted_servers']:
+            self.cache['prefix'].invalidate(str(server_id))
+            self.router.forget_server(str(server_id))
+        for channel_id in stats['deleted_channels']:
+            self.cache['channel'].invalidate(str(channel_id))
+        if stats['deleted_servers']:
+            self.cache['channel'].invalidate()
+        for owner_id in users:
+            self.cache['user'].invalidate(owner_id)
+
+        print('Synced {} servers and {} channels in {:.2f}s ({} users, {} servers, {} channels written, {} servers and {} channels removed)'.format(
+            len(rows), len(channels), elapsed, stats['users'], stats['servers'], stats['channels'],
+            len(stats['deleted_servers']), len(stats['deleted_channels'])))
+        return stats
 
     async def on_server_join(self, server):
-        self.db.connect(reuse_if_open=True)
         print('Joined server {}'.format(server.name))
-        owner = server.owner
-        sql.User.get_or_create(
-                id=owner.id,
-                name=owner.name,
-                bot=False
-        )
-
-        joined_server = sql.Server.create(
-                id=server.id,
-                name=server.name,
-                owner=owner.id
-        )
-
-        channel_dicts = []
-        for ch in server.channels:
-            channel_dicts.append({
-                'id': ch.id,
-                'name': ch.name,
-                'server': server.id
-            })
-
-        with self.db.atomic():
-            sql.Channel.insert_many(channel_dicts).execute()
-        self.db.close()
+        await self.sync_servers([server])
     
     async def on_server_remove(self, server):
-        with self.db.connection_context():
-            sql.Server[server.id].delete_instance()
+        await self.dbx.run(sql.Server.delete_by_id, server.id)
+        self.cache['prefix'].invalidate(server.id)
+        self.router.forget_server(server.id)
+        # channels cascade with the server, and we don't index them by server
+        self.cache['channel'].invalidate()
         
     async def on_server_update(self, before, after):
         if before.name != after.name:
-            with self.db.connection_context():
-                serv = sql.Server[after.id]
-                serv.name = after.name
-                serv.save()
+            query = sql.Server.update(name=after.name).where(sql.Server.id == after.id)
+            await self.dbx.run(query.execute)
+        self.cache['prefix'].invalidate(after.id)
+        self.router.forget_server(after.id)
 
     async def on_channel_create(self, channel):
         if not channel.is_private:
-            with self.db.connection_context():
-                ch = sql.Channel(
-                        id=channel.id,
-                        name=channel.name,
-                        server=sql.Server[channel.server.id]
-                )
-                ch.save()
+            await self.dbx.run(sql.Channel.create, id=channel.id, name=channel.name, server=channel.server.id)
+            self.cache['channel'].invalidate(channel.id)
 
     async def on_channel_delete(self, channel):
-        with self.db.connection_context():
-            sql.Channel[channel.id].delete_instance()
+        await self.dbx.run(sql.Channel.delete_by_id, channel.id)
+        self.cache['channel'].invalidate(channel.id)
 
     async def on_channel_update(self, before, after):
         if before.name != after.name:
-            with self.db.connection_context():
-                ch = sql.Channel[after.id]
-                ch.name = after.name
-                ch.save()
-        
+            query = sql.Channel.update(name=after.name).where(sql.Channel.id == after.id)
+            await self.dbx.run(query.execute)
+            self.cache['channel'].invalidate(after.id)
+
+    async def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.retention is not None:
+            self.retention.cancel()
+        await self.writer.close()
+        await self.pool.close()
+        await super().close()
+        self.dbx.shutdown()
+
 if __name__ == '__main__':
     client = PajamaClient()
     loop = asyncio.get_event_loop()
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.utils import sql
+from modules.utils.cache import LRUCache
+from modules.utils.moduletools import AttrDict
+
+@pytest.fixture
+def db(tmp_path):
+    """A fresh SQLite database with every table made, and no partitions left over from other tests"""
+    sql._partitions.clear()
+    db = sql.db_init('sqlite:///{}'.format(tmp_path / 'test.db'))
+    yield db
+    sql._partitions.clear()
+    db.close()
+
+@pytest.fixture
+def dbx(db):
+    dbx = sql.DBExecutor(db, 2)
+    yield dbx
+    dbx.shutdown()
+
+def make_server(server_id=1, channel_ids=(10,), owner_id=100):
+    """Just enough of the client's tables for messages to belong somewhere"""
+    sql.User.create(id=owner_id, name='owner', bot=False)
+    sql.Server.create(id=server_id, name='server', owner=owner_id)
+    for channel_id in channel_ids:
+        sql.Channel.create(id=channel_id, name='channel', server=server_id)
+
+def bare_module(cls, **attrs):
+    """An instance of a module class with the state BaseModule.__init__ sets up, minus the database"""
+    module = cls.__new__(cls)
+    module.config = {}
+    module.route = '/' + cls.__name__.lower()
+    module._credits = None
+    module._cancelled = set()
+    module.commands = cls.manifest()
+    module.options = AttrDict(cls.options)
+    module.in_queue = None
+    module.out_queue = None
+    module._server_options = LRUCache()
+    for attr, value in attrs.items():
+        setattr(module, attr, value)
+    return module
+
+class Clock:
+    """Stands in for monotonic(), moved along by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+class Control:
+    """Stands in for a worker's control queue"""
+
+    def __init__(self):
+        self.sent = []
+        self.queue = asyncio.Queue()
+
+    def put(self, msg):
+        self.sent.append(msg)
+
+    async def coro_get(self):
+        return await self.queue.get()
+
+class FakeQueue:
+    """Stands in for a worker's input or output queue, keeping whatever is put on it"""
+
+    def __init__(self):
+        self.items = []
+
+    async def coro_put(self, item):
+        self.items.append(item)
+        await asyncio.sleep(0)
+
+class Proc:
+    def __init__(self, exitcode=None):
+        self.exitcode = exitcode
+        self.killed = False
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def kill(self):
+        self.killed = True
+        self.exitcode = -9
+
+class FakeWorker:
+    """Just the parts of a Worker the pool looks at, without a process behind it"""
+
+    def __init__(self, wid=0, *assigned):
+        self.wid = wid
+        self.in_queue = FakeQueue()
+        self.control = Control()
+        self.proc = Proc()
+        self.assigned = dict((rid, 0.0) for rid in assigned)
+        self.retiring = False
+        self.heartbeat_age = 0.0
+
+    @property
+    def sent(self):
+        """Request ids handed to it, with None for a sentinel"""
+        return [item[0] if item is not None else None for item in self.in_queue.items]
+
+async def answer(pool, response=None, chunks=(), worker=None):
+    """Stands in for the feeder and a worker picking up the next queued request, sending chunks and replying"""
+    await asyncio.sleep(0)
+    priority, rid, deadline, item = pool.backlog.get_nowait()
+    worker = worker or FakeWorker()
+    if rid in pool.streams:
+        pool.streams[rid].worker = worker
+    for chunk in chunks:
+        pool._chunk(worker, rid, chunk)
+    pool.pending[rid][0].set_result(response)
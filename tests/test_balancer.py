@@ -0,0 +1,76 @@
+import asyncio
+
+from modules.utils.balancer import Balancer, RequestLost, remote_error
+
+def balancer(*urls, **kwargs):
+    b = Balancer(**kwargs)
+    for url in urls:
+        b.add('M', url)
+    return b
+
+def test_picks_least_outstanding_and_skips_excluded():
+    b = balancer('a', 'b')
+    b.replicas['M']['a'].in_flight = 2
+    assert b.pick('M').url == 'b'
+    assert b.pick('M', exclude={'b'}).url == 'a'
+    assert b.pick('M', exclude={'a', 'b'}) is None
+    assert b.pick('unknown') is None
+
+def test_fails_over_on_connection_errors_and_marks_replicas_down():
+    b = balancer('a', 'b', max_failures=1, cooldown=60)
+    tried = []
+    async def request(url):
+        tried.append(url)
+        if url == 'a':
+            raise ConnectionError('a is gone')
+        return url
+    b.replicas['M']['b'].in_flight = 1
+    assert asyncio.run(b.call('M', request)) == 'b'
+    assert tried == ['a', 'b']
+    assert not b.replicas['M']['a'].healthy
+    # a is in its cooldown, so b gets the next one straight away
+    assert asyncio.run(b.call('M', request)) == 'b' and tried[2:] == ['b']
+
+def test_other_errors_are_not_retried():
+    b = balancer('a', 'b')
+    async def request(url):
+        raise RuntimeError('the command failed')
+    try:
+        asyncio.run(b.call('M', request))
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    assert all(r.failures == 0 and r.in_flight == 0 for r in b.replicas['M'].values())
+
+def test_gauges_flatten_status():
+    b = balancer('host:1/m')
+    assert b.gauges() == {'M.host:1/m.in_flight': 0, 'M.host:1/m.healthy': 1,
+                          'M.host:1/m.failures': 0, 'M.host:1/m.last_latency': 0.0}
+
+def test_requests_lost_after_sending_are_not_run_again():
+    b = balancer('a', 'b')
+    tried = []
+    async def request(url):
+        tried.append(url)
+        raise RequestLost('dropped mid-request')
+    try:
+        asyncio.run(b.call('M', request))
+    except RequestLost:
+        pass
+    else:
+        assert False
+    assert len(tried) == 1 and b.replicas['M'][tried[0]].failures == 1
+
+def test_replicas_that_stopped_the_module_are_failed_over():
+    b = balancer('a', 'b')
+    tried = []
+    async def request(url):
+        tried.append(url)
+        if url == 'a':
+            raise remote_error('NotRunning: No module is running at /m')
+        return url
+    assert asyncio.run(b.call('M', request)) == 'b' and tried == ['a', 'b']
+    assert b.replicas['M']['a'].failures == 1
+    assert isinstance(remote_error('NotRunning: gone'), LookupError)
+    assert type(remote_error('LookupError: M has no command x')) is RuntimeError
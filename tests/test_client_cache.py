@@ -0,0 +1,55 @@
+import asyncio
+
+from types import SimpleNamespace
+
+from pajama import PajamaClient
+from modules.utils import sql
+from modules.utils.cache import LRUCache, MISSING
+from modules.utils.router import Router
+
+from conftest import make_server
+
+def make_client(dbx):
+    """A client with its caches and router, without logging in"""
+    client = PajamaClient.__new__(PajamaClient)
+    client.dbx = dbx
+    client.router = Router('!')
+    client.cache = dict((table, LRUCache()) for table in ('command', 'prefix', 'channel', 'user', 'result'))
+    return client
+
+def test_server_events_evict_cached_prefixes(db, dbx):
+    make_server(channel_ids=(10, 11))
+    client = make_client(dbx)
+    server = SimpleNamespace(id=1, name='server')
+
+    async def run():
+        assert await client._cached('prefix', 1, client._load_prefix) == ' '
+        client.router.set_prefix(1, ' ')
+        sql.Server.update(prefix='?').where(sql.Server.id == 1).execute()
+        # still the cached one until the gateway says something changed
+        assert await client._cached('prefix', 1, client._load_prefix) == ' '
+        await client.on_server_update(server, SimpleNamespace(id=1, name='renamed'))
+        assert await client._cached('prefix', 1, client._load_prefix) == '?'
+        assert not client.router.has_server(1) and sql.Server.get_by_id(1).name == 'renamed'
+
+        await client._cached('channel', 10, client._load_channel)
+        await client.on_server_remove(server)
+
+    asyncio.run(run())
+    assert client.cache['prefix'].get(1) is MISSING and client.cache['channel'].get(10) is MISSING
+    assert sql.Server.get_or_none(id=1) is None
+
+def test_channel_events_evict_cached_channels(db, dbx):
+    make_server(channel_ids=(10, 11))
+    client = make_client(dbx)
+
+    async def run():
+        for channel_id in (10, 11):
+            await client._cached('channel', channel_id, client._load_channel)
+        before = SimpleNamespace(id=10, name='channel')
+        await client.on_channel_update(before, SimpleNamespace(id=10, name='renamed'))
+        await client.on_channel_delete(SimpleNamespace(id=11))
+
+    asyncio.run(run())
+    assert client.cache['channel'].get(10) is MISSING and client.cache['channel'].get(11) is MISSING
+    assert sql.Channel.get_by_id(10).name == 'renamed' and sql.Channel.get_or_none(id=11) is None
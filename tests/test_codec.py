@@ -0,0 +1,24 @@
+import pytest
+
+from modules.utils import codec
+
+def test_json_is_always_available_and_the_default():
+    assert codec.negotiated(None) is codec.DEFAULT is codec.CODECS['json']
+    assert codec.negotiated('pajama.unknown') is codec.DEFAULT
+    assert codec.negotiated('other.msgpack') is codec.DEFAULT
+    assert codec.subprotocols(('json',)) == ['pajama.json']
+
+@pytest.mark.parametrize('name', sorted(codec.CODECS))
+def test_frames_round_trip(name):
+    c = codec.CODECS[name]
+    assert codec.negotiated('pajama.' + name) is c
+    frames = [codec.request(1, 'roll', ['1', '6'], {'server.id': '1'}, stream=True, priority=codec.HIGH, deadline=2.5),
+              codec.chunk(1, 'part'), codec.credit(1, 2), codec.cancel(1),
+              codec.reply(1, ['send_message', {'ref': 'channel'}, 'x']), codec.reply(1, error='boom')]
+    for frame in frames:
+        assert c.decode(c.encode(frame)) == frame
+
+def test_request_leaves_out_unset_fields():
+    r = codec.request(1, 'roll')
+    assert r == {'v': codec.VERSION, 'id': 1, 'action': 'roll', 'args': [], 'kwargs': {}}
+    assert codec.reply(1, 'ok', error='boom') == {'v': codec.VERSION, 'id': 1, 'error': 'boom'}
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+
+from module_manager import Manager
+from modules.utils.discovery import Discovery
+
+GOOD = b'''
+from modules.utils.moduletools import BaseModule, command
+class Watched(BaseModule):
+    @command
+    async def cmd(self, **ctx):
+        pass
+'''
+
+def write(path, source):
+    with open(path, 'wb') as f:
+        f.write(source)
+    # so the change shows up even on filesystems with coarse mtimes
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+def test_a_file_that_stops_parsing_keeps_its_last_good_entry(tmp_path):
+    write(tmp_path / 'watched.py', GOOD)
+    discovery = Discovery(str(tmp_path), 'modules')
+    before = discovery.discover()
+    hashes = discovery.hashes()
+    write(tmp_path / 'watched.py', GOOD + b'    def broken(:\n')
+    assert discovery.discover() == before and discovery.hashes() == hashes
+    # and one that never parsed is just left out
+    write(tmp_path / 'new.py', b'class (:\n')
+    assert discovery.discover() == before
+
+def test_watcher_keeps_reloading_after_a_broken_save(tmp_path, monkeypatch):
+    write(tmp_path / 'watched.py', GOOD)
+    manager = Manager.__new__(Manager)
+    manager.discovery = Discovery(str(tmp_path), 'modules')
+    manager.modules = dict((name, [info, None]) for name, info in manager.discovery.discover().items())
+    manager.processes = {'watched': None}
+    reloaded = []
+
+    async def reload(name):
+        reloaded.append(name)
+    manager.reload = reload
+
+    async def run():
+        watcher = asyncio.ensure_future(manager._watch(0))
+        await asyncio.sleep(0.01)
+        write(tmp_path / 'watched.py', GOOD + b'    def broken(:\n')
+        await asyncio.sleep(0.01)
+        assert reloaded == [] and not watcher.done()
+
+        # a pass that fails outright doesn't end it either
+        discover = manager.discovery.discover
+        def fail():
+            monkeypatch.setattr(manager.discovery, 'discover', discover)
+            raise OSError('gone')
+        monkeypatch.setattr(manager.discovery, 'discover', fail)
+        await asyncio.sleep(0.01)
+        assert not watcher.done()
+
+        write(tmp_path / 'watched.py', GOOD + b'\n    # fixed\n')
+        await asyncio.sleep(0.01)
+        watcher.cancel()
+
+    asyncio.run(run())
+    assert reloaded == ['watched']
+
+def test_starting_again_picks_up_edits_made_while_stopped(tmp_path, monkeypatch):
+    package = tmp_path / 'discovered'
+    package.mkdir()
+    write(package / '__init__.py', b'')
+    write(package / 'watched.py', GOOD + b'VERSION = 1\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    discovery = Discovery(str(package), 'discovered')
+    info = discovery.discover()['watched']
+    try:
+        first = discovery.load(info)
+        # unchanged, so the module already imported is reused
+        assert discovery.load(info) is first
+        write(package / 'watched.py', GOOD + b'VERSION = 2\n')
+        assert sys.modules['discovered.watched'].VERSION == 1
+        assert discovery.load(info) is not first and sys.modules['discovered.watched'].VERSION == 2
+    finally:
+        for name in ('discovered', 'discovered.watched'):
+            sys.modules.pop(name, None)
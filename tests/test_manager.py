@@ -0,0 +1,103 @@
+import asyncio
+
+from types import SimpleNamespace
+
+from module_manager import Manager
+from modules.utils import sql
+from modules.utils.discovery import ModuleInfo
+
+class StoppedPool:
+    async def stop(self):
+        self.stopped = True
+
+def make_manager(db, dbx, *names):
+    """A Manager with the given modules known, without a module server or discovery behind it"""
+    manager = Manager.__new__(Manager)
+    manager.config = {'uri': ['host', '1']}
+    manager.db = db
+    manager.dbx = dbx
+    manager.modules = dict((name.lower(), [ModuleInfo(name.lower(), name, {}, {}), None]) for name in names)
+    manager.processes = {}
+    manager.routes = {}
+    manager.commands = {}
+    return manager
+
+def test_stopping_a_module_drops_its_replica(db, dbx):
+    for url in ('host:1/mod', 'other:2/mod'):
+        sql.ModuleReplica.create(name='Mod', url=url)
+    manager = make_manager(db, dbx, 'Mod')
+    pool = manager.processes['mod'] = StoppedPool()
+
+    assert asyncio.run(manager.stop('mod'))
+    assert pool.stopped and not manager.processes
+    # other managers running it keep theirs
+    assert [r.url for r in sql.ModuleReplica.select()] == ['other:2/mod']
+
+def test_discovered_options_are_declared_before_the_module_starts(db, dbx):
+    manager = make_manager(db, dbx)
+    info = ModuleInfo('mod', 'Mod', {}, {'colour': 'blue'})
+    module = manager._module_row(info)
+    manager._module_row(info)
+    colour, = sql.OptionLookup.select()
+    assert (colour.option, colour.default, colour.module_id) == ('colour', 'blue', module.id)
+    # and starting it later keeps the same row, so anything servers set survives
+    sql.register_module('Mod', 'host:1/mod', {}, {'colour': 'blue', 'size': 1})
+    assert sorted(o.option for o in sql.OptionLookup.select()) == ['colour', 'size']
+    assert sql.OptionLookup.get(option='colour').id == colour.id
+
+class RoutedPool:
+    def __init__(self, name, commands, generation=0):
+        self.name = name
+        self.route = '/' + name.lower()
+        self.commands = frozenset(commands)
+        self.generation = generation
+        self.stopped = False
+
+    async def ready(self, timeout):
+        pass
+
+    async def stop(self):
+        self.stopped = True
+
+def test_resolve_rejects_unknown_routes_and_commands(db, dbx):
+    manager = make_manager(db, dbx, 'Mod')
+    pool = manager.processes['mod'] = RoutedPool('Mod', ['cmd'])
+    manager._rebuild_routes()
+    assert manager.resolve('/mod', 'cmd') is pool
+    # requests to /main may name any module's command
+    assert manager.resolve('/main', 'cmd') is pool
+    for route, act in [('/other', 'cmd'), ('/main', 'missing'), ('/mod', 'missing')]:
+        try:
+            manager.resolve(route, act)
+        except LookupError:
+            pass
+        else:
+            assert False, (route, act)
+
+def test_reloading_swaps_the_routes_to_the_new_generation(db, dbx):
+    manager = make_manager(db, dbx, 'Mod')
+    manager.config['reload_timeout'] = 1
+    manager.draining = set()
+    old = manager.processes['mod'] = RoutedPool('Mod', ['cmd', 'gone'])
+    manager._rebuild_routes()
+    new = RoutedPool('Mod', ['cmd', 'added'], generation=1)
+    manager.discovery = SimpleNamespace(discover=lambda: {'mod': manager.modules['mod'][0]})
+
+    async def start_pool(module_name, reload=False, generation=0):
+        assert reload and generation == 1
+        return new
+    manager._start_pool = start_pool
+
+    async def run():
+        assert await manager.reload('mod')
+        await asyncio.wait(manager.draining)
+
+    asyncio.run(run())
+    assert old.stopped and manager.processes['mod'] is new
+    assert manager.resolve('/mod', 'added') is new and manager.resolve('/main', 'cmd') is new
+    try:
+        manager.resolve('/main', 'gone')
+    except LookupError:
+        pass
+    else:
+        assert False
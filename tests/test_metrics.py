@@ -0,0 +1,30 @@
+from modules.utils.metrics import Histogram, Metrics
+
+def test_histogram_summary_is_within_bucket_precision():
+    h = Histogram()
+    for us in range(1, 1001):
+        h.record(us / 1000000)
+    s = h.summary()
+    assert s['count'] == 1000 and 499.5 <= s['mean'] <= 500.5
+    assert s['min'] == 1 and 1000 <= s['max'] < 1000 * 1.07
+    for p in (50, 90, 99):
+        assert p * 10 * 0.93 <= s['p{}'.format(p)] <= p * 10
+    assert Histogram().summary() == {'count': 0}
+
+def test_histogram_clamps_huge_values_into_the_last_bucket():
+    h = Histogram()
+    h.record(10 ** 6)
+    assert h.counts[-1] == 1
+
+def test_snapshot_and_render_include_counters_gauges_and_histograms():
+    m = Metrics()
+    m.incr('messages')
+    m.incr('messages', 2)
+    m.observe('latency', 0.002)
+    m.gauge('queue', lambda: {'depth': 4})
+    snap = m.snapshot()
+    assert snap['counters'] == {'messages': 3}
+    assert snap['gauges'] == {'queue.depth': 4}
+    lines = m.render(snap).splitlines()
+    assert 'messages 3' in lines and 'queue.depth 4' in lines
+    assert 'latency_count 1' in lines and 'latency_mean_us 2000' in lines
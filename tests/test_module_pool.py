@@ -0,0 +1,223 @@
+import asyncio
+
+import module_manager
+
+from module_manager import ModulePool
+from modules.utils import codec, metrics
+from modules.utils.moduletools import BaseModule, command
+
+from conftest import FakeWorker, bare_module
+
+class Plain(BaseModule):
+    @command
+    async def cmd(self, **ctx):
+        pass
+
+def make_pool(*workers, **settings):
+    pool = ModulePool(bare_module(Plain), **settings)
+    for worker in workers:
+        pool.workers[worker.wid] = worker
+    return pool
+
+async def supervise(pool, ticks=5):
+    """Runs a few rounds of the supervisor as though the feeder were still going"""
+    pool._feeder = asyncio.get_event_loop().create_future()
+    supervisor = asyncio.ensure_future(pool._supervise())
+    for i in range(ticks):
+        await asyncio.sleep(0)
+    supervisor.cancel()
+
+def queue(pool, rid, priority=1, deadline=None, sent=0.0):
+    """Puts a request in the backlog as request() would, returning its future"""
+    fut = asyncio.get_event_loop().create_future()
+    pool.pending[rid] = (fut, sent)
+    pool.backlog.put_nowait((priority, rid, deadline, [rid, 'cmd', [], {}]))
+    return fut
+
+async def feed(pool):
+    """Runs the feeder over whatever is queued, then stops it"""
+    pool.backlog.put_nowait((3, 1000, None, None))
+    await asyncio.wait_for(pool._feed(), 1)
+
+def test_feed_hands_each_request_to_the_least_loaded_worker():
+    busy, idle = FakeWorker(0, 100, 101), FakeWorker(1)
+
+    async def run():
+        pool = make_pool(busy, idle)
+        for rid in range(3):
+            queue(pool, rid)
+        await feed(pool)
+        return pool
+
+    asyncio.run(run())
+    assert idle.sent == [0, 1, None]
+    # tied at two each, so the first gets it
+    assert busy.sent == [2, None]
+    assert sorted(busy.assigned) == [2, 100, 101]
+
+def test_feed_waits_for_a_free_slot():
+    full = FakeWorker(0, 100)
+
+    async def run():
+        pool = make_pool(full)
+        pool.module.max_concurrency = 1
+        queue(pool, 0)
+        feeder = asyncio.ensure_future(feed(pool))
+        for i in range(5):
+            await asyncio.sleep(0)
+        assert full.sent == []
+        # as _dispatch does when a response comes back
+        full.assigned.pop(100)
+        pool._room.set()
+        await feeder
+
+    asyncio.run(run())
+    assert full.sent == [0, None]
+
+def test_retire_picks_the_least_busy_worker():
+    busy, quiet = FakeWorker(0, 100), FakeWorker(1)
+
+    async def run():
+        pool = make_pool(busy, quiet)
+        await pool._retire()
+        return pool
+
+    pool = asyncio.run(run())
+    assert quiet.retiring and quiet.sent == [None]
+    assert pool.active == [busy] and busy.sent == []
+
+def test_idle_pools_scale_down_to_min_workers():
+    busy, quiet, idle = FakeWorker(0, 100), FakeWorker(1), FakeWorker(2)
+
+    async def run():
+        pool = make_pool(busy, quiet, idle, min_workers=1, max_workers=3, scale_interval=0)
+        await supervise(pool, 10)
+        return pool
+
+    pool = asyncio.run(run())
+    # one a round, least busy first
+    assert pool.active == [busy] and busy.sent == []
+    assert quiet.sent == idle.sent == [None]
+
+def test_a_crashed_worker_fails_only_what_it_was_running():
+    crashed, retired, fine = FakeWorker(0, 1, 2), FakeWorker(1), FakeWorker(2, 3)
+    crashed.proc.exitcode = -9
+    retired.proc.exitcode = 0
+
+    async def run():
+        pool = make_pool(crashed, retired, fine)
+        futs = [queue(pool, rid) for rid in (1, 2, 3)]
+        pool._reap()
+        return pool, futs
+
+    pool, futs = asyncio.run(run())
+    assert list(pool.workers) == [2]
+    assert all(isinstance(f.exception(), RuntimeError) for f in futs[:2]) and not futs[2].done()
+    assert sorted(pool.pending) == [3] and not crashed.assigned
+    # workers that exit cleanly were retired, not crashed
+    assert pool.restarts == 1
+
+def test_restarts_back_off_after_repeated_crashes(monkeypatch, clock):
+    monkeypatch.setattr(module_manager, 'monotonic', clock)
+    spawned = []
+
+    async def run():
+        pool = make_pool(min_workers=1, scale_interval=0, restart_backoff=1, max_restart_backoff=3)
+        pool._spawn = lambda: spawned.append(clock.now)
+        delays = []
+        for i in range(4):
+            pool._crashed()
+            delays.append(pool._next_restart - clock.now)
+        assert delays == [1, 2, 3, 3]
+        # nothing is started again until the backoff is up
+        await supervise(pool)
+        assert spawned == []
+        clock.now = 3
+        await supervise(pool, 3)
+        return pool
+
+    asyncio.run(run())
+    assert spawned[0] == 3
+
+def test_a_wedged_worker_is_killed_and_its_requests_failed():
+    wedged = FakeWorker(0, 1)
+    wedged.heartbeat_age = 60
+
+    async def run():
+        pool = make_pool(wedged, scale_interval=0, heartbeat_timeout=10)
+        pool._spawn = lambda: None
+        fut = queue(pool, 1)
+        await supervise(pool, 2)
+        return pool, fut
+
+    pool, fut = asyncio.run(run())
+    assert wedged.proc.killed and not pool.workers
+    assert isinstance(fut.exception(), RuntimeError) and pool.restarts == 1
+
+def test_feed_runs_the_most_urgent_then_oldest_first():
+    worker = FakeWorker(0)
+
+    async def run():
+        pool = make_pool(worker)
+        queue(pool, 0, codec.LOW)
+        queue(pool, 1, codec.NORMAL)
+        queue(pool, 2, codec.HIGH)
+        queue(pool, 3, codec.NORMAL)
+        await feed(pool)
+
+    asyncio.run(run())
+    assert worker.sent == [2, 1, 3, 0, None]
+
+def test_requests_past_their_deadline_are_dropped_unrun(monkeypatch, clock):
+    monkeypatch.setattr(module_manager, 'monotonic', clock)
+    worker = FakeWorker(0)
+
+    async def run():
+        pool = make_pool(worker, metrics=metrics.Metrics())
+        clock.now = 10
+        late = queue(pool, 0, deadline=5, sent=1)
+        on_time = queue(pool, 1, deadline=20)
+        # given up on by the caller while queued
+        queue(pool, 2)
+        pool.pending.pop(2)
+        await feed(pool)
+        return pool, late, on_time
+
+    pool, late, on_time = asyncio.run(run())
+    assert worker.sent == [1, None]
+    assert isinstance(late.exception(), TimeoutError) and not on_time.done()
+    assert pool.expired == 1 and pool.health()['expired'] == 1
+    assert pool.metrics.snapshot()['counters']['manager.Plain.expired'] == 1
+
+def test_feed_skips_workers_that_died_before_being_reaped():
+    dead, alive = FakeWorker(0), FakeWorker(1, 100, 101)
+    dead.proc.exitcode = -9
+
+    async def run():
+        pool = make_pool(dead, alive)
+        futs = [queue(pool, rid) for rid in range(2)]
+        await feed(pool)
+        return futs
+
+    futs = asyncio.run(run())
+    assert dead.sent == [] and alive.sent == [0, 1, None]
+    assert not any(f.done() for f in futs)
+
+def test_requests_wait_for_a_dead_workers_replacement():
+    dead, replacement = FakeWorker(0), FakeWorker(1)
+    dead.proc.exitcode = -9
+
+    async def run():
+        pool = make_pool(dead)
+        queue(pool, 0)
+        feeder = asyncio.ensure_future(feed(pool))
+        for i in range(5):
+            await asyncio.sleep(0)
+        assert dead.sent == [] and not feeder.done()
+        # as _spawn does on restart
+        pool.workers[replacement.wid] = replacement
+        pool._room.set()
+        await feeder
+
+    asyncio.run(run())
+    assert dead.sent == [] and replacement.sent == [0, None]
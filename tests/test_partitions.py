@@ -0,0 +1,68 @@
+import datetime
+import os
+import threading
+
+from modules.utils import sql
+
+from conftest import make_server
+
+def rows(*stamps, channel=10, author=100):
+    return [{'id': i, 'content': str(i), 'timestamp': when, 'channel': channel, 'author': author}
+            for i, when in enumerate(stamps, 1)]
+
+def write(rows):
+    for model, part in sql.partition_messages(rows):
+        model.insert_many(part).execute()
+
+def test_partition_messages_groups_by_month(db):
+    groups = sql.partition_messages(rows(datetime.datetime(2020, 1, 31), datetime.datetime(2020, 2, 1),
+                                         datetime.datetime(2020, 1, 1)))
+    assert sorted((m._meta.table_name, [r['id'] for r in part]) for m, part in groups) == [
+        ('message_202001', [1, 3]), ('message_202002', [2])]
+    # the same model every time a month comes up
+    assert sql.message_partition(datetime.datetime(2020, 1, 5)) is groups[0][0]
+
+def test_partitions_accept_messages_from_unsynced_channels(db):
+    write(rows(datetime.datetime(2020, 1, 1), channel=12345, author=678))
+    assert sql.recent_messages(12345)[0]['id'] == 1
+
+def test_recent_messages_reads_back_across_partitions(db):
+    make_server()
+    write(rows(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 2, 1), datetime.datetime(2020, 3, 1)))
+    assert [m['id'] for m in sql.recent_messages(10)] == [3, 2, 1]
+    assert [m['id'] for m in sql.recent_messages(10, limit=2)] == [3, 2]
+    assert [m['id'] for m in sql.recent_messages(10, before=datetime.datetime(2020, 2, 15))] == [2, 1]
+
+def test_prune_archives_and_drops_old_partitions(db, tmp_path):
+    make_server()
+    write(rows(datetime.datetime(2019, 1, 1), datetime.datetime(2020, 6, 1)))
+    sql.Message.create(id=50, content='old', timestamp=datetime.datetime(2018, 1, 1), channel=10, author=100)
+    result = sql.prune_messages(keep_months=12, archive_dir=str(tmp_path / 'archive'),
+                                now=datetime.datetime(2020, 6, 15))
+    assert result == {'dropped': ['message_201901'], 'deleted': 1}
+    assert 'message_201901' not in db.get_tables()
+    assert os.path.exists(tmp_path / 'archive' / 'message_201901.db')
+    assert [m['id'] for m in sql.recent_messages(10)] == [2]
+
+def test_partitions_can_be_listed_while_others_are_dropped(db):
+    for month in range(1, 13):
+        sql.message_partition(datetime.datetime(2019, month, 1))
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                sql.message_partitions()
+            except RuntimeError as e:
+                errors.append(e)
+                return
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        sql.prune_messages(keep_months=1, now=datetime.datetime(2020, 6, 15))
+    finally:
+        stop.set()
+        thread.join()
+    assert errors == [] and sql.message_partitions() == []
@@ -0,0 +1,80 @@
+import asyncio
+
+import websockets
+
+from modules.utils import codec
+from modules.utils.balancer import NotRunning, RequestLost
+from modules.utils.pool import ModuleConnection
+
+class FakeSocket:
+    """Hands out the given frames, then closes"""
+
+    def __init__(self, *frames, closed=False):
+        self.frames = list(frames)
+        self.open = not closed
+
+    async def send(self, data):
+        if not self.open:
+            raise websockets.ConnectionClosed(None, None)
+
+    async def recv(self):
+        if not self.frames:
+            raise websockets.ConnectionClosed(None, None)
+        return self.frames.pop(0)
+
+def test_responses_are_matched_by_id_in_any_order():
+    async def run():
+        conn = ModuleConnection('host:1')
+        sock = FakeSocket(codec.DEFAULT.encode(codec.reply(2, 'two')), codec.DEFAULT.encode(codec.reply(1, error='bad')))
+        loop = asyncio.get_event_loop()
+        one, two = loop.create_future(), loop.create_future()
+        conn.pending = {1: (sock, one), 2: (sock, two)}
+        await conn._read(sock, codec.DEFAULT)
+        return one, two
+    one, two = asyncio.run(run())
+    assert two.result() == 'two'
+    assert isinstance(one.exception(), RuntimeError)
+
+def test_losing_a_socket_only_fails_what_was_sent_on_it():
+    async def run():
+        conn = ModuleConnection('host:1')
+        old, new = FakeSocket(), FakeSocket()
+        loop = asyncio.get_event_loop()
+        lost, fine = loop.create_future(), loop.create_future()
+        lost_chunks, fine_chunks = asyncio.Queue(), asyncio.Queue()
+        conn.pending = {1: (old, lost), 2: (new, fine)}
+        conn.streams = {3: (old, lost_chunks), 4: (new, fine_chunks)}
+        conn.websocket = new
+        await conn._read(old, codec.DEFAULT)
+        return conn, lost, fine, lost_chunks, fine_chunks, new
+    conn, lost, fine, lost_chunks, fine_chunks, new = asyncio.run(run())
+    assert isinstance(lost.exception(), RequestLost)
+    assert not fine.done()
+    assert lost_chunks.get_nowait()[0] == 'error' and fine_chunks.empty()
+    # and the reconnected socket stays in use
+    assert conn.websocket is new
+
+def test_a_request_that_never_went_out_can_be_retried():
+    async def run():
+        conn = ModuleConnection('host:1')
+        conn.websocket = FakeSocket(closed=True)
+        # _connect would hand back the socket it has, which closes before the send
+        async def connect():
+            return conn.websocket
+        conn._connect = connect
+        try:
+            await conn.request('cmd')
+        except Exception as e:
+            return e
+    e = asyncio.run(run())
+    assert isinstance(e, ConnectionError) and not isinstance(e, RequestLost)
+
+def test_a_replica_that_stopped_the_module_answers_with_not_running():
+    async def run():
+        conn = ModuleConnection('host:1')
+        sock = FakeSocket(codec.DEFAULT.encode(codec.reply(1, error='NotRunning: No module is running at /m')))
+        fut = asyncio.get_event_loop().create_future()
+        conn.pending = {1: (sock, fut)}
+        await conn._read(sock, codec.DEFAULT)
+        return fut
+    assert isinstance(asyncio.run(run()).exception(), NotRunning)
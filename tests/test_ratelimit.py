@@ -0,0 +1,61 @@
+import pytest
+
+from modules.utils.ratelimit import RateLimiter, RateLimits
+
+def test_bucket_refills_at_rate_up_to_burst():
+    limiter = RateLimiter(rate=1.0, burst=2)
+    assert limiter.allow('a', now=0) and limiter.allow('a', now=0)
+    assert not limiter.allow('a', now=0)
+    assert limiter.allow('a', now=1.0)
+    assert not limiter.allow('a', now=1.0)
+    # never more than burst, however long it sat
+    assert limiter.allow('a', now=100) and limiter.allow('a', now=100) and not limiter.allow('a', now=100)
+
+def test_idle_buckets_are_evicted_oldest_first():
+    limiter = RateLimiter(rate=1.0, burst=1, idle=10)
+    limiter.allow('a', now=0)
+    limiter.allow('b', now=5)
+    assert limiter.evict(now=12) == 1
+    assert list(limiter.buckets) == ['b']
+
+def limits():
+    return RateLimits(user={'rate': 1.0, 'burst': 2}, server={'rate': 1.0, 'burst': 5})
+
+def test_defaults_and_overrides():
+    rl = limits()
+    assert rl.defaults() == {'rate_limit.user.rate': 1.0, 'rate_limit.user.burst': 2,
+                             'rate_limit.server.rate': 1.0, 'rate_limit.server.burst': 5}
+    assert rl.set_option('s', 'rate_limit.user.burst', '3')
+    assert rl.overrides == {'s': {'user': (1.0, 3.0)}}
+    assert not rl.set_option('s', 'rate_limit.channel.rate', '1')
+    assert not rl.set_option('s', 'some_module_option', 'x')
+
+@pytest.mark.parametrize('option, value', [
+    ('rate_limit.user.rate', 'abc'), ('rate_limit.user.rate', '0'), ('rate_limit.user.rate', '-1'),
+    ('rate_limit.user.rate', 'inf'), ('rate_limit.user.rate', 'nan'), ('rate_limit.user.burst', '0.5'),
+    ('rate_limit.server.burst', None)
+])
+def test_bad_values_are_rejected_without_changing_anything(option, value):
+    rl = limits()
+    with pytest.raises(ValueError):
+        rl.parse_option(option, value)
+    with pytest.raises(ValueError):
+        rl.set_option('s', option, value)
+    assert rl.overrides.get('s', {}) == {}
+
+def test_allow_checks_every_scope():
+    rl = limits()
+    assert rl.allow('u', 'cmd', 'c', 's') and rl.allow('u', 'cmd', 'c', 's')
+    assert not rl.allow('u', 'cmd', 'c', 's')
+    # someone else in the same server still has room
+    assert rl.allow('v', 'cmd', 'c', 's')
+
+def test_denial_in_a_wider_scope_costs_nothing_in_the_narrower_ones():
+    rl = RateLimits(user={'rate': 0.001, 'burst': 3}, server={'rate': 0.001, 'burst': 1})
+    assert rl.allow('u', 'cmd', 'c', 's')
+    # the server is out of tokens, so these are all turned away...
+    for i in range(5):
+        assert not rl.allow('u', 'cmd', 'c', 's')
+    # ...without touching u's own bucket, which still has the two left over from the first
+    assert rl.limiters['user'].buckets['u'][0] == pytest.approx(2, abs=0.01)
+    assert rl.allow('u', 'cmd', 'c', 's2') and rl.allow('u', 'cmd', 'c', 's3')
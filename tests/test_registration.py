@@ -0,0 +1,51 @@
+from modules.utils import sql
+from modules.utils.moduletools import BaseModule
+
+from conftest import make_server
+
+def spec(help=None, requires=(), permissions=()):
+    return {'help': help, 'requires': list(requires), 'permissions': list(permissions), 'cache': None}
+
+COMMANDS = {'keep': spec('old help', requires=['author.name']), 'drop': spec()}
+OPTIONS = {'kept': 'a', 'dropped': 'b'}
+
+def register(commands=COMMANDS, options=OPTIONS):
+    return sql.register_module('Mod', 'host:1/mod', commands, options)
+
+def test_unchanged_manifests_write_nothing(db, monkeypatch):
+    module = register()
+    queries = []
+    original = db.obj.execute_sql
+    monkeypatch.setattr(db.obj, 'execute_sql', lambda q, *args, **kwargs: queries.append(q) or original(q, *args, **kwargs))
+    assert register().id == module.id
+    monkeypatch.undo()
+    assert queries and all(q.lstrip().upper().startswith('SELECT') for q in queries)
+    assert sql.Module.get_by_id(module.id).manifest_hash == sql.manifest_hash(COMMANDS, OPTIONS)
+
+def test_changed_manifests_keep_rows_for_what_still_exists(db):
+    make_server()
+    module = register()
+    keep = sql.Command.get(name='keep')
+    drop = sql.Command.get(name='drop')
+    kept = sql.OptionLookup.get(option='kept')
+    dropped = sql.OptionLookup.get(option='dropped')
+    for command in (keep, drop):
+        sql.Whitelist.create(module=module, command=command, server=1, channel=10)
+    sql.ServerOption.create(option=kept, value='set', server=1)
+    sql.ServerOption.create(option=dropped, value='set', server=1)
+
+    register({'keep': spec('new help', requires=['server.name']), 'new': spec()}, {'kept': 'c', 'new': 'd'})
+
+    assert sql.Command.get(name='keep').id == keep.id and sql.Command.get(name='keep').help == 'new help'
+    assert sorted(c.name for c in sql.Command.select()) == ['keep', 'new']
+    assert [r.attr for r in sql.RequiredContext.select().where(sql.RequiredContext.command == keep)] == ['server.name']
+    assert [w.command_id for w in sql.Whitelist.select()] == [keep.id]
+    assert sql.OptionLookup.get(option='kept').id == kept.id and sql.OptionLookup.get(option='kept').default == 'c'
+    assert sorted(o.option for o in sql.OptionLookup.select()) == ['kept', 'new']
+    assert [(o.option_id, o.value) for o in sql.ServerOption.select()] == [(kept.id, 'set')]
+
+def test_constructing_a_module_reuses_the_database(db, tmp_path):
+    inner = db.obj
+    module = BaseModule(config={'database_url': 'sqlite:///{}'.format(tmp_path / 'test.db'), 'uri': ['host', '1']})
+    assert module.db is db and db.obj is inner
+    assert sql.Module.get(name='BaseModule').url == 'host:1/basemodule'
@@ -0,0 +1,126 @@
+import asyncio
+
+from module_manager import ModulePool, Stream
+from modules.utils import cache
+from modules.utils.cache import LRUCache, MISSING
+from modules.utils.discovery import parse
+from modules.utils.moduletools import BaseModule, cacheable, command, ref, result_key
+from modules.utils.router import Router
+
+from conftest import answer, bare_module
+
+def test_entries_expire_after_their_own_ttl(monkeypatch, clock):
+    monkeypatch.setattr(cache, 'monotonic', clock)
+    c = LRUCache(maxsize=10, ttl=100)
+    c.set('short', 1, ttl=5)
+    c.set('long', 2)
+    clock.now = 6
+    assert c.get('short') is MISSING and c.get('long') == 2
+    assert (c.hits, c.misses) == (1, 1)
+
+def test_least_recently_used_goes_first():
+    c = LRUCache(maxsize=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert c.get('b') is MISSING and c.get('a') == 1 and c.get('c') == 3
+
+def test_invalidate_if_drops_only_matching_keys():
+    c = LRUCache()
+    for key in [('M', '1', 'cmd'), ('M', '2', 'cmd'), ('N', '1', 'cmd')]:
+        c.set(key, 'x')
+    c.invalidate_if(lambda key: key[0] == 'M' and key[1] == '1')
+    assert sorted(c.data) == [('M', '2', 'cmd'), ('N', '1', 'cmd')]
+
+def test_result_key_covers_server_args_and_named_context():
+    spec = cacheable(ttl=10, key=('author.id',))(lambda: None).cache
+    ctx = {'server.id': '1', 'channel.id': '2', 'author.id': '3'}
+    key = result_key('cmd', ['a', 'b'], ctx, spec)
+    assert key == ('1', 'cmd', ('a', 'b'), '3')
+    # the channel isn't part of it, since responses name it with ref()
+    assert result_key('cmd', ['a', 'b'], dict(ctx, **{'channel.id': '9'}), spec) == key
+    assert result_key('cmd', ['a', 'b'], dict(ctx, **{'author.id': '4'}), spec) != key
+    hash(key)
+
+class Cached(BaseModule):
+    @command
+    @cacheable(ttl=30, key=('author.id',))
+    async def lookup(self, *args, **ctx):
+        return ['send_message', ref('channel'), 'x']
+
+    @command
+    async def plain(self, **ctx):
+        return ['send_message', ref('channel'), 'y']
+
+SOURCE = b'''
+from modules.utils.moduletools import BaseModule, command, cacheable
+class Cached(BaseModule):
+    @command
+    @cacheable(ttl=30, key=('author.id',))
+    async def lookup(self, *args, **ctx):
+        pass
+
+    @command
+    async def plain(self, **ctx):
+        pass
+
+    @command
+    @cacheable(ttl=TTL)
+    async def dynamic(self, **ctx):
+        pass
+'''
+
+def test_manifest_and_discovery_agree_on_cache_specs():
+    manifest = Cached.manifest()
+    assert manifest['lookup']['cache'] == {'ttl': 30, 'key': ['author.id']}
+    assert manifest['plain']['cache'] is None
+    info, = parse(SOURCE, 'cached')
+    assert info.commands['lookup']['cache'] == manifest['lookup']['cache']
+    assert info.commands['plain']['cache'] is None
+    # can't be known without running the module, so it isn't cached
+    assert info.commands['dynamic']['cache'] is None
+
+def test_routes_carry_the_cache_spec():
+    router = Router('!')
+    router.register('Cached', 'host:1/cached', Cached.manifest())
+    assert router.commands['lookup'].cache == {'ttl': 30, 'key': ['author.id']}
+    assert router.commands['plain'].cache is None
+
+def test_manager_pool_answers_repeats_from_its_cache():
+    ctx = {'server.id': '1', 'channel.id': '2', 'author.id': '3'}
+    response = ['send_message', {'ref': 'channel'}, 'x']
+
+    async def run():
+        pool = ModulePool(bare_module(Cached))
+        first, _ = await asyncio.gather(pool.request('lookup', ['a'], dict(ctx)), answer(pool, response))
+        second = await pool.request('lookup', ['a'], dict(ctx))
+        assert pool.backlog.empty()
+        stream = Stream()
+        assert await pool.request('lookup', ['a'], dict(ctx), stream) == response
+        # a different author is a different entry
+        await asyncio.gather(pool.request('lookup', ['a'], dict(ctx, **{'author.id': '4'})), answer(pool, response))
+        pool.invalidate_results('1')
+        await asyncio.gather(pool.request('lookup', ['a'], dict(ctx)), answer(pool, response))
+        # commands that aren't @cacheable always go to a worker
+        await asyncio.gather(pool.request('plain', [], dict(ctx)), answer(pool, response))
+        await asyncio.gather(pool.request('plain', [], dict(ctx)), answer(pool, response))
+        return pool, first, second
+
+    pool, first, second = asyncio.run(run())
+    assert first == second == response
+    assert pool.health()['cache_hits'] == 2 and pool.health()['cache_misses'] == 3
+
+def test_manager_pool_streams_commands_that_are_not_cacheable():
+    response = ['send_message', {'ref': 'channel'}, 'y']
+
+    async def run():
+        pool = ModulePool(bare_module(Cached))
+        # the client streams every command, so these don't get a chunk list made for them
+        result, _ = await asyncio.gather(pool.request('plain', [], {'server.id': '1'}, Stream()),
+                                         answer(pool, response))
+        return pool, result
+
+    pool, result = asyncio.run(run())
+    assert result == response
+    assert not pool.collected and not pool.streams and len(pool.results) == 0
@@ -0,0 +1,56 @@
+from modules.utils.moduletools import HANDLES, ref
+from modules.utils.router import PrefixTrie, Router, context_extractor
+
+class Obj:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+def message():
+    server = Obj(id='1', name='a server', owner=Obj(id='2', name='owner'))
+    return Obj(id='3', content='!cmd', server=server, channel=Obj(id='4', name='general', server=server),
+               author=Obj(id='5', name='someone'))
+
+def test_trie_matches_the_longest_prefix():
+    trie = PrefixTrie(('!', '!!', '?p ', ''))
+    assert trie.match('!!cmd') == '!!'
+    assert trie.match('!cmd') == '!'
+    assert trie.match('?p cmd') == '?p '
+    assert trie.match('?pcmd') is None
+    assert trie.match('cmd') is None
+
+def test_router_parses_per_server_prefixes():
+    router = Router('!')
+    router.set_prefix('1', '$')
+    assert router.parse('1', '$roll 1 6') == ('$', 'roll', ['1', '6'])
+    assert router.parse('1', '!roll') == ('!', 'roll', [])
+    assert router.parse(None, '$roll') is None
+    router.forget_server('1')
+    assert not router.has_server('1')
+
+def test_register_replaces_a_modules_commands():
+    router = Router('!')
+    router.register('M', 'a:1', {'old': {'requires': [], 'permissions': []}})
+    router.register('M', 'a:2', {'new': {'requires': ['author.name'], 'permissions': ['admin']}})
+    assert 'old' not in router.commands
+    route = router.commands['new']
+    assert (route.url, route.required_context, route.permissions) == ('a:2', ('author.name',), ('admin',))
+    router.unregister('M')
+    assert router.commands == {}
+
+def test_extractor_builds_context_and_is_shared():
+    extract = context_extractor(('server.owner.name', 'channel.id'))
+    assert extract is context_extractor(('server.owner.name', 'channel.id'))
+    assert extract(message()) == {'server.id': '1', 'message.id': '3', 'channel.id': '4',
+                                  'server.owner.name': 'owner'}
+
+def test_handles_resolve_against_the_message():
+    m = message()
+    assert ref('channel') == {'ref': 'channel'}
+    assert HANDLES['message'](m) is m
+    assert HANDLES['author'](m) is m.author
+    try:
+        ref('nope')
+    except ValueError:
+        pass
+    else:
+        assert False
@@ -0,0 +1,103 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+
+from module_manager import ModulePool
+from modules.utils.moduletools import BaseModule, command
+from modules.utils.shm import SharedRing
+
+from conftest import FakeWorker, bare_module
+
+class Plain(BaseModule):
+    @command
+    async def cmd(self, **ctx):
+        pass
+
+def test_payloads_round_trip_and_space_is_reclaimed():
+    ring = SharedRing(256)
+    try:
+        refs = [ring.write(pickle.dumps(['x' * 40, i])) for i in range(3)]
+        assert None not in refs
+        # full until the oldest block is released, whatever order the rest go in
+        assert ring.write(b'y' * 100) is None
+        assert ring.load(refs[1]) == ['x' * 40, 1]
+        assert ring.write(b'y' * 100) is None
+        assert ring.load(refs[0]) == ['x' * 40, 0]
+        big = ring.write(pickle.dumps('z' * 100))
+        assert big is not None
+        assert ring.load(refs[2]) == ['x' * 40, 2]
+        assert ring.load(big) == 'z' * 100
+    finally:
+        ring.close()
+
+def test_wraps_around_and_rejects_oversized_payloads():
+    ring = SharedRing(128)
+    try:
+        assert ring.write(b'x' * 200) is None
+        for i in range(20):
+            ref = ring.write(pickle.dumps(i))
+            assert ring.load(ref) == i
+    finally:
+        ring.close()
+
+def in_child(target, *args):
+    """Runs target in a forked process that then dies without cleaning up"""
+    proc = multiprocessing.get_context('fork').Process(target=target, args=args)
+    proc.start()
+    proc.join()
+    return proc.pid
+
+def write_and_die(ring):
+    ring.write(b'x' * 100)
+    os._exit(1)
+
+def lock_and_die(ring):
+    ring._acquire()
+    os._exit(1)
+
+def test_blocks_a_dead_writer_never_queued_are_freed():
+    ring = SharedRing(128)
+    try:
+        pid = in_child(write_and_die, ring)
+        # its block was never handed on, so nothing would ever release it
+        assert ring.write(b'y' * 100) is None
+        assert ring.release_owner(pid) == 1
+        assert ring.load(ring.write(pickle.dumps('y' * 50))) == 'y' * 50
+    finally:
+        ring.close()
+
+def test_a_lock_held_by_a_dead_process_times_out_then_is_recovered():
+    ring = SharedRing(256, lock_timeout=0.05)
+    try:
+        ref = ring.write(pickle.dumps(1))
+        pid = in_child(lock_and_die, ring)
+        assert ring.release(ref) is False and ring.write(b'x') is None
+        assert ring.lock_timeouts == 2
+        ring.release_owner(pid)
+        assert ring.load(ref) == 1
+        assert ring.load(ring.write(pickle.dumps(2))) == 2
+    finally:
+        ring.close()
+
+def test_reaping_a_worker_frees_its_blocks_once_its_queue_is_drained():
+    pool = ModulePool(bare_module(Plain), shm_size=128)
+    worker = FakeWorker(0)
+    pool.workers[0] = worker
+
+    async def run():
+        worker.proc.pid = in_child(write_and_die, pool.ring)
+        worker.proc.exitcode = 1
+        worker.dispatcher = asyncio.get_event_loop().create_future()
+        pool._reap()
+        await asyncio.sleep(0)
+        # still draining, so whatever it queued may yet be loaded
+        assert pool.ring.reclaimed == 0
+        worker.dispatcher.set_result(None)
+        await asyncio.sleep(0)
+
+    try:
+        asyncio.run(run())
+        assert pool.ring.reclaimed == 1 and pool.health()['shm_reclaimed'] == 1
+    finally:
+        pool.ring.close()
@@ -0,0 +1,141 @@
+import asyncio
+
+from module_manager import Manager, ModulePool, Stream
+from modules.utils import codec, metrics
+from modules.utils.moduletools import BaseModule, cacheable, command, ref
+
+from conftest import Control, FakeQueue, FakeWorker, answer, bare_module
+
+class Streamer(BaseModule):
+    closed = False
+
+    @command
+    async def lines(self, **ctx):
+        try:
+            n = 0
+            while True:
+                yield ['send_message', ref('channel'), str(n)]
+                n += 1
+        finally:
+            Streamer.closed = True
+
+    @command
+    @cacheable(ttl=30)
+    async def cached_lines(self, **ctx):
+        yield ['send_message', ref('channel'), 'x']
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(codec.DEFAULT.decode(data))
+
+def drain(stream):
+    chunks = []
+    while not stream.chunks.empty():
+        chunks.append(stream.chunks.get_nowait())
+    return chunks
+
+def test_pool_forwards_chunks_of_commands_that_are_not_cacheable():
+    async def run():
+        pool = ModulePool(bare_module(Streamer))
+        worker = FakeWorker()
+        stream = Stream()
+        result, _ = await asyncio.gather(pool.request('lines', [], {}, stream),
+                                         answer(pool, chunks=['a', 'b'], worker=worker))
+        # without a stream they all come back at the end, and the worker is credited for each
+        gathered, _ = await asyncio.gather(pool.request('lines', [], {}),
+                                           answer(pool, chunks=['c', 'd'], worker=worker))
+        return pool, worker, stream, result, gathered
+
+    pool, worker, stream, result, gathered = asyncio.run(run())
+    assert result is None and drain(stream) == ['a', 'b']
+    assert gathered == ['c', 'd']
+    assert [m[0] for m in worker.control.sent] == ['credit', 'credit']
+    assert not pool.collected and not pool.streams and len(pool.results) == 0
+
+def test_pool_streams_and_replays_cacheable_commands():
+    async def run():
+        pool = ModulePool(bare_module(Streamer))
+        first, second = Stream(), Stream()
+        await asyncio.gather(pool.request('cached_lines', [], {'server.id': '1'}, first),
+                             answer(pool, chunks=['x', 'y']))
+        await pool.request('cached_lines', [], {'server.id': '1'}, second)
+        return pool, first, second
+
+    pool, first, second = asyncio.run(run())
+    assert drain(first) == drain(second) == ['x', 'y']
+    assert pool.results.hits == 1 and pool.backlog.empty()
+
+def test_giving_up_on_a_stream_cancels_it_on_the_worker():
+    async def run():
+        pool = ModulePool(bare_module(Streamer))
+        worker = FakeWorker()
+        stream = Stream()
+        request = asyncio.ensure_future(pool.request('lines', [], {}, stream))
+        await asyncio.sleep(0)
+        priority, rid, deadline, item = pool.backlog.get_nowait()
+        stream.worker = worker
+        pool._chunk(worker, rid, 'a')
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+        return pool, worker, rid
+
+    pool, worker, rid = asyncio.run(run())
+    assert worker.control.sent == [['cancel', rid]]
+    assert not pool.pending and not pool.streams
+
+def test_cancel_stops_the_generator():
+    module = bare_module(Streamer, stream_window=2, _credits={}, out_queue=FakeQueue())
+    control = Control()
+    Streamer.closed = False
+
+    async def run():
+        listener = asyncio.ensure_future(module._listen(control))
+        task = asyncio.ensure_future(module._stream(7, module.lines.func(module)))
+        # runs until the window is used up, then waits on credit
+        for i in range(5):
+            await asyncio.sleep(0)
+        assert len(module.out_queue.items) == 2 and not task.done()
+        control.queue.put_nowait(['credit', 7, 1])
+        for i in range(5):
+            await asyncio.sleep(0)
+        control.queue.put_nowait(['cancel', 7])
+        await asyncio.wait_for(task, 1)
+        control.queue.put_nowait(None)
+        await listener
+
+    asyncio.run(run())
+    assert [item[2][2] for item in module.out_queue.items] == ['0', '1', '2']
+    assert Streamer.closed and not module._credits and not module._cancelled
+
+def test_manager_forwards_chunks_and_cancels():
+    manager = Manager.__new__(Manager)
+    manager.metrics = metrics.Metrics()
+
+    async def run():
+        pool = ModulePool(bare_module(Streamer))
+        ws = FakeSocket()
+        streams = {}
+        worker = FakeWorker()
+        result, _ = await asyncio.gather(
+            manager._stream(ws, codec.DEFAULT, 5, pool, 'lines', [], {}, streams),
+            answer(pool, 'done', ['a', 'b'], worker))
+        assert not streams
+
+        # a cancel frame from the client ends the request, which tells the worker to stop
+        task = asyncio.ensure_future(manager._stream(ws, codec.DEFAULT, 6, pool, 'lines', [], {}, streams))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        priority, rid, deadline, item = pool.backlog.get_nowait()
+        pool.streams[rid].worker = worker
+        await manager.dispatch(ws, codec.DEFAULT, '/streamer', codec.DEFAULT.encode(codec.cancel(6)), streams)
+        cancelled = await asyncio.gather(task, return_exceptions=True)
+        return ws, result, worker, rid, cancelled
+
+    ws, result, worker, rid, cancelled = asyncio.run(run())
+    assert result == 'done'
+    assert ws.sent == [codec.chunk(5, 'a'), codec.chunk(5, 'b')]
+    assert isinstance(cancelled[0], asyncio.CancelledError)
+    assert worker.control.sent == [['cancel', rid]]
@@ -0,0 +1,31 @@
+from modules.utils import sql
+
+def gateway(*servers):
+    """users, servers and channels rows as the client builds them, from (server id, owner id, channel ids)"""
+    users = [{'id': owner, 'name': 'owner{}'.format(owner), 'bot': False} for s, owner, chans in servers]
+    rows = [{'id': s, 'name': 'server{}'.format(s), 'owner': owner} for s, owner, chans in servers]
+    channels = [{'id': c, 'name': 'channel{}'.format(c), 'server': s} for s, owner, chans in servers for c in chans]
+    return users, rows, channels
+
+def test_sync_only_writes_missing_or_changed_rows(db):
+    stats = sql.sync_servers(*gateway((1, 100, [10, 11]), (2, 200, [20])))
+    assert (stats['users'], stats['servers'], stats['channels']) == (2, 2, 3)
+    assert sql.sync_servers(*gateway((1, 100, [10, 11]), (2, 200, [20])))['channels'] == 0
+
+    users, servers, channels = gateway((1, 100, [10, 11]), (2, 200, [20]))
+    servers[0]['name'] = 'renamed'
+    channels[2]['name'] = 'renamed'
+    stats = sql.sync_servers(users, servers, channels)
+    assert (stats['users'], stats['servers'], stats['channels']) == (0, 1, 1)
+    assert sql.Server.get_by_id(1).name == sql.Channel.get_by_id(20).name == 'renamed'
+
+def test_prune_drops_servers_left_and_channels_deleted(db):
+    sql.sync_servers(*gateway((1, 100, [10, 11]), (2, 200, [20]), (3, 300, [30])))
+    stats = sql.sync_servers(*gateway((1, 100, [10])), prune=True, keep=[3])
+    assert stats['deleted_servers'] == [2] and stats['deleted_channels'] == [11]
+    assert sorted(s.id for s in sql.Server.select()) == [1, 3]
+    # a server we couldn't read keeps everything hanging off it
+    assert sql.Channel.get_or_none(id=30) is not None
+    # without prune nothing goes
+    assert sql.sync_servers(*gateway())['deleted_servers'] == []
+    assert sql.Server.select().count() == 2
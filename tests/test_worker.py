@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from module_manager import Manager, ModulePool
+from modules.utils.cache import MISSING
+from modules.utils.discovery import ModuleInfo
+from modules.utils.moduletools import BaseModule, command
+
+from conftest import Control, FakeWorker, bare_module
+
+class Worked(BaseModule):
+    @command
+    async def slow(self, **ctx):
+        await self.release.wait()
+        return 'slow'
+
+    @command
+    def blocking(self, **ctx):
+        return threading.current_thread().name
+
+class JoinableQueue:
+    """Hands out the given items and records what the worker does with them, in order"""
+
+    def __init__(self, log, *items):
+        self.log = log
+        self.items = asyncio.Queue()
+        for item in items:
+            self.items.put_nowait(item)
+
+    async def coro_get(self):
+        return await self.items.get()
+
+    async def coro_put(self, item):
+        self.log.append(('put', item[1], item[2]))
+
+    def task_done(self):
+        self.log.append(('task_done',))
+
+def run_worker(module, *items):
+    log = []
+
+    async def run():
+        module.release = asyncio.Event()
+        module.in_queue = JoinableQueue(log, *items)
+        module.out_queue = module.in_queue
+        main = asyncio.ensure_future(module.main())
+        # everything but the slow command gets to answer
+        while sum(entry[0] == 'put' for entry in log) < len(items) - 2:
+            await asyncio.sleep(0.01)
+        for i in range(5):
+            await asyncio.sleep(0)
+        # the sentinel is in, but the slow command is still running
+        assert not main.done() and ('put', 1, 'slow') not in log
+        module.release.set()
+        await asyncio.wait_for(main, 1)
+
+    asyncio.run(run())
+    return log
+
+def test_main_drains_running_commands_before_acknowledging_the_sentinel():
+    module = bare_module(Worked, max_concurrency=4)
+    log = run_worker(module, [1, 'slow', [], {}], None)
+    assert log == [('put', 1, 'slow'), ('task_done',), ('task_done',)]
+
+def test_plain_function_commands_run_on_the_thread_pool():
+    module = bare_module(Worked, max_concurrency=4, _threads=ThreadPoolExecutor(1, thread_name_prefix='commands'))
+    try:
+        log = run_worker(module, [1, 'slow', [], {}], [2, 'blocking', [], {}], None)
+    finally:
+        module._threads.shutdown()
+    name, = [entry[2] for entry in log if entry[:2] == ('put', 2)]
+    assert name.startswith('commands') and name != threading.current_thread().name
+    # and the rest kept going while the slow one waited
+    assert log.index(('put', 1, 'slow')) > log.index(('put', 2, name))
+    assert log[-2:] == [('task_done',), ('task_done',)] and log.count(('task_done',)) == 3
+
+def test_invalidate_options_broadcasts_clear_the_workers_options_cache():
+    manager = Manager.__new__(Manager)
+    manager.modules = {'worked': [ModuleInfo('worked', 'Worked', {}, {}), None]}
+    pool = ModulePool(bare_module(Worked))
+    workers = [FakeWorker(0), FakeWorker(1)]
+    for worker in workers:
+        pool.workers[worker.wid] = worker
+    manager.processes = {'worked': pool}
+    module = bare_module(Worked)
+    for server_id in ('1', '2', '3'):
+        module._server_options.set(server_id, {'option': server_id})
+
+    async def run():
+        assert await manager.invalidate_options('Worked', '1')
+        assert await manager.invalidate_options('Worked', None)
+        assert not await manager.invalidate_options('Other', None)
+        # what one worker was sent, played into a real one
+        control = Control()
+        listener = asyncio.ensure_future(module._listen(control))
+        first, everything = workers[0].control.sent
+        control.queue.put_nowait(first)
+        for i in range(3):
+            await asyncio.sleep(0)
+        assert module._server_options.get('1') is MISSING and module._server_options.get('2') == {'option': '2'}
+        control.queue.put_nowait(everything)
+        control.queue.put_nowait(None)
+        await asyncio.wait_for(listener, 1)
+
+    asyncio.run(run())
+    assert all(w.control.sent == [['invalidate_options', '1'], ['invalidate_options', None]] for w in workers)
+    assert len(module._server_options) == 0
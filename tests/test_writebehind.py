@@ -0,0 +1,74 @@
+import asyncio
+import datetime
+
+from modules.utils import sql
+from modules.utils.writebehind import WriteBehindQueue
+
+from conftest import make_server
+
+def message(mid, channel, author, when=datetime.datetime(2020, 5, 1)):
+    return {'id': mid, 'content': 'hi', 'timestamp': when, 'channel': channel, 'author': author}
+
+def writer(dbx, **kwargs):
+    return WriteBehindQueue(dbx, {
+        sql.User: {'conflict_target': [sql.User.id], 'preserve': [sql.User.name, sql.User.bot]},
+        sql.Message: {'action': 'IGNORE'}
+    }, **kwargs)
+
+def test_flush_writes_and_collapses_upserts(dbx):
+    make_server()
+    async def run():
+        w = writer(dbx)
+        await w.put(sql.User, {'id': 1, 'name': 'old', 'bot': False})
+        await w.put(sql.User, {'id': 1, 'name': 'new', 'bot': False})
+        await w.put(sql.Message, message(1, 10, 1))
+        assert w.depth == 2
+        await w.flush()
+        return w
+    w = asyncio.run(run())
+    assert sql.User[1].name == 'new'
+    assert sql.Message.select().count() == 1
+    assert w.rows_written == 2 and w.dropped == 0 and w.depth == 0
+
+def test_bad_row_only_drops_itself(dbx):
+    make_server()
+    async def run():
+        w = writer(dbx, chunk_size=2)
+        await w.put(sql.User, {'id': 1, 'name': 'someone', 'bot': False})
+        for mid in range(1, 5):
+            # message 3 is in a channel that was never synced
+            await w.put(sql.Message, message(mid, 99 if mid == 3 else 10, 1))
+        await w.flush()
+        return w
+    w = asyncio.run(run())
+    assert sql.User.get_or_none(sql.User.id == 1) is not None
+    assert sorted(m.id for m in sql.Message.select()) == [1, 2, 4]
+    assert w.rows_written == 4 and w.dropped == 1
+
+def test_partitioned_messages_go_to_their_month(dbx):
+    make_server()
+    async def run():
+        w = writer(dbx, partitions={sql.Message: sql.partition_messages})
+        await w.put(sql.User, {'id': 1, 'name': 'someone', 'bot': False})
+        await w.put(sql.Message, message(1, 10, 1, datetime.datetime(2020, 5, 1)))
+        await w.put(sql.Message, message(2, 10, 1, datetime.datetime(2020, 6, 1)))
+        await w.close()
+    asyncio.run(run())
+    assert [m._meta.table_name for m in sql.message_partitions()] == ['message_202006', 'message_202005']
+    assert sql.Message.select().count() == 0
+
+def test_stats_are_published_as_gauges(dbx):
+    from modules.utils.metrics import Metrics
+    make_server()
+    metrics = Metrics()
+    async def run():
+        w = writer(dbx, max_pending=1, put_timeout=0.01)
+        metrics.gauge('writebehind', w.stats)
+        await w.put(sql.User, {'id': 1, 'name': 'someone', 'bot': False})
+        # no room, and nothing flushing to make any
+        assert not await w.put(sql.User, {'id': 2, 'name': 'someone else', 'bot': False})
+        await w.flush()
+    asyncio.run(run())
+    gauges = metrics.snapshot()['gauges']
+    assert gauges['writebehind.dropped'] == 1 and gauges['writebehind.rows_written'] == 1
+    assert 'writebehind.depth 0' in metrics.render()